@@ -26,31 +26,38 @@ Requirements:
 
 # Imports for general use
 import argparse
+import cProfile
+import errno
+import hashlib
+import httplib
+import json
 import logging
+import marshal
 import os
 import plistlib
+import Queue
+import re
 import sys
 import shutil
+import socket
 import ssl
 import subprocess
+import threading
+import time
 import traceback
-import urllib2
+import uuid
+import xml.parsers.expat
 
 from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
 from distutils.version import LooseVersion, StrictVersion
 from glob import glob
 from logging.handlers import RotatingFileHandler
-from urlparse import urlparse
-
-# Imports specifically for FoundationPlist
-# PyLint cannot properly find names inside Cocoa libraries, so issues bogus
-# No name 'Foo' in module 'Bar' warnings. Disable them.
-# pylint: disable=E0611
-from Foundation import NSData  # NOQA
-from Foundation import NSPropertyListSerialization
-from Foundation import NSPropertyListMutableContainers
-from Foundation import NSPropertyListXMLFormat_v1_0  # NOQA
-# pylint: enable=E0611
+from urlparse import urljoin, urlparse
+
+# Startup time, reported with --debug
+started = time.time()
 
 # Script information
 __script__ = 'appleLoops.py'
@@ -67,6 +74,17 @@ __status__ = 'Production'
 
 version_string = '%s version %s (%s). Author: %s (licensed under the %s). Status: %s. GitHub: %s' % (__script__, __version__, __date__, __copyright__, __license__, __status__, __github__)  # NOQA
 
+# Where loops come from, and the tools used to fetch and install them. These
+# can be swapped out, i.e. for a local server and fake tools when benchmarking.
+APPLE_URL = 'https://audiocontentdownload.apple.com'
+CURL = '/usr/bin/curl'
+DISKUTIL = '/usr/sbin/diskutil'
+HDIUTIL = '/usr/bin/hdiutil'
+INSTALLER = '/usr/sbin/installer'
+PKGUTIL = '/usr/sbin/pkgutil'
+# Where packages are downloaded to before they are installed in deployment mode
+DEPLOYMENT_PATH = '/tmp'
+
 
 # FoundationPlist from munki
 class FoundationPlistException(Exception):
@@ -84,6 +102,14 @@ def readPlist(filepath):
     Read a .plist file from filepath.  Return the unpacked root object
     (which is usually a dictionary).
     """
+    # Foundation is slow to import, so it is only imported when a plist
+    # actually needs it. PyLint cannot properly find names inside Cocoa
+    # libraries, so issues bogus No name 'Foo' in module 'Bar' warnings.
+    # pylint: disable=E0611
+    from Foundation import NSData
+    from Foundation import NSPropertyListSerialization
+    from Foundation import NSPropertyListMutableContainers
+    # pylint: enable=E0611
     plistData = NSData.dataWithContentsOfFile_(filepath)
     dataObject, dummy_plistFormat, error = (
         NSPropertyListSerialization.
@@ -102,6 +128,10 @@ def readPlist(filepath):
 
 def readPlistFromString(data):
     '''Read a plist data from a string. Return the root object.'''
+    # pylint: disable=E0611
+    from Foundation import NSPropertyListSerialization
+    from Foundation import NSPropertyListMutableContainers
+    # pylint: enable=E0611
     try:
         plistData = buffer(data)
     except TypeError, err:
@@ -120,43 +150,1731 @@ def readPlistFromString(data):
         return dataObject
 
 
+# Threading
+def threaded_map(function, items, workers=1):
+    '''Applies function to each item on a bounded pool of worker threads.
+    Results are returned in the same order as items. If any call raises,
+    remaining work is abandoned and the first exception is re-raised.'''
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+
+    for index, item in enumerate(items):
+        work.put((index, item))
+
+    def worker():
+        while not errors:
+            try:
+                index, item = work.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[index] = function(item)
+            except BaseException:
+                # Catches SystemExit as well so AppleLoops.exit() still works
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for thread in range(min(workers, len(items)))]  # NOQA
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    return results
+
+
+class RequestsException(Exception):
+    """Raised when a request returns an unexpected HTTP status"""
+    pass
+
+
+# Feed reader
+class FeedReader():
+    '''Incremental reader for XML plist feeds, fed a chunk at a time as the
+    feed streams in. Only the top level keys asked for are built into Python
+    objects. Everything else, like the large base64 PackageContentsUpdateData
+    blob, is skipped over without being kept or decoded. This uses expat, so
+    doesn't need Foundation.'''
+    def __init__(self, keys=None):
+        # Top level keys to keep, None keeps everything
+        self.keys = keys
+        self.result = None
+
+        # Containers being built, each as [container, pending dict key]
+        self.stack = []
+        self.text = []
+        self.depth = 0
+        self.skip_depth = None
+
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._data
+
+    def _start(self, name, attrs):
+        self.depth += 1
+        if self.skip_depth or name == 'plist':
+            return
+
+        # Skip values of top level keys that aren't wanted
+        if len(self.stack) == 1 and name != 'key' and self.keys is not None:
+            if self.stack[0][1] not in self.keys:
+                self.skip_depth = self.depth
+                return
+
+        if name == 'dict':
+            self.stack.append([{}, None])
+        elif name == 'array':
+            self.stack.append([[], None])
+        else:
+            self.text = []
+
+    def _data(self, data):
+        if not self.skip_depth:
+            self.text.append(data)
+
+    def _end(self, name):
+        depth = self.depth
+        self.depth -= 1
+
+        if self.skip_depth:
+            if depth == self.skip_depth:
+                self.skip_depth = None
+                self.stack[0][1] = None
+            return
+
+        if name == 'plist':
+            return
+        elif name == 'key':
+            self.stack[-1][1] = ''.join(self.text)
+            return
+        elif name in ['dict', 'array']:
+            value = self.stack.pop()[0]
+            if not self.stack:
+                self.result = value
+                return
+        elif name == 'integer':
+            value = int(''.join(self.text))
+        elif name == 'real':
+            value = float(''.join(self.text))
+        elif name in ['true', 'false']:
+            value = name == 'true'
+        elif name == 'data':
+            value = ''.join(self.text).decode('base64')
+        elif name == 'date':
+            # Dates are written in UTC, as plistlib reads them
+            value = datetime.strptime(''.join(self.text), '%Y-%m-%dT%H:%M:%SZ')  # NOQA
+        else:
+            value = ''.join(self.text)
+
+        parent = self.stack[-1]
+        if isinstance(parent[0], dict):
+            parent[0][parent[1]] = value
+            parent[1] = None
+        else:
+            parent[0].append(value)
+
+    def feed(self, data):
+        '''Parses the next chunk of the feed.'''
+        self.parser.Parse(data, False)
+
+    def close(self):
+        '''Finishes parsing and returns the result.'''
+        self.parser.Parse('', True)
+        return self.result
+
+    def parse_file(self, fileobj, chunk_size=65536):
+        '''Parses a file object a chunk at a time and returns the result.'''
+        for chunk in iter(lambda: fileobj.read(chunk_size), ''):
+            self.feed(chunk)
+        return self.close()
+
+
 # Requests
 class Requests():
-    '''Simplify url requests'''
-    def __init__(self, allow_insecure=False):
+    '''Simplify url requests. Connections are kept alive and pooled per host,
+    so repeated requests to the same server re-use an open connection instead
+    of doing a new TCP/TLS handshake every time.'''
+    def __init__(self, allow_insecure=False, pool_size=4, timeout=5):
         self.allow_insecure = allow_insecure
-        self.timeout = 5
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_redirects = 5
+
+        # Largest unread response body that is drained so the connection can
+        # go back into the pool. Anything bigger (i.e. a pkg) closes instead.
+        self.drain_limit = 65536
+
+        # Idle connections, keyed by (scheme, netloc)
+        self.pools = {}
+        self.lock = threading.Lock()
+
+        # Connection counters
+        self.stats = {
+            'connections_opened': 0,
+            'connections_reused': 0,
+            'requests': 0,
+        }
 
-    def response_code(self, url):
-        try:
+    def _connection(self, scheme, netloc, fresh=False):
+        '''Returns a tuple of an idle connection for the host (or a new one)
+        and whether it was re-used.'''
+        with self.lock:
+            self.stats['requests'] += 1
+            idle = self.pools.get((scheme, netloc))
+            if idle and not fresh:
+                self.stats['connections_reused'] += 1
+                return (idle.pop(), True)
+
+            self.stats['connections_opened'] += 1
+
+        if scheme == 'https':
             if self.allow_insecure:
-                return urllib2.urlopen(url, timeout=self.timeout, context=ssl._create_unverified_context()).getcode()  # NOQA
+                return (httplib.HTTPSConnection(netloc, timeout=self.timeout, context=ssl._create_unverified_context()), False)  # NOQA
+            else:
+                return (httplib.HTTPSConnection(netloc, timeout=self.timeout), False)  # NOQA
+        else:
+            return (httplib.HTTPConnection(netloc, timeout=self.timeout), False)  # NOQA
+
+    def open(self, url, method='GET', headers=None):
+        '''Sends a request and returns the response with the body unread.
+        Redirects are followed. The response must be handed back with
+        release() when finished with.'''
+        for redirect in range(self.max_redirects + 1):
+            parsed = urlparse(url)
+            path = parsed.path or '/'
+            if parsed.query:
+                path = '%s?%s' % (path, parsed.query)
+
+            request_headers = {'Connection': 'keep-alive'}
+            if headers:
+                request_headers.update(headers)
+
+            conn, reused = self._connection(parsed.scheme, parsed.netloc)
+            try:
+                conn.request(method, path, headers=request_headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # A pooled connection may have been closed by the server
+                # while idle, so try once more on a new connection.
+                if not reused:
+                    raise
+                conn, reused = self._connection(parsed.scheme, parsed.netloc, fresh=True)  # NOQA
+                try:
+                    conn.request(method, path, headers=request_headers)
+                    response = conn.getresponse()
+                except Exception:
+                    conn.close()
+                    raise
+
+            response.pool_key = (parsed.scheme, parsed.netloc)
+            response.pool_conn = conn
+
+            location = response.getheader('location')
+            if response.status in [301, 302, 303, 307, 308] and location:
+                self.release(response)
+                url = urljoin(url, location)
             else:
-                return urllib2.urlopen(url, timeout=self.timeout).getcode()
-        except urllib2.HTTPError as e:
-            return e.getcode()
-        except urllib2.URLError as e:
+                return response
+
+        raise RequestsException('Too many redirects: %s' % url)
+
+    def release(self, response, discard=False):
+        '''Hands the connection used by a response back to the pool. Small
+        unread bodies are drained first, larger ones close the connection.'''
+        conn = response.pool_conn
+        try:
+            if discard or response.will_close:
+                conn.close()
+                return
+
+            if not response.isclosed():
+                if response.length is None or response.length > self.drain_limit:  # NOQA
+                    conn.close()
+                    return
+                response.read()
+        except Exception:
+            conn.close()
+            return
+
+        with self.lock:
+            idle = self.pools.setdefault(response.pool_key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        '''Closes all idle pooled connections.'''
+        with self.lock:
+            for key in self.pools:
+                for conn in self.pools[key]:
+                    conn.close()
+            self.pools = {}
+
+    def response_code(self, url):
+        '''Returns the HTTP status of a HEAD request. HEAD has no body, so the
+        connection goes back into the pool however big the file is.'''
+        try:
+            response = self.open(url, method='HEAD')
+            self.release(response)
+            return response.status
+        except Exception as e:
             return e
 
     def get_headers(self, url):
+        return self.head(url)
+
+    def head(self, url):
+        '''Returns the headers of a HEAD request as a dictionary.'''
         try:
-            if self.allow_insecure:
-                return dict(urllib2.urlopen(url, timeout=self.timeout, context=ssl._create_unverified_context()).info())  # NOQA
-            else:
-                return dict(urllib2.urlopen(url, timeout=self.timeout).info())
+            response = self.open(url, method='HEAD')
+            self.release(response)
+            if response.status >= 400:
+                raise RequestsException('HTTP Error %s: %s' % (response.status, url))  # NOQA
+            return dict(response.getheaders())
         except Exception as e:
             return e
 
     def read_data(self, url):
         try:
-            if self.allow_insecure:
-                return urllib2.urlopen(url, timeout=self.timeout, context=ssl._create_unverified_context()).read()  # NOQA
-            else:
-                return urllib2.urlopen(url, timeout=self.timeout).read()
+            response = self.open(url)
+            if response.status >= 400:
+                self.release(response)
+                raise RequestsException('HTTP Error %s: %s' % (response.status, url))  # NOQA
+            result = response.read()
+            self.release(response)
+            return result
         except Exception as e:
             return e
 
 
+# Cache
+class HTTPCache():
+    '''On disk cache for documents such as the configuration and feed plists.
+    Each document is kept with its ETag and Last-Modified headers, so later
+    fetches are conditional and only download the document if it changed.
+    In offline mode documents are only ever served from the cache.'''
+    def __init__(self, request, cache_path, offline=False):
+        self.request = request
+        self.cache_path = cache_path
+        self.offline = offline
+        self.stats = {
+            'fetched': 0,
+            'not_modified': 0,
+            'served_from_cache': 0,
+        }
+
+    def _paths(self, url):
+        '''Returns the data and metadata file paths for a url.'''
+        key = hashlib.sha1(url).hexdigest()
+        return (os.path.join(self.cache_path, '%s.data' % key),
+                os.path.join(self.cache_path, '%s.plist' % key))
+
+    def fetch_file(self, url, consumers=None, stale=True):
+        '''Returns a tuple of the HTTP status, the path to the cached document
+        for a url, and whether the consumers were fed the whole document. A
+        changed document is streamed to disk, and each chunk is handed to the
+        consumers as it arrives. Documents served from the cache have a status
+        of 200. If the request fails, the status is the exception raised, or
+        the stale cached copy is served unless stale is False. A document a
+        consumer raises an exception for is never cached, and the stale copy
+        isn't served in its place.'''
+        data_file, meta_file = self._paths(url)
+        try:
+            meta = plistlib.readPlist(meta_file)
+            cached = os.path.exists(data_file)
+        except Exception:
+            meta = {}
+            cached = False
+
+        if self.offline:
+            if cached:
+                self.stats['served_from_cache'] += 1
+                return (200, data_file, False)
+            else:
+                return (RequestsException('%s is not cached, cannot fetch in offline mode' % url), None, False)  # NOQA
+
+        headers = {}
+        if cached:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last-modified'):
+                headers['If-Modified-Since'] = meta['last-modified']
+
+        unread = None
+        rejected = False
+        tmp_file = '%s.tmp' % data_file
+        try:
+            response = unread = self.request.open(url, headers=headers)
+            if response.status == 304 and cached:
+                self.request.release(response)
+                self.stats['not_modified'] += 1
+                return (200, data_file, False)
+            elif response.status != 200:
+                self.request.release(response)
+                return (response.status, None, False)
+
+            if not os.path.exists(self.cache_path):
+                os.makedirs(self.cache_path)
+
+            # Write to a temporary file first so a half written document is
+            # never served from the cache.
+            with open(tmp_file, 'wb') as f:
+                for chunk in iter(lambda: response.read(65536), ''):
+                    f.write(chunk)
+                    try:
+                        for consumer in (consumers or []):
+                            consumer(chunk)
+                    except Exception:
+                        rejected = True
+                        raise
+            self.request.release(response)
+            unread = None
+            os.rename(tmp_file, data_file)
+
+            meta = {'url': url}
+            for header in ['etag', 'last-modified']:
+                if response.getheader(header):
+                    meta[header] = response.getheader(header)
+            plistlib.writePlist(meta, meta_file)
+
+            self.stats['fetched'] += 1
+            return (200, data_file, True)
+        except Exception as e:
+            # The rest of the document is unread, so don't pool the connection
+            if unread is not None:
+                self.request.release(unread, discard=True)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+            # Better to use a stale copy than nothing at all, unless the
+            # document was fetched and rejected
+            if cached and stale and not rejected:
+                self.stats['served_from_cache'] += 1
+                return (200, data_file, False)
+            return (e, None, False)
+
+    def fetch(self, url, stale=True):
+        '''Returns a tuple of the HTTP status and document for a url.'''
+        status, data_file, streamed = self.fetch_file(url, stale=stale)
+        if status != 200:
+            return (status, None)
+
+        with open(data_file, 'rb') as f:
+            return (200, f.read())
+
+
+# Feed index
+class FeedIndex():
+    '''Compact binary index of the parts of a feed that are actually used,
+    the Packages (and Content groups), without the large data blobs. Indexes
+    are keyed by feed name and the hash of the feed, so a changed feed is
+    never served from a stale index.'''
+    version = 2
+    package_keys = ['DownloadName', 'DownloadSize', 'InstalledSize',
+                    'IsMandatory', 'PackageID', 'PackageVersion']
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+    def path(self, feed, digest):
+        '''Returns the index file path for a feed with the given hash.'''
+        return os.path.join(self.index_path, '%s-%s.idx' % (os.path.splitext(feed)[0], digest))  # NOQA
+
+    def _value(self, value):
+        '''Converts plist values to plain types that marshal can write.'''
+        if isinstance(value, bool):
+            return bool(value)
+        elif isinstance(value, (int, long)):
+            return int(value)
+        elif isinstance(value, float):
+            return float(value)
+        else:
+            return unicode(value)
+
+    def compact(self, result):
+        '''Returns just the Packages and Content of a parsed feed.'''
+        packages = {}
+        for pkg in result['Packages']:
+            info = result['Packages'][pkg]
+            packages[unicode(pkg)] = dict((key, self._value(info[key])) for key in self.package_keys if key in info)  # NOQA
+
+        # GarageBand feeds have a list of Content groups, Logic Pro and
+        # MainStage feeds a list for each language. The groups are the same
+        # in every language, so English is used if it is there.
+        groups = result.get('Content') or []
+        if isinstance(groups, dict):
+            locales = sorted(groups)
+            if 'en' in groups:
+                groups = groups['en']
+            elif locales:
+                groups = groups[locales[0]]
+            else:
+                groups = []
+
+        content = []
+        for group in groups:
+            content.append({'Name': unicode(group['Name']),
+                            'Packages': self.group_packages(group)})
+
+        return {'Packages': packages, 'Content': content}
+
+    def group_packages(self, group):
+        '''Returns the packages in a Content group, followed by those in its
+        SubContent groups, in the order they are listed.'''
+        packages = [unicode(pkg) for pkg in group.get('Packages', [])]
+        for sub_group in group.get('SubContent', []):
+            packages.extend(self.group_packages(sub_group))
+        return packages
+
+    def load(self, feed, digest):
+        '''Returns the indexed feed, or None if there is no current index.'''
+        try:
+            with open(self.path(feed, digest), 'rb') as f:
+                index = marshal.load(f)
+            if index['version'] == self.version:
+                return index['result']
+        except Exception:
+            pass
+
+        return None
+
+    def compile(self, feed, digest, result):
+        '''Writes the index for a parsed feed and returns the compact feed.'''
+        compact = self.compact(result)
+        index_file = self.path(feed, digest)
+        try:
+            if not os.path.exists(self.index_path):
+                os.makedirs(self.index_path)
+            with open('%s.tmp' % index_file, 'wb') as f:
+                marshal.dump({'version': self.version, 'feed': feed, 'result': compact}, f)  # NOQA
+            os.rename('%s.tmp' % index_file, index_file)
+        except Exception:
+            pass
+
+        return compact
+
+
+# Sources
+class SourcePool():
+    '''Ranks a list of download sources (caching servers or pkg servers) by
+    health, latency and throughput. Sources are checked in the background,
+    and a source a download fails on is treated as down until it passes its
+    next check. Ties keep the order the sources were given in.'''
+    def __init__(self, request, urls, interval=30, caching=False):
+        self.request = request
+        self.urls = list(urls)
+        self.interval = interval
+        self.caching = caching
+        # Weight given to the newest latency or throughput sample
+        self.alpha = 0.3
+        self.lock = threading.Lock()
+        self.checker = None
+        self.stopped = threading.Event()
+
+        self.sources = {}
+        for order, url in enumerate(self.urls):
+            self.sources[url] = {
+                'order': order,
+                'healthy': None,
+                'latency': None,
+                'throughput': None,
+                'failures': 0,
+                'downloads': 0,
+            }
+
+    def _average(self, current, sample):
+        if current is None:
+            return sample
+        return current + self.alpha * (sample - current)
+
+    def probe(self, url):
+        '''Checks a source is up. A caching server answers a request without
+        a source with 400 Bad Request, anything else isn't a caching server.
+        A pkg server has to answer with a success or a redirect, or with 403
+        or 404 as a munki repo often has no listing for its root.'''
+        start = time.time()
+        status = self.request.response_code(url)
+        elapsed = time.time() - start
+        if self.caching:
+            healthy = status == 400
+        else:
+            healthy = isinstance(status, int) and (200 <= status < 400 or status in [403, 404])  # NOQA
+        with self.lock:
+            source = self.sources[url]
+            source['healthy'] = healthy
+            if healthy:
+                source['latency'] = self._average(source['latency'], elapsed)
+
+        return healthy
+
+    def check(self):
+        '''Checks every source at the same time.'''
+        threaded_map(self.probe, self.urls, workers=len(self.urls))
+
+    def start(self):
+        '''Re-checks every source each interval on a background thread, until
+        stopped.'''
+        def checker():
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.check()
+                except Exception:
+                    pass
+
+        if len(self.urls) > 1 and not self.checker:
+            self.checker = threading.Thread(target=checker)
+            self.checker.daemon = True
+            self.checker.start()
+
+    def stop(self):
+        '''Stops the background checks.'''
+        self.stopped.set()
+
+    def record(self, url, seconds, size, ok=True):
+        '''Scores a download from a source. A failed download marks the
+        source as down.'''
+        with self.lock:
+            source = self.sources[url]
+            if ok:
+                source['downloads'] += 1
+                if seconds > 0 and size > 0:
+                    source['throughput'] = self._average(source['throughput'], size / seconds)  # NOQA
+            else:
+                source['failures'] += 1
+                source['healthy'] = False
+
+    def score(self, url):
+        '''Returns the estimated seconds to fetch a 1MB package from a
+        source, or None if it hasn't been measured.'''
+        source = self.sources[url]
+        if source['latency'] is None:
+            return None
+        if source['throughput']:
+            return source['latency'] + 1048576.0 / source['throughput']
+        return source['latency']
+
+    def ranked(self):
+        '''Returns the sources best first. Sources that are down are last.'''
+        with self.lock:
+            return sorted(self.urls, key=lambda url: (self.sources[url]['healthy'] is False, self.score(url) is None, self.score(url), self.sources[url]['order']))  # NOQA
+
+    def best(self):
+        '''Returns the best source that is up, or None.'''
+        for url in self.ranked():
+            if self.sources[url]['healthy'] is not False:
+                return url
+
+    def source_for(self, url):
+        '''Returns the source a url belongs to, or None.'''
+        for source in self.urls:
+            if url.startswith('%s/' % source):
+                return source
+
+
+# Downloads
+class DownloadScheduler():
+    '''Runs queued downloads on a pool of threads. Each download is tagged
+    with the source it comes from (apple, pkg_server or cache_server), and
+    each source has its own limit on concurrent transfers.'''
+    def __init__(self, workers=1, limits=None, profiler=None):
+        self.workers = max(1, workers)
+        self.profiler = profiler or Profiler()
+        self.sources = ['apple', 'pkg_server', 'cache_server']
+        self.jobs = []
+        self.lock = threading.Lock()
+
+        # Concurrent transfers per source default to the number of workers
+        self.limits = {}
+        for source in self.sources:
+            try:
+                limit = int(limits[source])
+            except Exception:
+                limit = self.workers
+            self.limits[source] = threading.BoundedSemaphore(max(1, limit))
+
+        # Aggregate transfer stats across all runs
+        self.stats = {
+            'bytes': 0,
+            'elapsed': 0.0,
+            'transfers': 0,
+        }
+        # Bytes transferred from each source
+        self.source_bytes = dict((source, 0) for source in self.sources)
+
+    def add(self, source, cmd, destination, callback=None, size=0, item=None):  # NOQA
+        '''Queues a download command, or a function to call. A function can
+        return a dictionary of the bytes it downloaded from each source, as
+        a download can end up coming from another source. The callback is
+        called with the scheduler lock held once the download has finished.
+        Size is the expected download size, and item is handed on to the
+        finished queue when running as part of a pipeline. A cmd of None is
+        for something already downloaded, its item is just handed on.'''
+        self.jobs.append((source, cmd, destination, callback, size, item))
+
+    def _transfer(self, job, staging=None, finished=None):
+        source, cmd, destination, callback, size, item = job
+
+        # Wait for room in the staging area before starting
+        if staging:
+            staging.reserve(size)
+
+        # Partial files are resumed, so only count what is transferred now
+        try:
+            existing_size = os.path.getsize(destination)
+        except OSError:
+            existing_size = 0
+
+        # A download is either a command, or a function that does the work
+        if cmd is not None:
+            served = None
+            with self.limits[source]:
+                if callable(cmd):
+                    served = cmd()
+                else:
+                    self.profiler.count(cmd)
+                    subprocess.check_call(cmd)
+
+            with self.lock:
+                try:
+                    transferred = os.path.getsize(destination) - existing_size  # NOQA
+                    self.stats['bytes'] += transferred
+                    for served_source, served_bytes in (served or {source: transferred}).items():  # NOQA
+                        self.source_bytes[served_source] += served_bytes
+                except OSError:
+                    pass
+                self.stats['transfers'] += 1
+                if callback:
+                    callback()
+
+        if finished is not None:
+            finished.put(item)
+
+    def run(self, staging=None, finished=None):
+        '''Runs all queued downloads, returning once they have finished. If a
+        staging area is provided, space is reserved in it before each download
+        starts. Items of finished downloads are put on the finished queue.'''
+        jobs, self.jobs = self.jobs, []
+        start = time.time()
+        try:
+            threaded_map(lambda job: self._transfer(job, staging, finished), jobs, workers=self.workers)  # NOQA
+        finally:
+            self.stats['elapsed'] += time.time() - start
+
+    def throughput(self):
+        '''Returns the average bytes per second across all runs.'''
+        if self.stats['elapsed'] > 0:
+            return int(self.stats['bytes'] / self.stats['elapsed'])
+        else:
+            return 0
+
+
+class RateLimit():
+    '''Token bucket that caps the combined transfer rate, in bytes per
+    second, of every download sharing it.'''
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        '''Takes amount bytes from the bucket, sleeping off any debt.'''
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)  # NOQA
+            self.last = now
+            self.allowance -= amount
+            wait = -self.allowance / float(self.rate) if self.allowance < 0 else 0  # NOQA
+
+        if wait:
+            time.sleep(wait)
+
+
+# Download order
+def _order_fair(items):
+    '''Takes a package from each feed in turn.'''
+    feeds = []
+    queues = {}
+    for item in items:
+        feed = item[1].pkg_plist
+        if feed not in queues:
+            feeds.append(feed)
+            queues[feed] = []
+        queues[feed].append(item)
+
+    ordered = []
+    while len(ordered) < len(items):
+        for feed in feeds:
+            if queues[feed]:
+                ordered.append(queues[feed].pop(0))
+
+    return ordered
+
+
+# Ordering policies for downloads. Each takes a list of (rank, loop) tuples,
+# where rank is the (feed, Content group, position) a package was first seen
+# at, and returns them in the order they should be downloaded.
+download_orders = {
+    'feed': lambda items: items,
+    'mandatory': lambda items: sorted(items, key=lambda item: not item[1].pkg_mandatory),  # NOQA
+    'content': lambda items: sorted(items, key=lambda item: item[0]),
+    'smallest': lambda items: sorted(items, key=lambda item: item[1].pkg_size if item[1].pkg_size is not None else sys.maxint),  # NOQA
+    'fair': _order_fair,
+}
+
+
+def order_loops(loops, policy='feed', ranks=None):
+    '''Returns loops in download order for a policy in download_orders.'''
+    if ranks is None:
+        ranks = [(0, 0, 0)] * len(loops)
+
+    return [loop for rank, loop in download_orders[policy](list(zip(ranks, loops)))]  # NOQA
+
+
+class SegmentedDownload():
+    '''Downloads a file as several byte ranges at once, each over its own
+    connection. Ranges are shared out between the urls given, and a range
+    that fails on one url is retried on the next.
+
+    Each range is written into its place in a preallocated .part file,
+    which is renamed to the destination once every range is complete. How
+    far each range got is kept in a state file next to the .part file, so
+    an interrupted download carries on from where each range stopped.'''
+    # Packages smaller than this aren't worth splitting up
+    min_size = 104857600
+
+    # Bytes written by a range between saves of the state file
+    checkpoint = 4194304
+
+    def __init__(self, request, urls, destination, size, segments=4, headers=None, rate_limit=None):  # NOQA
+        self.request = request
+        self.rate_limit = rate_limit
+        self.urls = urls
+        self.destination = destination
+        self.size = size
+        self.segments = max(1, segments)
+        self.headers = headers or {}
+        self.part = '%s.part' % destination
+        self.state_file = '%s.plist' % self.part
+        self.lock = threading.Lock()
+
+        # Each range is [start, end, bytes done]
+        self.ranges = []
+        # Url mapped to the bytes downloaded from it
+        self.served = {}
+
+    def _load_state(self):
+        '''Picks up the ranges from an interrupted download of the same size,
+        otherwise splits the file into new ranges.'''
+        try:
+            state = plistlib.readPlist(self.state_file)
+            if state['size'] == self.size and os.path.getsize(self.part) == self.size:  # NOQA
+                self.ranges = state['ranges']
+                return
+        except Exception:
+            pass
+
+        segment_size = -(-self.size // self.segments)
+        self.ranges = [[start, min(start + segment_size, self.size) - 1, 0] for start in range(0, self.size, segment_size)]  # NOQA
+
+        # Preallocate, so each range can be written straight to its offset
+        if not os.path.exists(os.path.dirname(self.part)):
+            os.makedirs(os.path.dirname(self.part))
+        with open(self.part, 'wb') as f:
+            f.truncate(self.size)
+
+        self._save_state()
+
+    def _save_state(self):
+        with self.lock:
+            plistlib.writePlist({'size': self.size, 'ranges': self.ranges}, self.state_file)  # NOQA
+
+    def _written(self, index, url, written):
+        with self.lock:
+            self.ranges[index][2] += written
+            self.served[url] = self.served.get(url, 0) + written
+
+    def _fetch(self, index):
+        '''Downloads one range, trying each url in turn until it completes.'''
+        start, end, done = self.ranges[index]
+        error = None
+        urls = self.urls[index % len(self.urls):] + self.urls[:index % len(self.urls)]  # NOQA
+
+        for url in urls:
+            offset = start + self.ranges[index][2]
+            if offset > end:
+                return
+
+            response = None
+            try:
+                headers = {'Range': 'bytes=%s-%s' % (offset, end)}
+                headers.update(self.headers)
+                response = self.request.open(url, headers=headers)
+
+                # A 200 response is the whole file, so the server doesn't
+                # support ranges
+                content_range = re.match(r'bytes (\d+)-(\d+)/(\d+)$', response.getheader('content-range') or '')  # NOQA
+                if response.status != 206 or not content_range or int(content_range.group(1)) != offset:  # NOQA
+                    self.request.release(response, discard=True)
+                    raise RequestsException('HTTP Error %s: ranged request for %s' % (response.status, url))  # NOQA
+
+                # The .part file is the size from the feed, so a file of any
+                # other size would end up truncated or padded with zeros
+                if int(content_range.group(3)) != self.size:
+                    self.request.release(response, discard=True)
+                    raise RequestsException('Size mismatch for %s - expected: %s  server: %s' % (url, self.size, content_range.group(3)))  # NOQA
+
+                with open(self.part, 'r+b') as f:
+                    f.seek(offset)
+                    written = 0
+                    for chunk in iter(lambda: response.read(65536), ''):
+                        f.write(chunk)
+                        written += len(chunk)
+                        if self.rate_limit:
+                            self.rate_limit.consume(len(chunk))
+
+                        # Only record bytes once they're flushed to disk
+                        if written >= self.checkpoint:
+                            f.flush()
+                            self._written(index, url, written)
+                            written = 0
+                            self._save_state()
+                    f.flush()
+                    self._written(index, url, written)
+
+                self.request.release(response)
+            except Exception as e:
+                if response is not None:
+                    self.request.release(response, discard=True)
+                error = e
+
+        if start + self.ranges[index][2] <= end:
+            raise error or RequestsException('Incomplete range %s-%s of %s' % (start, end, self.destination))  # NOQA
+
+    def run(self):
+        '''Downloads all ranges, then moves the finished file into place.'''
+        self._load_state()
+        try:
+            threaded_map(self._fetch, range(len(self.ranges)), workers=len(self.ranges))  # NOQA
+        finally:
+            self._save_state()
+
+        if os.path.getsize(self.part) != self.size:
+            raise RequestsException('Size mismatch for %s' % self.destination)
+
+        os.rename(self.part, self.destination)
+        os.remove(self.state_file)
+
+
+class StagingArea():
+    '''Tracks bytes of downloads waiting to be installed, so downloads can run
+    ahead of installs without running out of space. A size of None (the size
+    lookup failed) counts as nothing.'''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        # Bytes of files left on disk after their install was attempted
+        self.kept = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, size):
+        '''Blocks until size bytes fit in the staging area. Something is
+        always allowed in when nothing is waiting to be installed, otherwise
+        a package bigger than the limit would never be downloaded.'''
+        size = size or 0
+        with self.condition:
+            while self.used and self.used + self.kept + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        '''Frees size bytes once a file is removed from disk.'''
+        size = size or 0
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+    def keep(self, size):
+        '''Stops size bytes waiting to be installed, but keeps counting them
+        because the file stays on disk.'''
+        size = size or 0
+        with self.condition:
+            self.used -= size
+            self.kept += size
+            self.condition.notify_all()
+
+
+# Catalog
+class Catalog():
+    '''Packages from one or more feeds, merged by DownloadName so a package
+    listed in several feeds is only processed once. Every feed that
+    references a package is kept, along with whether the package is
+    mandatory or optional in that feed.'''
+    def __init__(self):
+        # Unique DownloadNames in the order they were first seen
+        self.names = []
+        # DownloadName mapped to a list of references
+        self.packages = {}
+        # DownloadName mapped to the (feed, Content group, position) it was
+        # first seen at
+        self.rank = {}
+        self.feeds = 0
+
+    def add_feed(self, app_feed_file, packages, content=None):
+        # Packages that aren't in a Content group sort after those that are
+        groups = content or []
+        for group_index, group in enumerate(groups):
+            for position, pkg in enumerate(group['Packages']):
+                if pkg in packages:
+                    name = packages[pkg]['DownloadName']
+                    if name not in self.rank:
+                        self.rank[name] = (self.feeds, group_index, position)  # NOQA
+
+        for pkg in packages:
+            if packages[pkg]['DownloadName'] not in self.rank:
+                self.rank[packages[pkg]['DownloadName']] = (self.feeds, len(groups), 0)  # NOQA
+        self.feeds += 1
+
+        for pkg in packages:
+            name = packages[pkg]['DownloadName']
+            if name not in self.packages:
+                self.names.append(name)
+                self.packages[name] = []
+
+            try:
+                mandatory = bool(packages[pkg]['IsMandatory'])
+            except Exception:
+                mandatory = False
+
+            self.packages[name].append({
+                'feed': app_feed_file,
+                'mandatory': mandatory,
+                'info': packages[pkg],
+            })
+
+
+# Space
+class SpacePlanner():
+    '''Free space on the volume packages are saved to (or installed on),
+    queried once with diskutil, or statvfs where diskutil can't be used.
+
+    A percentage of the free space can be protected by a threshold. Space
+    for downloads and installs is reserved in a ledger up front, so work
+    that doesn't fit is turned down before anything is downloaded.'''
+    def __init__(self, path='/', threshold=False, diskutil=None, profiler=None):  # NOQA
+        self.path = path
+        self.threshold = threshold
+        self.diskutil = diskutil or DISKUTIL
+        self.profiler = profiler or Profiler()
+        self.free = None
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    def query(self):
+        '''Returns the free space in bytes, only asking the filesystem once.'''
+        if self.free is not None:
+            return self.free
+
+        try:
+            cmd = [self.diskutil, 'info', '-plist', self.path]
+            self.profiler.count(cmd)
+            (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+            self.free = int(plistlib.readPlistFromString(result)['FreeSpace'])
+        except Exception:
+            # The path may not exist yet, so use the nearest folder that does
+            path = os.path.abspath(self.path)
+            while not os.path.exists(path):
+                path = os.path.dirname(path)
+            stat = os.statvfs(path)
+            self.free = stat.f_bavail * stat.f_frsize
+
+        return self.free
+
+    def protected(self):
+        '''Returns the bytes kept free by the threshold.'''
+        if not self.threshold:
+            return 0
+        return self.query() * min(int(self.threshold), 99) // 100
+
+    def usable(self):
+        '''Returns the free space less the protected space.'''
+        return self.query() - self.protected()
+
+    def available(self):
+        '''Returns the usable space that hasn't been reserved yet.'''
+        return self.usable() - self.reserved
+
+    def reserve(self, download=0, install=0, transient=False):
+        '''Reserves space for a package, returning False if it doesn't fit.
+        Transient downloads are deleted once installed, so they only need to
+        fit alongside what is reserved, and aren't kept in the ledger.'''
+        with self.lock:
+            kept = install + (0 if transient else download)
+            if self.reserved + kept + (download if transient else 0) > self.usable():  # NOQA
+                return False
+            self.reserved += kept
+            return True
+
+
+# Destination
+class DestinationIndex():
+    '''Index of packages already in the destination, mapping each package
+    name to the paths it can be found at. Each path has its size and
+    modification time.
+
+    The scan is kept in a manifest between runs, along with the
+    modification time of every folder. On later runs only folders that have
+    changed are listed again, so a large mirror doesn't need a full walk.
+    Folders on the same level are listed in parallel. A file replaced in
+    place doesn't change its folder's mtime, so sizes from the index can be
+    stale - use size() where the size matters.'''
+    version = 1
+
+    def __init__(self, root, manifest_file=None, workers=1):
+        self.root = root
+        self.manifest_file = manifest_file
+        self.workers = workers
+        self.lock = threading.Lock()
+
+        # Folder mapped to its mtime, subfolders, and pkg files with their
+        # size and mtime, as found on disk. This is what the manifest keeps.
+        self.folders = {}
+        # Package name mapped to a list of paths
+        self.files = {}
+        # Path mapped to (size, mtime)
+        self.info = {}
+        self.stats = {'listed': 0, 'reused': 0}
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_file, 'rb') as f:
+                manifest = marshal.load(f)
+            if manifest['version'] == self.version and manifest['root'] == self.root:  # NOQA
+                return manifest['folders']
+        except Exception:
+            pass
+
+        return {}
+
+    def _list(self, folder, previous):
+        '''Returns the entry for a folder, reusing the previous entry if the
+        folder hasn't changed since.'''
+        try:
+            mtime = os.path.getmtime(folder)
+        except OSError:
+            return None
+
+        if folder in previous and previous[folder]['mtime'] == mtime:
+            with self.lock:
+                self.stats['reused'] += 1
+            return previous[folder]
+
+        entry = {'mtime': mtime, 'folders': [], 'files': {}}
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return None
+
+        for name in names:
+            path = os.path.join(folder, name)
+            if name.endswith('.pkg') and os.path.isfile(path):
+                stat = os.stat(path)
+                entry['files'][name] = (stat.st_size, stat.st_mtime)
+            elif os.path.isdir(path) and not os.path.islink(path) and name != ContentStore.folder:  # NOQA
+                entry['folders'].append(path)
+
+        with self.lock:
+            self.stats['listed'] += 1
+        return entry
+
+    def scan(self):
+        '''Builds the index, one level of folders at a time.'''
+        previous = self._load_manifest() if self.manifest_file else {}
+        self.folders = {}
+        self.files = {}
+        self.info = {}
+
+        level = [self.root]
+        while level:
+            entries = threaded_map(lambda folder: self._list(folder, previous), level, workers=self.workers)  # NOQA
+            next_level = []
+            for folder, entry in zip(level, entries):
+                if entry is None:
+                    continue
+                self.folders[folder] = entry
+                next_level.extend(entry['folders'])
+                for name, info in entry['files'].items():
+                    self.add(os.path.join(folder, name), info)
+            level = next_level
+
+    def add(self, path, info=None):
+        '''Adds a path to the index. Paths added during a run are only kept
+        for the run, the manifest is rebuilt from disk next time.'''
+        with self.lock:
+            name = os.path.basename(path)
+            if path not in self.info:
+                self.files.setdefault(name, []).append(path)
+            self.info[path] = info
+
+    def remove(self, path):
+        '''Removes a path from the index.'''
+        with self.lock:
+            name = os.path.basename(path)
+            if path in self.info:
+                del self.info[path]
+                self.files[name].remove(path)
+                if not self.files[name]:
+                    del self.files[name]
+
+    def size(self, path):
+        '''Returns the size of a file as it is on disk now, or None if it
+        is gone, and updates the index with it.'''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            if path in self.info:
+                self.info[path] = (stat.st_size, stat.st_mtime)
+        return stat.st_size
+
+    def find(self, name):
+        '''Returns the first path a package can be found at, or None.'''
+        paths = self.files.get(name)
+        if paths:
+            return paths[0]
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __len__(self):
+        return len(self.info)
+
+    def save(self):
+        '''Writes the manifest, the temporary file is renamed into place so
+        a partial manifest is never read.'''
+        if not self.manifest_file:
+            return
+
+        try:
+            if not os.path.exists(os.path.dirname(self.manifest_file)):
+                os.makedirs(os.path.dirname(self.manifest_file))
+
+            with open('%s.tmp' % self.manifest_file, 'wb') as f:
+                marshal.dump({'version': self.version, 'root': self.root, 'folders': self.folders}, f)  # NOQA
+            os.rename('%s.tmp' % self.manifest_file, self.manifest_file)
+        except Exception:
+            pass
+
+
+# Mirror manifest
+class MirrorManifest():
+    '''The packages in a mirror and their sizes. Packages are keyed by path
+    relative to the mirror, i.e. lp10_ms3_content_2016/<package>.pkg. The
+    manifest is saved as a plist next to the lp10_ms3_content_YYYY folders,
+    so it can be published on a pkg server along with the packages.'''
+    filename = 'appleLoops_manifest.plist'
+    version = 1
+
+    def __init__(self):
+        # Relative path mapped to a dictionary of DownloadSize and PackageID
+        self.packages = {}
+        self.feeds = []
+        # Feed mapped to the sha1 of the feed the mirror was synced with
+        self.digests = {}
+
+    def loads(self, data):
+        '''Reads a manifest from a string, returning False if it isn't a
+        manifest this version understands.'''
+        try:
+            manifest = plistlib.readPlistFromString(data)
+            if manifest['Version'] != self.version:
+                return False
+            self.packages = dict(manifest['Packages'])
+            self.feeds = list(manifest.get('Feeds', []))
+            self.digests = dict(manifest.get('FeedDigests', {}))
+            return True
+        except Exception:
+            return False
+
+    def load(self, path):
+        '''Reads a manifest file, returning False if it can't be read.'''
+        try:
+            with open(path, 'rb') as f:
+                return self.loads(f.read())
+        except (IOError, OSError):
+            return False
+
+    def scan(self, root):
+        '''Adds every package in the lp10_ms3_content_YYYY folders of a
+        mirror, with its size on disk.'''
+        for folder in sorted(glob(os.path.join(root, 'lp10_ms3_content_*'))):  # NOQA
+            for path in sorted(glob(os.path.join(folder, '*.pkg'))):
+                if os.path.isfile(path):
+                    self.add('%s/%s' % (os.path.basename(folder), os.path.basename(path)), os.path.getsize(path))  # NOQA
+
+    def add(self, path, size, pkg_id=None):
+        self.packages[path] = {'DownloadSize': size}
+        if pkg_id:
+            self.packages[path]['PackageID'] = pkg_id
+
+    def size(self, path):
+        '''Returns the size of a package in the manifest, or None.'''
+        try:
+            return self.packages[path]['DownloadSize']
+        except KeyError:
+            return None
+
+    def save(self, path):
+        '''Writes the manifest, the temporary file is renamed into place so a
+        server never publishes a partial manifest.'''
+        manifest = {
+            'Version': self.version,
+            'Generated': datetime.utcnow().replace(microsecond=0),
+            'Feeds': sorted(self.feeds),
+            'FeedDigests': self.digests,
+            'Packages': self.packages,
+        }
+        plistlib.writePlist(manifest, '%s.tmp' % path)
+        os.rename('%s.tmp' % path, path)
+
+
+# Store
+class ContentStore():
+    '''One copy of each unique package, kept in a .store folder in the
+    destination. Each copy is keyed by package name and size, with an
+    optional hash. Feed folders and mirrored paths are then filled in with
+    hard links into the store. If the store is on a filesystem without hard
+    link support, symbolic links are used instead.
+
+    The store is kept in the destination so hard links can be made into it,
+    but it is left out of the destination index and the DMG.'''
+    folder = '.store'
+
+    def __init__(self, root):
+        self.root = os.path.join(root, self.folder)
+        self.lock = threading.Lock()
+        self.stats = {'linked': 0, 'symlinked': 0, 'replaced': 0}
+
+    def path(self, name, size, digest=None):
+        '''Returns the store path for a package.'''
+        base, ext = os.path.splitext(name)
+        key = [base]
+        if size is not None:
+            key.append(str(size))
+        if digest:
+            key.append(digest)
+        return os.path.join(self.root, '%s%s' % ('-'.join(key), ext))
+
+    def linked(self, blob, destination):
+        '''Returns True if destination is already a link to blob.'''
+        try:
+            return os.path.samefile(blob, destination)
+        except OSError:
+            return False
+
+    def digest(self, path):
+        '''Returns the sha1 hash of a file.'''
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def duplicate(self, blob, destination):
+        '''Returns True if destination is a separate copy of blob, so it can be
+        replaced with a link to save space. A copy is the same package (the
+        blob is named after it), the same size, and has the same hash.'''
+        base = os.path.splitext(os.path.basename(destination))[0]
+        if not os.path.basename(blob).startswith('%s-' % base):
+            return False
+
+        try:
+            if self.linked(blob, destination) or os.path.getsize(blob) != os.path.getsize(destination):  # NOQA
+                return False
+            return self.digest(blob) == self.digest(destination)
+        except (IOError, OSError):
+            return False
+
+    def staging(self, destination):
+        '''Returns a folder in destination that mirrors it with hard links,
+        leaving out the store, to build a DMG from. The caller removes it
+        when finished with it.'''
+        staging = os.path.join(destination, '.dmg-%s' % os.getpid())
+        for folder, folders, files in os.walk(destination):
+            folders[:] = [name for name in folders if os.path.join(folder, name) not in [self.root, staging]]  # NOQA
+            target = os.path.normpath(os.path.join(staging, os.path.relpath(folder, destination)))  # NOQA
+            if not os.path.exists(target):
+                os.makedirs(target)
+
+            for name in files + [name for name in folders if os.path.islink(os.path.join(folder, name))]:  # NOQA
+                path = os.path.join(folder, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                else:
+                    os.link(path, os.path.join(target, name))
+
+        return staging
+
+    def hard_links(self):
+        '''Returns True if the filesystem the store is on supports hard
+        links, otherwise links into the store are symbolic links.'''
+        probe = os.path.join(self.root, '.probe-%s' % os.getpid())
+        try:
+            if not os.path.exists(self.root):
+                os.makedirs(self.root)
+            open(probe, 'w').close()
+            os.link(probe, '%s.link' % probe)
+            return True
+        except (IOError, OSError):
+            return False
+        finally:
+            for path in [probe, '%s.link' % probe]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def link(self, blob, destination):
+        '''Links destination to blob, replacing any existing copy. The link is
+        made next to the destination then renamed over it, so there is never
+        a moment where the destination is missing.'''
+        if not os.path.exists(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+
+        tmp = '%s.tmp' % destination
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+        try:
+            os.link(blob, tmp)
+            kind = 'linked'
+        except OSError:
+            os.symlink(os.path.relpath(blob, os.path.dirname(destination)), tmp)  # NOQA
+            kind = 'symlinked'
+
+        replaced = os.path.lexists(destination)
+        os.rename(tmp, destination)
+
+        with self.lock:
+            self.stats[kind] += 1
+            if replaced:
+                self.stats['replaced'] += 1
+
+
+# Receipts
+class ReceiptIndex():
+    '''Index of installed package receipts. Installed package IDs come from a
+    single `pkgutil --pkgs` call instead of forking pkgutil for every package,
+    and versions are looked up once per package. The index is cached on disk
+    and rebuilt when the receipts database changes. If pkgutil can't list the
+    receipts, each package is looked up on its own and nothing is cached.
+
+    Both the pkgutil binary and the receipts database path can be swapped out,
+    i.e. for a fake pkgutil and a folder of fixture receipts.'''
+    def __init__(self, pkgutil=None, receipts_db='/var/db/receipts', cache_file=None, profiler=None):  # NOQA
+        self.pkgutil = pkgutil or PKGUTIL
+        self.profiler = profiler or Profiler()
+        self.receipts_db = receipts_db
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+
+        # Package ID mapped to version, '' for versions not looked up yet
+        self.receipts = None
+        self.stamp = None
+        self.changed = False
+        # Whether receipts has every installed package
+        self.complete = False
+
+    def _stamp(self):
+        '''Returns the modification time of the receipts database. This
+        changes whenever a receipt is added or removed.'''
+        try:
+            return os.path.getmtime(self.receipts_db)
+        except OSError:
+            return None
+
+    def load(self):
+        '''Loads the index from the cache if it is still current, otherwise
+        builds it with one pkgutil call.'''
+        with self.lock:
+            if self.receipts is not None:
+                return
+
+            self.stamp = self._stamp()
+
+            if self.cache_file and self.stamp is not None:
+                try:
+                    cached = plistlib.readPlist(self.cache_file)
+                    if cached['stamp'] == self.stamp and cached['pkgutil'] == self.pkgutil:  # NOQA
+                        self.receipts = cached['receipts']
+                        self.complete = True
+                        return
+                except Exception:
+                    pass
+
+            cmd = [self.pkgutil, '--pkgs']
+            self.profiler.count(cmd)
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)  # NOQA
+            (result, error) = process.communicate()
+            if process.returncode != 0:
+                # An empty index would make every package look uninstalled
+                self.receipts = {}
+                return
+
+            self.receipts = dict((pkg_id.strip(), '') for pkg_id in result.splitlines() if pkg_id.strip())  # NOQA
+            self.complete = True
+            self.changed = True
+
+    def installed(self, pkg_id):
+        '''Returns True if there is a receipt for the package ID.'''
+        self.load()
+        if pkg_id not in self.receipts and not self.complete:
+            ver = self._pkg_info(pkg_id)
+            if ver is not None:
+                with self.lock:
+                    self.receipts[pkg_id] = ver
+        return pkg_id in self.receipts
+
+    def version(self, pkg_id):
+        '''Returns the installed version of a package, or 0.0.0 if it is not
+        installed or the version can't be found.'''
+        if not self.installed(pkg_id):
+            return '0.0.0'
+
+        if not self.receipts[pkg_id]:
+            ver = self._read_version(pkg_id)
+            with self.lock:
+                self.receipts[pkg_id] = ver
+                self.changed = True
+
+        return self.receipts[pkg_id]
+
+    def _read_version(self, pkg_id):
+        '''Reads the version from the receipt in the receipts database, and
+        falls back to asking pkgutil.'''
+        receipt = os.path.join(self.receipts_db, '%s.plist' % pkg_id)
+        for reader in [plistlib.readPlist, readPlist]:
+            try:
+                return str(reader(receipt)['PackageVersion'])
+            except Exception:
+                pass
+
+        # If the plist can't be read, the package is probably not installed.
+        return self._pkg_info(pkg_id) or '0.0.0'
+
+    def _pkg_info(self, pkg_id):
+        '''Returns the version pkgutil has for a package, or None if it isn't
+        installed.'''
+        cmd = [self.pkgutil, '--pkg-info-plist', pkg_id]
+        self.profiler.count(cmd)
+        (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+        try:
+            return str(plistlib.readPlistFromString(result)['pkg-version'])
+        except Exception:
+            return None
+
+    def save(self):
+        '''Writes the index to the cache file if anything changed. An index
+        that isn't complete is never written.'''
+        if not all([self.cache_file, self.changed, self.complete, self.stamp is not None]):  # NOQA
+            return
+
+        try:
+            if not os.path.exists(os.path.dirname(self.cache_file)):
+                os.makedirs(os.path.dirname(self.cache_file))
+            plistlib.writePlist({'stamp': self.stamp, 'pkgutil': self.pkgutil, 'receipts': self.receipts}, self.cache_file)  # NOQA
+            self.changed = False
+        except Exception:
+            pass
+
+
+# Events
+class EventStream():
+    '''Writes events as JSON lines, one object per line, to a file or to
+    stdout if the path is -. Every event has its type, the time, the host
+    and an ID shared by all events in the run. Events can be emitted from
+    several threads. Without a path, events are dropped.'''
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.run_id = uuid.uuid4().hex
+        self.host = socket.gethostname()
+        self.started = time.time()
+
+        if path == '-':
+            self.stream = sys.stdout
+        elif path:
+            self.stream = open(os.path.expanduser(os.path.expandvars(path)), 'a')  # NOQA
+        else:
+            self.stream = None
+
+    def emit(self, event, **fields):
+        '''Writes an event with the given fields. Writing never raises, a
+        broken event stream shouldn't stop loops being deployed.'''
+        if not self.stream:
+            return
+
+        record = {
+            'event': event,
+            'time': round(time.time(), 3),
+            'host': self.host,
+            'run': self.run_id,
+        }
+        record.update(fields)
+
+        try:
+            line = json.dumps(record, sort_keys=True)
+            with self.lock:
+                self.stream.write('%s\n' % line)
+                self.stream.flush()
+        except Exception:
+            pass
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def close(self):
+        if self.stream and self.stream is not sys.stdout:
+            self.stream.close()
+        self.stream = None
+
+
+# Metrics
+class PrometheusTextfile():
+    '''Metrics in the Prometheus text format, for node_exporter's textfile
+    collector. The file is written to a temporary file next to it, then
+    renamed into place, so the collector never reads a half written file.'''
+    def __init__(self, path, prefix='appleloops'):
+        self.path = path
+        self.prefix = prefix
+        # Metric name mapped to its help text and a list of samples
+        self.metrics = {}
+        self.order = []
+
+    def add(self, name, help_text, value, labels=None):
+        '''Adds a sample. All metrics are gauges, as each describes the last
+        run.'''
+        name = '%s_%s' % (self.prefix, name)
+        if name not in self.metrics:
+            self.metrics[name] = (help_text, [])
+            self.order.append(name)
+        self.metrics[name][1].append((labels or {}, value))
+
+    def render(self):
+        lines = []
+        for name in self.order:
+            help_text, samples = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                if labels:
+                    label_text = ','.join('%s="%s"' % (key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"')) for key in sorted(labels))  # NOQA
+                    lines.append('%s{%s} %s' % (name, label_text, value))
+                else:
+                    lines.append('%s %s' % (name, value))
+
+        return '%s\n' % '\n'.join(lines)
+
+    def write(self):
+        tmp_file = '%s.%s.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp_file, 0644)
+            os.rename(tmp_file, self.path)
+        except Exception:
+            # Don't leave temporary files behind for the collector to find
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+
+# Profiling
+class Profiler():
+    '''Times the phases of a run, and counts the commands run during it.
+    Commands are counted where they are run, by whatever runs them calling
+    count(). Phases can run on several threads at once, so the time for a
+    phase is the total across all threads and phases can add up to more than
+    the run took. If a profile file is given, cProfile also runs on the main
+    thread and its stats are written to the file when the profiler stops.'''
+    def __init__(self, enabled=False, profile_file=None):
+        self.enabled = enabled or bool(profile_file)
+        self.profile_file = profile_file
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stopped = None
+
+        # Phase mapped to [calls, seconds], and the order phases started in
+        self.phases = {}
+        self.order = []
+        # Command name mapped to the number of times it was run
+        self.commands = {}
+
+        self.cprofile = None
+
+    def start(self):
+        '''Starts cProfile if there is a profile file.'''
+        if self.profile_file and not self.cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stop(self):
+        '''Writes the cProfile stats if there are any.'''
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.profile_file)
+            self.cprofile = None
+
+        self.stopped = time.time()
+
+    @contextmanager
+    def span(self, phase):
+        '''Times the code run in a with block as part of a phase.'''
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                if phase not in self.phases:
+                    self.phases[phase] = [0, 0.0]
+                    self.order.append(phase)
+                self.phases[phase][0] += 1
+                self.phases[phase][1] += elapsed
+
+    def count(self, cmd):
+        '''Counts a command by name, cmd is the list of arguments it is run
+        with.'''
+        if not self.enabled:
+            return
+
+        with self.lock:
+            command = os.path.basename(cmd[0])
+            self.commands[command] = self.commands.get(command, 0) + 1
+
+    def elapsed(self):
+        return (self.stopped or time.time()) - self.started
+
+
 # AppleLoops
 class AppleLoops():
     '''
@@ -168,31 +1886,85 @@ class AppleLoops():
         apps_plist: A list, values should be a specific plist to process, i.e. garageband1020.plist  # NOQA
                    These plists are found in the apps Contents/Resources folder. A local copy is kept  # NOQA
                    in case the app can't reach the remote equivalent hosted by Apple.  # NOQA
-        caching_server: A URL string to the caching server on your network.
+        cache_path: A string, folder to keep cached data in between runs.
+                    Defaults to ~/Library/Caches/com.github.carlashley.appleLoops,  # NOQA
+                    or /Library/Caches/com.github.carlashley.appleLoops in deployment mode.  # NOQA
+        content_store: Boolean, keeps one copy of each package in destination/.store  # NOQA
+                       and links feed folders (or mirrored paths) to it.
+                       Default is False.
+        caching_server: A URL string, or list of URL strings, to the caching servers on your network.  # NOQA
                         Must be formatted: http://example.org:45698
+                        With several, downloads use the fastest one that is up and fail over to the others.  # NOQA
         destination: A string, path to save packages in, and create a DMG in (if specified).  # NOQA
                      For example: '/Users/jappleseed/Desktop/loops'
                      Use "" to escape paths with weird characters (like spaces).
                      If nothing is supplied, defaults to ~/Library/Logs
         dmg_filename: A string, filename to save the DMG as.
+        download_limits: A list of 'source=n' strings limiting concurrent downloads per  # NOQA
+                         source, where source is apple, pkg_server or cache_server.  # NOQA
+        downloads: Integer, number of packages to download at the same time.  # NOQA
+                   Default is 1.
         dry_run: Boolean, when true, does a dummy run without downloading anything.  # NOQA
                  Default is True.
+        events: A string, file to append a JSON lines stream of events to, or - for stdout.  # NOQA
+                There is an event for what is done with each package, each download and  # NOQA
+                install, and a summary at the end, see summary_event().
+                Default is None, no events.
+        http_pool_size: Integer, number of idle keep-alive connections kept per host.  # NOQA
+                        Default is 4.
+        http_timeout: Integer, seconds to wait on a HTTP connection before giving up.  # NOQA
+                      Default is 5.
+        limit_rate: A string, bytes per second for all downloads combined. A K, M or G suffix can be used.  # NOQA
+                    Downloads that fall back to curl are limited to an equal share each.  # NOQA
+                    Default is None, no limit.
         mandatory_loops: Boolean, processes all mandatory loops as specified by Apple.  # NOQA
                          Default is False.
+        offline: Boolean, only uses cached copies of the configuration and feeds.  # NOQA
+                 Default is False.
         optional_loops: Boolean, processes all optional loops as specified by Apple.  # NOQA
                         Default is False.
+        order: A string, the order packages are downloaded in. One of feed, mandatory (mandatory before optional),  # NOQA
+               content (Content group order in the feed), smallest (smallest first), or fair (each feed in turn).  # NOQA
+               Default is feed.
+        profile: Boolean, or a string path. Times each phase of the run and counts HTTP requests  # NOQA
+                 and commands run, see profile_report(). If a path is given, cProfile stats for  # NOQA
+                 the main thread are also written to it.
+                 Default is False.
+        prometheus_textfile: A string, .prom file to write metrics about the run to for the  # NOQA
+                             node_exporter textfile collector, see write_metrics().  # NOQA
+                             Default is None.
         quiet: Boolean, disables all stdout and stderr.
                Default is False. Replaces JSS mode in older versions.
+        segments: Integer, number of byte ranges large packages are downloaded in at the same time.  # NOQA
+                  Default is 1, which downloads with curl as normal.
+        sync: Boolean, mirrors every package from every configured feed, and prunes packages  # NOQA
+              no feed references. Implies mirror_paths, mandatory_loops and optional_loops.  # NOQA
+              Default is False.
+        workers: Integer, number of threads used to resolve package metadata.  # NOQA
+                 Default is 4.
+        verify_sizes: Boolean, checks package sizes with the server instead of trusting  # NOQA
+                      the DownloadSize value in the feed.
+                      Default is False.
 
     '''
     def __init__(self, allow_insecure=False, allow_untrusted=False,
-                 apps=None, apps_plist=None, caching_server=None,
+                 apps=None, apps_plist=None, cache_path=None,
+                 caching_server=None, content_store=False,
                  debug=False, deployment_mode=False, destination='/tmp',
-                 dmg_filename=None, dry_run=True, force_deploy=False,
+                 dmg_filename=None, download_limits=None, downloads=1,
+                 dry_run=True, events=None, force_deploy=False,
                  force_dmg=False, hard_link=False, help_init=False,
+                 http_pool_size=4, http_timeout=5, limit_rate=None,
                  log_path=False, mandatory_loops=False, mirror_paths=False,
-                 muted_download=False, optional_loops=False, pkg_server=False,
-                 quiet_mode=False, space_threshold=5):
+                 muted_download=False, offline=False, optional_loops=False,
+                 order='feed', pkg_server=False, profile=False,
+                 prometheus_textfile=None, quiet_mode=False, segments=1,
+                 space_threshold=5, sync=False, verify_sizes=False,
+                 workers=4):
+
+        # Messages go to stderr when events are streamed to stdout, so the
+        # stream is only JSON lines
+        self.output = sys.stderr if events == '-' else None
 
         # Logging
         if not help_init:
@@ -225,6 +1997,14 @@ class AppleLoops():
         # Dry run, yo.
         self.dry_run = dry_run
 
+        # Cached data that is kept between runs
+        if cache_path:
+            self.cache_path = os.path.expanduser(os.path.expandvars(cache_path))  # NOQA
+        elif deployment_mode:
+            self.cache_path = '/Library/Caches/com.github.carlashley.appleLoops'  # NOQA
+        else:
+            self.cache_path = os.path.expanduser('~/Library/Caches/com.github.carlashley.appleLoops')  # NOQA
+
         # Forces a re-download and install attempt even if loops are installed
         self.force_deploy = force_deploy
 
@@ -250,6 +2030,11 @@ class AppleLoops():
             'not_all_loops_installed': [17, 'Not all loops installed: ####'],  # NOQA
             'general_exception': [18, 'Exception: ####'],
             'remove_dmg': [19, 'Could not remove file ####'],
+            'download_limits_format': [20, 'Invalid download limit ####. Must be apple=n, pkg_server=n, or cache_server=n'],  # NOQA
+            'limit_rate_format': [21, 'Invalid rate ####. Must be bytes per second, optionally ending in K, M or G'],  # NOQA
+            'events_path': [22, 'Cannot write events to ####'],
+            'no_previous_feed': [23, 'No earlier feed is configured to compare #### with.'],  # NOQA
+            'unknown_app': [24, 'No app is configured for the feed ####.'],  # NOQA
         }
 
         # If deployment mode, and not a dry run, must be root to install loops.
@@ -271,25 +2056,74 @@ class AppleLoops():
         # Default is not to allow pkg installs with untrusted certs
         self.allow_untrusted = allow_untrusted
 
+        # Phase timings and command counts for --profile and the metrics.
+        # Started here so loading the configuration is included.
+        self.prometheus_textfile = prometheus_textfile
+        self.profiler = Profiler(enabled=any([profile, prometheus_textfile]) and not help_init, profile_file=profile if isinstance(profile, basestring) else None)  # NOQA
+        self.profiler.start()
+
+        # JSON lines event stream for --events
+        try:
+            self.events = EventStream(None if help_init else events)
+        except (IOError, OSError):
+            self.exit('events_path', custom_msg=events)
+        self.events.emit('start', version=__version__, deployment=self.deployment_mode, dry_run=self.dry_run)  # NOQA
+
         # Initialise requests
-        self.request = Requests(allow_insecure=self.allow_insecure)
+        self.request = Requests(allow_insecure=self.allow_insecure, pool_size=http_pool_size, timeout=http_timeout)  # NOQA
+
+        # Configuration and feeds are cached, and only re-downloaded if changed  # NOQA
+        # Help output only uses cached or bundled copies, so never waits on
+        # the network.
+        self.help_init = help_init
+        self.cache = HTTPCache(self.request, os.path.join(self.cache_path, 'http'), offline=(offline or help_init))  # NOQA
+
+        # Compiled feed indexes, to avoid re-parsing large feeds
+        self.feed_index = FeedIndex(os.path.join(self.cache_path, 'feeds'))
+        # Feed mapped to the sha1 of the copy read this run
+        self.feed_digests = {}
+
+        # Package index published by the pkg_server, fetched when first used
+        self.pkg_index = None
+        self.pkg_index_lock = threading.Lock()
+
+        # Download sources, ranked by health and speed when there are several
+        self.sources = None
 
         # Setup pkg_server
         if pkg_server:
-            # Don't need a trailing / in this address
-            if any([pkg_server.startswith('http://'), pkg_server.startswith('https://')]):  # NOQA
-                self.pkg_server = pkg_server.rstrip('/')
-            elif pkg_server == 'munki':
-                try:
-                    # This is the standard location for the munki client config  # NOQA
-                    self.pkg_server = readPlist('/Library/Preferences/ManagedInstalls.plist')['SoftwareRepoURL']  # NOQA
-                    self.printlog('Found munki ManagedInstalls.plist, using SoftwareRepoURL %s' % self.pkg_server)  # NOQA
-                except Exception as e:
-                    # If we can't find a munki server, fallback to using
-                    # Apple's servers.
-                    self.pkg_server = False
-                    self.printlog('Falling back to use Apple servers for package downloads.')  # NOQA
-                    self.log.debug('Exception: %s' % e)
+            if not isinstance(pkg_server, list):
+                pkg_server = [pkg_server]
+
+            pkg_servers = []
+            for server in pkg_server:
+                # Don't need a trailing / in this address
+                if any([server.startswith('http://'), server.startswith('https://')]):  # NOQA
+                    pkg_servers.append(server.rstrip('/'))
+                elif server == 'munki':
+                    try:
+                        # This is the standard location for the munki client config  # NOQA
+                        server = readPlist('/Library/Preferences/ManagedInstalls.plist')['SoftwareRepoURL']  # NOQA
+                        pkg_servers.append(server.rstrip('/'))
+                        self.printlog('Found munki ManagedInstalls.plist, using SoftwareRepoURL %s' % server)  # NOQA
+                    except Exception as e:
+                        self.log.debug('Exception: %s' % e)
+
+            # Use the best pkg_server that is up. If none are, fallback to
+            # using Apple's servers. A single pkg_server is used as given,
+            # like it always has been.
+            self.pkg_server = False
+            if pkg_servers:
+                self.sources = SourcePool(self.request, pkg_servers)
+                if help_init or len(pkg_servers) == 1:
+                    self.pkg_server = pkg_servers[0]
+                else:
+                    self.sources.check()
+                    self.pkg_server = self.sources.best() or False
+
+            if not self.pkg_server:
+                self.sources = None
+                self.printlog('Falling back to use Apple servers for package downloads.')  # NOQA
         else:
             # If nothing is provided
             self.pkg_server = False
@@ -301,58 +2135,12 @@ class AppleLoops():
         self.config_file_path = 'com.github.carlashley.appleLoops.configuration.plist'  # NOQA
         self.github_config_url = os.path.join(self.github_url, self.config_file_path)  # NOQA
 
-        # Set up an empy self.configuration to fill, and use in catch later.
-        self.configuration = ''
-
-        # If pkg_server is specified, we can try this URL, otherwise fallback
-        # to the github config url.
-        try:
-            # These try statements for the logging avoid exceptions when printing out the help text.  # NOQA
-            try:
-                self.log.debug('Trying specified package server {} for configuration'.format(self.pkg_server))  # NOQA
-            except Exception:
-                pass
-            if self.pkg_server and self.config_url_reachable(os.path.join(self.pkg_server, self.config_file_path)):  # NOQA
-                # Test if the pkg server path is reachable
-                self.config_url = os.path.join(self.pkg_server, self.config_file_path)  # NOQA
-                self.log.debug('Using %s for configuration url' % e)
-                config = self.request.read_data(self.config_url)
-                self.configuration = plistlib.readPlistFromString(config)  # NOQA
-            else:
-                try:
-                    self.log.debug('Trying github server for configuration')  # NOQA
-                except Exception:
-                    pass
-                # Fail to github and test if github is reachable
-                if self.config_url_reachable(self.github_config_url):
-                    self.config_url = self.github_config_url
-                    self.log.debug('Using %s for configuration url' % e)
-                    config = self.request.read_data(self.config_url)
-                    self.configuration = plistlib.readPlistFromString(config)  # NOQA
-        except Exception:
-            try:
-                try:
-                    self.log.debug('Trying for local configuration file')
-                except Exception:
-                    pass
-                # Fail to local copy
-                self.config_url = self.config_file_path
-                self.configuration = plistlib.readPlist(self.config_url)  # NOQA
-            except Exception as e:
-                if not help_init:
-                    self.log.debug('Exception: %s' % e)
+        with self.profiler.span('config'):
+            self.configuration = self.load_configuration()
 
         # This is a catch in case self.configuration is left empty.
         if not self.configuration:
-            try:
-                config = self.request.read_data(self.github_config_url)
-                self.configuration = plistlib.readPlistFromString(config)  # NOQA
-            except Exception as e:
-                self.exit('config_read', custom_msg=self.config_url)
-                try:
-                    self.log.debug('Exception: %s' % e)
-                except Exception:
-                    pass
+            self.exit('config_read', custom_msg=self.config_url)
 
         # Supported apps
         self.supported_apps = ['garageband', 'logicpro', 'mainstage']
@@ -361,7 +2149,7 @@ class AppleLoops():
         # If A pkg_server has been specified, and the test for falling
         # back to a self hosted config has worked, then use the self
         # hosted plists as fallback
-        self.base_url = 'https://audiocontentdownload.apple.com/lp10_ms3_content_'  # NOQA
+        self.base_url = '%s/lp10_ms3_content_' % APPLE_URL
 
         # Configure alt base url
         if self.pkg_server:
@@ -409,23 +2197,27 @@ class AppleLoops():
                 self.apps_plist = False
 
             if caching_server:
-                if caching_server.startswith('http://'):
-                    self.caching_server = caching_server.rstrip('/')
-                    # Test if the caching server provides a valid response
-                    # Set to false if it doesn't
-                    try:
-                        # The caching service should send back a HTTP bad request status code if it exists  # NOQA
-                        if self.request.response_code(self.caching_server) != 400:  # NOQA
-                            self.printlog('Caching server test failed, falling back to Apple servers.')  # NOQA
-                            self.caching_server = False
-                    except Exception:
-                        self.printlog('Caching server test failed, falling back to Apple servers.')  # NOQA
-                        self.caching_server = False
-                else:
+                if not isinstance(caching_server, list):
+                    caching_server = [caching_server]
+
+                if not all([server.startswith('http://') for server in caching_server]):  # NOQA
                     self.exit('cache_srv_format')
+
+                # Test which caching servers provide a valid response, and use
+                # the best one. Set to false if none do.
+                self.sources = SourcePool(self.request, [server.rstrip('/') for server in caching_server], caching=True)  # NOQA
+                self.sources.check()
+                self.caching_server = self.sources.best() or False
+                if not self.caching_server:
+                    self.sources = None
+                    self.printlog('Caching server test failed, falling back to Apple servers.')  # NOQA
             else:
                 self.caching_server = False
 
+            # Keep scoring the sources while the run goes on
+            if self.sources:
+                self.sources.start()
+
             if destination:
                 # Expand any vars/user paths
                 self.destination = os.path.expanduser(os.path.expandvars(destination))  # NOQA
@@ -441,24 +2233,76 @@ class AppleLoops():
             # Forces the creation of a DMG file if one already exists
             self.force_dmg = force_dmg
 
-            self.mandatory_loops = mandatory_loops
-            self.mirror_paths = mirror_paths
-            self.optional_loops = optional_loops
+            # Sync mode mirrors everything
+            self.sync_mode = sync
+            self.mandatory_loops = mandatory_loops or sync
+            self.mirror_paths = mirror_paths or sync
+            self.optional_loops = optional_loops or sync
             self.quiet_mode = quiet_mode
 
             self.user_agent = '%s/%s' % (self.configuration['user_agent'], __version__)  # NOQA
 
-            # Determines if file copy or hard link (to reduce disk usage)
+            # Packages are hard linked where possible. With --hard-link they
+            # are never copied instead.
             self.hard_link = hard_link
 
-            # Creating a list of files found in destination
-            self.files_found = []
-            for root, dirs, files in os.walk(self.destination, topdown=True):
-                for name in files:
-                    if name.endswith('.pkg'):
-                        _file = os.path.join(root, name)
-                        if _file not in self.files_found:
-                            self.files_found.append(_file)
+            # One copy of each package, with links to it for every feed.
+            # Not used in deployment mode as packages are deleted once
+            # installed.
+            if content_store and not self.deployment_mode:
+                self.content_store = ContentStore(self.destination)
+            else:
+                self.content_store = False
+
+            # Only ask the server for package sizes if the feed value is
+            # missing, or if explicitly asked to verify them.
+            self.verify_sizes = verify_sizes
+
+            # Number of threads used to resolve package metadata
+            self.workers = max(1, workers)
+
+            # Installed package receipts, built once and cached between runs
+            self.receipts = ReceiptIndex(cache_file=os.path.join(self.cache_path, 'receipts.plist'), profiler=self.profiler)  # NOQA
+
+            # Download scheduler, with optional per source limits
+            _download_limits = {}
+            for limit in (download_limits or []):
+                try:
+                    source, value = limit.split('=')
+                    if source not in ['apple', 'pkg_server', 'cache_server']:  # NOQA
+                        raise ValueError(source)
+                    _download_limits[source] = int(value)
+                except Exception:
+                    self.exit('download_limits_format', custom_msg=limit)
+
+            self.downloads = DownloadScheduler(workers=downloads, limits=_download_limits, profiler=self.profiler)  # NOQA
+
+            # Large packages can be split into ranges downloaded in parallel
+            self.segments = max(1, segments)
+
+            # Order packages are downloaded in
+            self.order = order
+
+            # Cap on the combined download rate, in bytes per second
+            self.limit_rate = None
+            if limit_rate:
+                try:
+                    multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}.get(str(limit_rate)[-1].upper(), 1)  # NOQA
+                    self.limit_rate = int(float(str(limit_rate).rstrip('kKmMgG')) * multiplier)  # NOQA
+                    if self.limit_rate <= 0:
+                        raise ValueError(limit_rate)
+                except Exception:
+                    self.exit('limit_rate_format', custom_msg=str(limit_rate))  # NOQA
+
+            # One bucket shared by every download, and every range of a
+            # download, so the limit holds however many are running
+            self.rate_limit = RateLimit(self.limit_rate) if self.limit_rate else None  # NOQA
+
+            # Index of packages found in destination, only folders changed
+            # since the last run are listed again
+            self.files_found = DestinationIndex(self.destination, manifest_file=os.path.join(self.cache_path, 'destinations', '%s.idx' % hashlib.sha1(os.path.abspath(self.destination)).hexdigest()), workers=self.workers)  # NOQA
+            self.files_found.scan()
+            self.log.debug('Destination index: %s packages, %s folders listed, %s unchanged' % (len(self.files_found), self.files_found.stats['listed'], self.files_found.stats['reused']))  # NOQA
 
             # Named tuple for loops
             self.Loop = namedtuple('Loop', ['pkg_name',
@@ -473,7 +2317,8 @@ class AppleLoops():
                                             'pkg_installed',
                                             'pkg_destination',
                                             'pkg_local_ver',
-                                            'pkg_remote_ver'])
+                                            'pkg_remote_ver',
+                                            'pkg_links'])
             # Dictionary for total download size and install sizes
             # This must be in bytes.
             # The threshold value is how much space to make sure is free.
@@ -485,14 +2330,18 @@ class AppleLoops():
 
             if space_threshold and type(space_threshold) is int:
                 self.space_threshold = space_threshold
-                self.size_info['reserved_space'] = self.percentage(self.space_threshold, self.space_available())  # NOQA
-                self.size_info['new_available_space'] = (self.space_available() - self.size_info['reserved_space'])  # NOQA
             else:
                 self.space_threshold = False
-                self.size_info['new_available_space'] = self.space_available()
 
-            if self.dry_run:
-                self.size_info['available_space'] = self.space_available()
+            # Free space is queried once, packages are installed on / in
+            # deployment mode, otherwise saved to the destination.
+            self.space = SpacePlanner(path='/' if self.deployment_mode else self.destination, threshold=self.space_threshold, profiler=self.profiler)  # NOQA
+            self.size_info['reserved_space'] = self.space.protected()
+            self.size_info['new_available_space'] = self.space.usable()
+            self.size_info['available_space'] = self.space.query()
+
+            # Packages turned down by the space plan
+            self.space_rejected = set()
 
         # Maintain a summary of actions taken in deployment mode
         self.deployment_summary = {
@@ -507,23 +2356,56 @@ class AppleLoops():
         error_msg = self.exit_codes[error][1]
 
         if custom_msg:
-            error_msg = error_msg.replace('####', custom_msg)
+            error_msg = error_msg.replace('####', '%s' % custom_msg)
 
-        print error_msg
+        self.echo(error_msg)
         self.log.info('sys.exit(%s) - %s' % (exit_code, error_msg))
         sys.exit(exit_code)
 
+    def echo(self, message):
+        '''Prints a message, to stderr if events are streamed to stdout.'''
+        print >> (self.output or sys.stdout), message
+
     def printlog(self, message):
-        print message
+        self.echo(message)
         self.log.info(message)
 
-    def config_url_reachable(self, configuration_url):
-        '''Returns True if the configuration file at github or self hosted
-        has HTTP status of 200, or False if anything else.'''
-        if configuration_url.startswith('http') and self.request.response_code(configuration_url) == 200:  # NOQA
-            return True
-        else:
-            return False
+    def load_configuration(self):
+        '''Returns the configuration from the package server if there is one,
+        otherwise from GitHub, or a local copy if neither can be reached.
+        Remote copies are fetched through the HTTP cache. The local copy is
+        looked for in the current directory, then next to this script.'''
+        config_urls = []
+        if self.pkg_server:
+            config_urls.append(os.path.join(self.pkg_server, self.config_file_path))  # NOQA
+        config_urls.append(self.github_config_url)
+
+        for config_url in config_urls:
+            if not self.help_init:
+                self.log.debug('Trying %s for configuration' % config_url)
+
+            status, config = self.cache.fetch(config_url)
+            if status == 200:
+                try:
+                    self.config_url = config_url
+                    return plistlib.readPlistFromString(config)
+                except Exception as e:
+                    if not self.help_init:
+                        self.log.debug('Exception: %s' % e)
+
+        # Fail to local copy
+        if not self.help_init:
+            self.log.debug('Trying for local configuration file')
+
+        for config_url in [self.config_file_path, os.path.join(os.path.dirname(os.path.abspath(__file__)), self.config_file_path)]:  # NOQA
+            self.config_url = config_url
+            try:
+                return plistlib.readPlist(self.config_url)
+            except Exception as e:
+                if not self.help_init:
+                    self.log.debug('Exception: %s' % e)
+
+        return ''
 
     def main_processor(self):
         # Some feedback to stdout for CLI use
@@ -555,12 +2437,13 @@ class AppleLoops():
         # deployment_mode should only be used by itself.
         if self.deployment_mode:
             if not any([self.apps, self.apps_plist]):
+                feeds = []
                 for app in self.supported_apps:
                     try:
                         # Test if the plist for the app can be found, if not log the app doesn't appear to be installed.  # NOQA
                         if len(glob(self.configuration['loop_feeds'][app]['app_path'])) > 0:  # NOQA
                             urls = self.plist_url(app)
-                            self.process_pkgs(self.get_feed(urls.apple, urls.fallback), os.path.basename(urls.apple))  # NOQA
+                            feeds.append(self.get_feed(urls.apple, urls.fallback))  # NOQA
                         else:
                             self.printlog('Skipping %s as it does not appear to be installed.' % app)  # NOQA
                             pass
@@ -570,8 +2453,13 @@ class AppleLoops():
                         self.log.debug(traceback.format_exc())
                         self.log.debug('Exception: %s' % e)
                         raise e
+
+                # Packages shared between apps are only installed once
+                self.process_feeds(feeds)
+                self.receipts.save()
+
                 if self.dry_run:
-                    print('-' * 15)  # NOQA
+                    self.echo('-' * 15)
                     # If the install size is 0, there's probably nothing to install  # NOQA
                     if self.deployment_summary['install_size'] == 0:
                         self.printlog('Nothing to install.')  # NOQA
@@ -588,11 +2476,11 @@ class AppleLoops():
                                 self.exit('freespace_threshold', custom_msg=self.convert_size(self.size_info['reserved_space']))  # NOQA
 
                         if not self.space_threshold:
-                            self.printlog('Free space: %s' % self.convert_size(self.space_available()))  # NOQA
-                            if self.size_info['install_total'] < self.space_available():  # NOQA
+                            self.printlog('Free space: %s' % self.convert_size(self.space.query()))  # NOQA
+                            if self.size_info['install_total'] < self.space.query():  # NOQA
                                 self.printlog('All loops will be installed, sufficient free space')  # NOQA
                             else:
-                                self.exit('nospace', custom_msg=self.convert_size(self.space_available()))  # NOQA
+                                self.exit('nospace', custom_msg=self.convert_size(self.space.query()))  # NOQA
                 if not self.dry_run:
                     summary_msg = 'Installed %s packages, downloaded %s, install size %s' % (self.deployment_summary['successful_installs'],  # NOQA
                                                                                              self.convert_size(self.deployment_summary['downloaded_amount']),  # NOQA
@@ -609,50 +2497,70 @@ class AppleLoops():
         if self.apps:
             # Check if .plist exists in self.apps
             if '.plist' in self.apps:
-                print self.apps
+                self.echo(self.apps)
                 self.apps = [x.replace('.plist', '') for x in self.apps]
-                print self.apps
+                self.echo(self.apps)
                 # print 'Please remove the .plist extension.'
                 # sys.exit(1)
 
             if not any([self.apps_plist, self.deployment_mode]):
+                feeds = []
                 for app in self.apps:
                     if any(app in x for x in self.supported_apps):  # NOQA
                         if 'garageband' in app:
                             for plist in self.garageband_loop_plists:
                                 apple_url = '%s%s/%s' % (self.base_url, self.garageband_loop_year, plist)  # NOQA
                                 fallback_url = '%s%s/%s' % (self.alt_base_url, self.garageband_loop_year, plist)  # NOQA
-                                self.process_pkgs(self.get_feed(apple_url, fallback_url), os.path.basename(apple_url))  # NOQA
+                                feeds.append(self.get_feed(apple_url, fallback_url))  # NOQA
 
                         if 'logicpro' in app:
                             for plist in self.logicpro_loop_plists:
                                 apple_url = '%s%s/%s' % (self.base_url, self.logicpro_loop_year, plist)  # NOQA
                                 fallback_url = '%s%s/%s' % (self.alt_base_url, self.logicpro_loop_year, plist)  # NOQA
-                                self.process_pkgs(self.get_feed(apple_url, fallback_url), os.path.basename(apple_url))  # NOQA
+                                feeds.append(self.get_feed(apple_url, fallback_url))  # NOQA
 
                         if 'mainstage' in app:
                             for plist in self.mainstage_loop_plists:
                                 apple_url = '%s%s/%s' % (self.base_url, self.mainstage_loop_year, plist)  # NOQA
                                 fallback_url = '%s%s/%s' % (self.alt_base_url, self.mainstage_loop_year, plist)  # NOQA
-                                self.process_pkgs(self.get_feed(apple_url, fallback_url), os.path.basename(apple_url))  # NOQA
+                                feeds.append(self.get_feed(apple_url, fallback_url))  # NOQA
+
+                # Packages shared between feeds are only downloaded once
+                self.process_feeds(feeds)
             else:
                 self.exit('plist_deployment_combo')
 
         if self.apps_plist:
             if not any([self.apps, self.deployment_mode]):
+                feeds = []
                 for plist in self.apps_plist:
                     # Strip numbers from plist name to get app name
                     app = ''.join(map(lambda c: '' if c in '0123456789' else c, plist.replace('.plist', '')))  # NOQA
                     app_year = self.configuration['loop_feeds'][app]['loop_year']  # NOQA
                     apple_url = '%s%s/%s' % (self.base_url, app_year, plist)
                     fallback_url = '%s%s/%s' % (self.alt_base_url, app_year, plist)  # NOQA
-                    self.process_pkgs(self.get_feed(apple_url, fallback_url), os.path.basename(apple_url))  # NOQA
+                    feeds.append(self.get_feed(apple_url, fallback_url))
+
+                # Packages shared between feeds are only downloaded once
+                self.process_feeds(feeds)
             else:
                 self.exit('apps_deployment_combo')
 
+        if self.downloads.stats['transfers'] and not self.quiet_mode:
+            self.printlog('Downloaded %s in %s packages, %.1f seconds (%s/s)' % (self.convert_size(self.downloads.stats['bytes']), self.downloads.stats['transfers'], self.downloads.stats['elapsed'], self.convert_size(self.downloads.throughput())))  # NOQA
+
         if self.dmg_filename:
             self.build_dmg(self.dmg_filename)
 
+        self.log.debug('Documents fetched: %s, not modified: %s, served from cache: %s' % (self.cache.stats['fetched'], self.cache.stats['not_modified'], self.cache.stats['served_from_cache']))  # NOQA
+        self.log.debug('HTTP requests: %s, connections opened: %s, connections re-used: %s' % (self.request.stats['requests'], self.request.stats['connections_opened'], self.request.stats['connections_reused']))  # NOQA
+
+        if self.sources:
+            for url in self.sources.ranked():
+                source = self.sources.sources[url]
+                self.log.debug('Source %s: healthy: %s, score: %s, downloads: %s, failures: %s' % (url, source['healthy'], self.sources.score(url), source['downloads'], source['failures']))  # NOQA
+        self.request.close()
+
     # Functions
     def plist_url(self, app):
         '''Returns a namedtuple with the Apple URL and a fallback URL. These URLs are the feed containing the pkg info.'''  # NOQA
@@ -682,296 +2590,922 @@ class AppleLoops():
 
     def get_feed(self, apple_url, fallback_url):
         '''Returns the feed as a dictionary from either the Apple URL or the fallback URL, pending result code.'''  # NOQA
-        # Initalise request, and check for 404's
-        apple_url_request = self.request.response_code(apple_url)
-        fallback_url_request = self.request.response_code(fallback_url)
-        if apple_url_request == 404:
-            # Use fallback URL
-            self.log.debug('Falling back to alternate feed: %s' % fallback_url)  # NOQA
-            if fallback_url_request == 200:
+        with self.profiler.span('get_feed'):
+            # Feeds come through the cache, and check for 404's
+            apple_url_request, apple_data = self.fetch_feed(apple_url)
+            if apple_url_request == 404:
+                # Use fallback URL
+                self.log.debug('Falling back to alternate feed: %s' % fallback_url)  # NOQA
+                fallback_url_request, fallback_data = self.fetch_feed(fallback_url)  # NOQA
+                if fallback_url_request == 200:
+                    req = {
+                        'app_feed_file': os.path.basename(fallback_url),
+                        'result': fallback_data
+                    }
+                    return req
+                else:
+                    self.log.info('There was a problem trying to reach %s' % fallback_url)  # NOQA
+                    return Exception('There was a problem trying to reach %s' % fallback_url)  # NOQA
+            elif apple_url_request == 200:
+                # Use Apple URL
                 req = {
-                    'app_feed_file': os.path.basename(fallback_url),
-                    'result': readPlistFromString(self.request.read_data(fallback_url))  # NOQA
+                    'app_feed_file': os.path.basename(apple_url),
+                    'result': apple_data
                 }
                 return req
             else:
-                self.log.info('There was a problem trying to reach %s' % fallback_url)  # NOQA
-                return Exception('There was a problem trying to reach %s' % fallback_url)  # NOQA
-        elif apple_url_request == 200:
-            # Use Apple URL
-            req = {
-                'app_feed_file': os.path.basename(apple_url),
-                'result': readPlistFromString(self.request.read_data(apple_url))  # NOQA
-            }
-            return req
+                self.log.info('There was a problem trying to reach %s' % apple_url)  # NOQA
+                return Exception('There was a problem trying to reach %s' % apple_url)  # NOQA
+
+    def feed_digest(self, feed_file):
+        '''Returns the sha1 hash of a local feed file.'''
+        digest = hashlib.sha1()
+        with open(feed_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def read_feed(self, feed, feed_file, force=False):
+        '''Returns the Packages and Content of a local feed file, from its
+        compiled index if there is one, otherwise by reading the feed and
+        compiling it. If force is True the feed is always recompiled.'''
+        digest = self.feed_digests[feed] = self.feed_digest(feed_file)
+        result = None if force else self.feed_index.load(feed, digest)
+        if result is None:
+            self.log.debug('No index for %s, reading feed' % feed)
+            with self.profiler.span('parse_feed'):
+                with open(feed_file, 'rb') as f:
+                    result = FeedReader(keys=['Packages', 'Content']).parse_file(f)  # NOQA
+                result = self.feed_index.compile(feed, digest, result)
+
+        return result
+
+    def fetch_feed(self, url):
+        '''Returns a tuple of the HTTP status and the Packages and Content of
+        the feed at url. A changed feed is read as it streams in from the
+        server, otherwise the cached copy (or its index) is used.'''
+        feed = os.path.basename(url)
+        digest = hashlib.sha1()
+        reader = FeedReader(keys=['Packages', 'Content'])
+        status, feed_file, streamed = self.cache.fetch_file(url, consumers=[digest.update, reader.feed])  # NOQA
+        if status != 200:
+            return (status, None)
+
+        if not streamed:
+            return (200, self.read_feed(feed, feed_file))
+
+        self.feed_digests[feed] = digest.hexdigest()
+        result = self.feed_index.load(feed, digest.hexdigest())
+        if result is None:
+            result = self.feed_index.compile(feed, digest.hexdigest(), reader.close())  # NOQA
+
+        return (200, result)
+
+    def feed_file(self, feed):
+        '''Returns the path to a local copy of a feed. Feeds can be paths to
+        local feed files, or feed names which are fetched through the cache.
+        Returns None if the feed can't be fetched.'''
+        if os.path.exists(feed):
+            return feed
+
+        if not feed.endswith('.plist'):
+            self.exit('end_in_plist')
+        app = ''.join(map(lambda c: '' if c in '0123456789' else c, os.path.basename(feed).replace('.plist', '')))  # NOQA
+        if app not in self.configuration['loop_feeds']:
+            self.exit('unknown_app', custom_msg=os.path.basename(feed))
+        app_year = self.configuration['loop_feeds'][app]['loop_year']  # NOQA
+        for url in ['%s%s/%s' % (self.base_url, app_year, os.path.basename(feed)), '%s%s/%s' % (self.alt_base_url, app_year, os.path.basename(feed))]:  # NOQA
+            status, feed_file, streamed = self.cache.fetch_file(url)  # NOQA
+            if status == 200:
+                return feed_file
+
+        return None
+
+    def compile_feeds(self, feeds):
+        '''Compiles feeds into indexes. Feeds can be paths to local feed
+        files, or feed names which are fetched. If no feeds are given, all
+        supported feeds are compiled.'''
+        for feed in (feeds or self.supported_plists):
+            feed_file = self.feed_file(feed)
+            if not feed_file:
+                self.printlog('Unable to fetch %s, skipping' % feed)
+                continue
+
+            result = self.read_feed(os.path.basename(feed), feed_file, force=True)  # NOQA
+            if not self.quiet_mode:
+                self.printlog('Compiled %s (%s packages): %s' % (os.path.basename(feed), len(result['Packages']), self.feed_index.path(os.path.basename(feed), self.feed_digest(feed_file))))  # NOQA
+
+    def feed_history(self):
+        '''Returns the configured feeds of each supported app, oldest first.'''  # NOQA
+        return [self.garageband_loop_plists, self.logicpro_loop_plists, self.mainstage_loop_plists]  # NOQA
+
+    def feed_packages(self, feed):
+        '''Returns the packages in a feed keyed by DownloadName, or None if
+        the feed can't be fetched.'''
+        feed_file = self.feed_file(feed)
+        if not feed_file:
+            return None
+
+        packages = self.read_feed(os.path.basename(feed), feed_file)['Packages']  # NOQA
+        return dict((packages[pkg]['DownloadName'], packages[pkg]) for pkg in packages)  # NOQA
+
+    def diff_packages(self, old, new):
+        '''Returns the differences between the packages of two feeds, as
+        returned by feed_packages(). A package with a new PackageVersion is
+        version_changed, one with the same version and a new DownloadSize is
+        size_changed. download_bytes is what a client with everything in the
+        old feed downloads to catch up with the new one, byte_delta is the
+        change in the download size of the whole feed.'''
+        def size(info):
+            try:
+                return int(info['DownloadSize'])
+            except Exception:
+                return 0
+
+        def version(info):
+            return str(info.get('PackageVersion', ''))
+
+        old_names = set(old)
+        new_names = set(new)
+        common = old_names & new_names
+        version_changed = set(name for name in common if version(old[name]) != version(new[name]))  # NOQA
+        size_changed = set(name for name in common - version_changed if size(old[name]) != size(new[name]))  # NOQA
+        added = new_names - old_names
+
+        return {
+            'added': sorted(added),
+            'removed': sorted(old_names - new_names),
+            'version_changed': sorted(version_changed),
+            'size_changed': sorted(size_changed),
+            'download_bytes': sum(size(new[name]) for name in added | version_changed | size_changed),  # NOQA
+            'byte_delta': sum(size(new[name]) for name in new) - sum(size(old[name]) for name in old),  # NOQA
+        }
+
+    def diff_feeds(self, feeds):
+        '''Prints the differences between feeds, see diff_packages(). Each
+        feed is compared with the one before it. A single feed is compared
+        with the configured feed before it for the same app. If no feeds are
+        given, the configured history of every supported app is compared.
+        Returns a list of the differences.'''
+        if not feeds:
+            runs = self.feed_history()
+        elif len(feeds) == 1:
+            history = [plists for plists in self.feed_history() if os.path.basename(feeds[0]) in plists]  # NOQA
+            if not history or history[0].index(os.path.basename(feeds[0])) == 0:  # NOQA
+                self.exit('no_previous_feed', custom_msg=os.path.basename(feeds[0]))  # NOQA
+            runs = [[history[0][history[0].index(os.path.basename(feeds[0])) - 1], feeds[0]]]  # NOQA
         else:
-            self.log.info('There was a problem trying to reach %s' % apple_url)  # NOQA
-            return Exception('There was a problem trying to reach %s' % apple_url)  # NOQA
+            runs = [feeds]
+
+        def signed_size(size):
+            return '%s%s' % ('-' if size < 0 else '+', self.convert_size(abs(size)))  # NOQA
+
+        def size(info):
+            try:
+                return self.convert_size(int(info['DownloadSize']))
+            except Exception:
+                return 'unknown size'
+
+        diffs = []
+        report = []
+        for run in runs:
+            previous = None
+            for feed in run:
+                packages = self.feed_packages(feed)
+                if packages is None:
+                    report.append('Unable to fetch %s, skipping' % feed)
+                    continue
+
+                if previous:
+                    old_feed, old = previous
+                    diff = self.diff_packages(old, packages)
+                    diff.update({'old': os.path.basename(old_feed), 'new': os.path.basename(feed)})  # NOQA
+                    diffs.append(diff)
+                    self.events.emit('feed_diff', **diff)
+
+                    report.append('%s -> %s' % (diff['old'], diff['new']))
+                    report.append('  Added: %s' % len(diff['added']))
+                    report.extend('    %s (%s)' % (name, size(packages[name])) for name in diff['added'])  # NOQA
+                    report.append('  Removed: %s' % len(diff['removed']))
+                    report.extend('    %s (%s)' % (name, size(old[name])) for name in diff['removed'])  # NOQA
+                    report.append('  Version changed: %s' % len(diff['version_changed']))  # NOQA
+                    report.extend('    %s %s -> %s (%s)' % (name, old[name].get('PackageVersion', '?'), packages[name].get('PackageVersion', '?'), size(packages[name])) for name in diff['version_changed'])  # NOQA
+                    report.append('  Size changed: %s' % len(diff['size_changed']))  # NOQA
+                    report.extend('    %s %s -> %s' % (name, size(old[name]), size(packages[name])) for name in diff['size_changed'])  # NOQA
+                    report.append('  Download: %s, total size: %s' % (self.convert_size(diff['download_bytes']), signed_size(diff['byte_delta'])))  # NOQA
+
+                previous = (feed, packages)
+
+        if len(diffs) > 1:
+            report.append('Total for %s comparisons: download %s, total size %s' % (len(diffs), self.convert_size(sum(diff['download_bytes'] for diff in diffs)), signed_size(sum(diff['byte_delta'] for diff in diffs))))  # NOQA
+
+        for line in report:
+            if self.quiet_mode:
+                self.log.info(line)
+            else:
+                self.printlog(line)
+
+        return diffs
 
     def process_pkgs(self, app_feed_dict, app_feed_filename):
-        # Specific part of the app_feed_dict to process
-        loops = []
-        packages = app_feed_dict['result']['Packages']
+        '''Processes the packages in a single feed.'''
+        self.process_feeds([app_feed_dict])
+
+    def wanted(self, pkg_name, reference):
+        '''Returns True if a feed's reference to a package is selected by the
+        mandatory/optional arguments.'''
+        # After GarageBand 10.3+ release, there's a bunch of loops that are downloaded but don't install due to not finding a qualifying package for mainstage and logicpro  # NOQA
+        garageband1021_failures = [
+            'JamPack1.pkg',
+            'JamPack4_Instruments.pkg',
+            'MAContent10_AppleLoopsLegacy1.pkg',
+            'MAContent10_AppleLoopsLegacyRemix.pkg',
+            'MAContent10_AppleLoopsLegacyRhythm.pkg',
+            'MAContent10_AppleLoopsLegacySymphony.pkg',
+            'MAContent10_AppleLoopsLegacyVoices.pkg',
+            'MAContent10_AppleLoopsLegacyWorld.pkg',
+            'MAContent10_GarageBand6Legacy.pkg',
+            'MAContent10_IRsSurround.pkg',
+            'MAContent10_Logic9Legacy.pkg',
+            'RemixTools_Instruments.pkg',
+            'RhythmSection_Instruments.pkg',
+            'Voices_Instruments.pkg',
+            'WorldMusic_Instruments.pkg',
+        ]
+        # Check to see if pkg_name is not one of the packages that gets downloaded for GarageBand 10.3+ that can't install because reasons.  # NOQA
+        if reference['feed'] in ['garageband1021.plist'] and os.path.basename(pkg_name) in garageband1021_failures:  # NOQA
+            return False
 
-        # Values to put in the Loop named tuple - lambda strips numbers from name  # NOQA
-        _pkg_loop_for = ''.join(map(lambda c: '' if c in '0123456789' else c, os.path.splitext(app_feed_dict['app_feed_file'])[0]))  # NOQA
-        _pkg_plist = app_feed_dict['app_feed_file']
+        if self.mandatory_loops and reference['mandatory']:
+            return True
 
-        _pkg_year = self.configuration['loop_feeds'][_pkg_loop_for]['loop_year']  # NOQA
+        if self.optional_loops and not reference['mandatory']:
+            return True
 
-        for pkg in packages:
-            _pkg_name = packages[pkg]['DownloadName']
-            _pkg_url = '%s%s/%s' % (self.base_url, _pkg_year, _pkg_name)
-            _pkg_destination_folder_year = _pkg_year
+        return False
+
+    def resolve_feeds(self, feeds):
+        '''Returns a Loop for each selected package in one or more feeds, in
+        download order. The feeds are merged into one catalog, so a package
+        in several feeds is resolved once, with links for the other feeds.'''
+        catalog = Catalog()
+        for app_feed_dict in feeds:
+            # get_feed() returns an exception if the feed couldn't be reached
+            if isinstance(app_feed_dict, Exception):
+                self.log.debug('Skipping feed: %s' % app_feed_dict)
+                continue
+            catalog.add_feed(app_feed_dict['app_feed_file'], app_feed_dict['result']['Packages'], app_feed_dict['result'].get('Content'))  # NOQA
+
+        # Only keep the references each package is selected for. The first
+        # reference is where the package is downloaded to, the rest are links.
+        selected = []
+        for name in catalog.names:
+            references = [ref for ref in catalog.packages[name] if self.wanted(name, ref)]  # NOQA
+            if references:
+                selected.append(references)
+
+        self.log.debug('Catalog has %s unique packages from %s feeds, %s selected' % (len(catalog.names), len(feeds), len(selected)))  # NOQA
+
+        # Resolve package metadata (sizes, mirror availability, receipts) on
+        # a pool of worker threads. Results come back in feed order.
+        loops = threaded_map(lambda refs: self.resolve_pkg(refs[0]['info'], refs[0]['feed'], links=[(ref['feed'], ref['mandatory']) for ref in refs[1:]], mandatory=any(ref['mandatory'] for ref in refs)), selected, workers=self.workers)  # NOQA
+
+        # Put the packages in download order
+        loops = order_loops(loops, self.order, ranks=[catalog.rank[refs[0]['info']['DownloadName']] for refs in selected])  # NOQA
+
+        for loop in loops:
+            self.log.debug(loop)
+
+        return loops
+
+    def sync(self):
+        '''Brings a mirror up to date with every configured feed. Packages
+        missing from the mirror are added, packages of the wrong size are
+        fetched again, and packages no feed references are pruned. Only the
+        difference is transferred. The mirror manifest is then rewritten.
+
+        The sync is a delta against the manifest of the last sync. A package
+        at the same path, with the same size, from a feed with the same sha1
+        as then is trusted without checking its size on disk. Everything
+        else is checked. Removing the manifest has every package checked.
+
+        If any feed can't be fetched, the packages only it references can't
+        be told apart from ones no feed references, so nothing is pruned and
+        the manifest isn't rewritten.'''
+        feeds = []
+        for plist in self.supported_plists:
+            # Strip numbers from plist name to get app name
+            app = ''.join(map(lambda c: '' if c in '0123456789' else c, plist.replace('.plist', '')))  # NOQA
+            app_year = self.configuration['loop_feeds'][app]['loop_year']
+            apple_url = '%s%s/%s' % (self.base_url, app_year, plist)
+            fallback_url = '%s%s/%s' % (self.alt_base_url, app_year, plist)
+            feeds.append(self.get_feed(apple_url, fallback_url))
+
+        with self.profiler.span('process_pkgs'):
+            loops = self.resolve_feeds(feeds)
+
+        failed = [feed for feed in feeds if isinstance(feed, Exception)]
+        if failed:
+            self.printlog('Not pruning, %s feeds could not be fetched: %s' % (len(failed), ', '.join(str(feed) for feed in failed)))  # NOQA
+
+        manifest_file = os.path.join(self.destination, MirrorManifest.filename)  # NOQA
+
+        # Mirrored path of each package, relative to the destination
+        wanted = {}
+        for loop in loops:
+            path = loop.pkg_links[0] if self.content_store else loop.pkg_destination  # NOQA
+            wanted[os.path.relpath(path, self.destination)] = loop
+
+        # Packages already in the mirror folders
+        on_disk = {}
+        for path in list(self.files_found.info):
+            relative = os.path.relpath(path, self.destination)
+            if relative.startswith('lp10_ms3_content_') and os.sep in relative:  # NOQA
+                on_disk[relative] = path
+
+        # Feeds that changed since the last sync
+        previous = MirrorManifest()
+        previous.load(manifest_file)
+        changed = set(feed for feed in self.feed_digests if previous.digests.get(feed) != self.feed_digests[feed])  # NOQA
+
+        # Sizes of wanted packages that changed since the last sync are
+        # checked on disk, the index only knows the size a file had when its
+        # folder last changed
+        add = []
+        refetch = []
+        sizes = {}
+        trusted = set()
+        for relative in sorted(wanted):
+            size = wanted[relative].pkg_size
+            if relative in on_disk and size is not None and previous.size(relative) == size and wanted[relative].pkg_plist not in changed:  # NOQA
+                sizes[relative] = size
+                trusted.add(relative)
+            elif relative in on_disk:
+                sizes[relative] = self.files_found.size(on_disk[relative])
+            if sizes.get(relative) is None:
+                add.append(relative)
+            elif size is not None and sizes[relative] != size:
+                refetch.append(relative)
+
+        # Stored packages no feed folder or mirrored path links to
+        if self.content_store and os.path.isdir(self.content_store.root):
+            stored = set(loop.pkg_destination for loop in loops)
+            for name in os.listdir(self.content_store.root):
+                path = os.path.join(self.content_store.root, name)
+                if name.endswith('.pkg') and path not in stored:
+                    on_disk[os.path.relpath(path, self.destination)] = path
+
+        prune = [] if failed else sorted(relative for relative in on_disk if relative not in wanted)  # NOQA
 
-            # Some package names start with ../lp10_ms3_content_2013/
-            if _pkg_name.startswith('../'):
-                # When setting the destination path for mirroring, need to have the correct year  # NOQA
-                if '2013' in _pkg_name and self.mirror_paths:
-                    _pkg_destination_folder_year = '2013'
+        if not self.quiet_mode:
+            self.printlog('Sync: %s to add, %s to re-fetch, %s to prune, %s unchanged (%s unchanged since the last sync)' % (len(add), len(refetch), len(prune), len(wanted) - len(add) - len(refetch), len(trusted)))  # NOQA
 
-                _pkg_url = 'https://audiocontentdownload.apple.com/%s' % _pkg_name[3:]  # NOQA
-                _pkg_name = os.path.basename(_pkg_name)
+        for relative in prune + refetch:
+            path = os.path.join(self.destination, relative)
+            if not self.quiet_mode:
+                if relative in prune:
+                    self.printlog('Prune: %s' % relative)
+                else:
+                    self.printlog('Re-fetch: %s (%s, expected %s)' % (relative, sizes[relative], wanted[relative].pkg_size))  # NOQA
 
-            # Reformat URL if caching server specified
-            if self.caching_server:
-                self.log.debug(_pkg_url)
-                _pkg_url = urlparse(_pkg_url)
-                _pkg_url = '%s%s?source=%s' % (self.caching_server, _pkg_url.path, _pkg_url.netloc)  # NOQA
-
-            # If pkg_server is true, and deployment_mode has a list, use that
-            # instead of Apple servers. Important note, the pkg_server must
-            # have the same `lp10_ms3_content_YYYY` folder structure. i.e.
-            # http://munki.example.org/munki_repo/lp10_ms3_content_2016/
-            # This can be achieved by using the `--mirror-paths` option when
-            # running appleLoops.py and then copying the resulting folders
-            # to the munki repo.
-            if self.pkg_server and self.deployment_mode:
-                if not self.caching_server:
-                    # Test each package path if pkg_server is provided, fallback if not reachable  # NOQA
-                    try:
-                        mirrored_url = _pkg_url.replace('https://audiocontentdownload.apple.com', self.pkg_server)  # NOQA
-                        if self.request.response_code(mirrored_url) == 200:  # NOQA
-                            _pkg_url = mirrored_url
-                        else:
-                            self.log.debug('Response code seeking %s is %s' % (mirrored_url, self.request.response_code(mirrored_url)))  # NOQA
-                    except Exception as e:
-                        self.log.debug('Exception: %s' % e)
+            if relative in prune:
+                self.events.emit('package', decision='prune', path=relative, dry_run=self.dry_run)  # NOQA
+
+            if not self.dry_run:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    self.log.debug('Exception: %s' % e)
+                self.files_found.remove(path)
+
+                # The mirrored path is a link to the stored copy, which is
+                # the wrong size too
+                if relative in refetch and self.content_store and os.path.exists(wanted[relative].pkg_destination):  # NOQA
+                    os.remove(wanted[relative].pkg_destination)
+
+        # Only the missing packages are transferred. A dry run leaves
+        # packages to re-fetch in place, they've been reported above.
+        transfer = [wanted[relative] for relative in add + refetch]
+        with self.profiler.span('plan_space'):
+            self.plan_space(transfer)
+        for loop in transfer:
+            if self.dry_run and os.path.exists(loop.pkg_destination):
+                continue
+            elif loop.pkg_name in self.space_rejected:
+                self.package_event(loop, 'insufficient_space')
+                self.printlog('Cannot download (insufficient space): %s' % loop.pkg_name)  # NOQA
+            else:
+                self.download(loop, scheduler=self.downloads)
+        self.downloads.run()
+
+        for loop in transfer:
+            self.fan_out(loop)
+
+        if not self.dry_run and not failed:
+            manifest = MirrorManifest()
+            manifest.feeds = [feed['app_feed_file'] for feed in feeds if not isinstance(feed, Exception)]  # NOQA
+            manifest.digests = dict((feed, self.feed_digests[feed]) for feed in manifest.feeds if feed in self.feed_digests)  # NOQA
+            for relative in wanted:
+                loop = wanted[relative]
+                if relative in trusted:
+                    manifest.add(relative, sizes[relative], loop.pkg_id)
+                    continue
+
+                try:
+                    size = os.path.getsize(os.path.join(self.destination, relative))  # NOQA
+                except OSError:
+                    continue
+                if loop.pkg_size is None or size == loop.pkg_size:
+                    manifest.add(relative, size, loop.pkg_id)
 
-            # Mandatory or optional
             try:
-                _pkg_mandatory = packages[pkg]['IsMandatory']
-            except Exception:
-                _pkg_mandatory = False
+                manifest.save(manifest_file)
+            except Exception as e:
+                self.log.debug('Exception: %s' % e)
+
+        self.files_found.save()
+
+    def process_feeds(self, feeds):
+        '''Processes the packages in one or more feeds. The feeds are merged
+        into one catalog, so each unique package is resolved and downloaded (or
+        installed) once. Any other feed folders that reference the package are
+        then filled in from that copy.'''
+        # Only care about mandatory or optional, because other arguments are taken care of elsewhere.  # NOQA
+        if not any([self.mandatory_loops, self.optional_loops]):
+            self.exit('loop_types')
+
+        with self.profiler.span('process_pkgs'):
+            loops = self.resolve_feeds(feeds)
+
+        # Internal method to check if download/download+install takes place
+        def download_or_install(loop_pkg):
+            '''Internal function to download/install depending on arguments'''  # NOQA
+            if self.deployment_mode:
+                if not loop_pkg.pkg_installed:
+                    if self.dry_run:
+                        self.download(loop_pkg)
+                        self.install_pkg(loop_pkg)
+                    else:
+                        # Installed as downloads finish, see deploy()
+                        self.download(loop_pkg, scheduler=self.downloads)  # NOQA
+                else:
+                    self.package_event(loop_pkg, 'installed')
+            else:
+                # Only download if this isn't a deployment run
+                if not self.deployment_mode:
+                    if loop_pkg.pkg_name in self.space_rejected:
+                        self.package_event(loop_pkg, 'insufficient_space')
+                        self.printlog('Cannot download (insufficient space): %s' % loop_pkg.pkg_name)  # NOQA
+                    else:
+                        self.download(loop_pkg, scheduler=self.downloads)
+
+        def update_pkg_sizes(loop):
+            # Only add download and install size info if
+            # the package is not installed or needs upgrading
+            if not loop.pkg_installed:
+                self.size_info['download_total'] = self.size_info['download_total'] + loop.pkg_size  # NOQA
+                self.size_info['install_total'] = self.size_info['install_total'] + loop.pkg_install_size  # NOQA
+
+        for _loop in loops:
+            update_pkg_sizes(_loop)
+
+        # Plan space for everything up front, so nothing is downloaded if it
+        # won't all fit
+        with self.profiler.span('plan_space'):
+            self.plan_space(loops)
+
+        for _loop in loops:
+            download_or_install(_loop)
+
+        # Queued downloads run concurrently
+        if self.deployment_mode and not self.dry_run:
+            self.deploy()
+        else:
+            self.downloads.run()
+
+        # Fill in the other feed folders that reference each package
+        for _loop in loops:
+            self.fan_out(_loop)
+
+        self.files_found.save()
+
+    def fan_out(self, pkg):
+        '''Hard links (or copies, see link_or_copy) a downloaded package into
+        the folders of any other feeds that reference it. With a content
+        store, every feed folder is linked to the stored copy, and existing
+        copies are replaced by links.'''
+        for destination in pkg.pkg_links:
+            if os.path.exists(destination):
+                if not (self.content_store and self.content_store.duplicate(pkg.pkg_destination, destination)):  # NOQA
+                    continue
+
+            if self.dry_run:
+                if not self.quiet_mode:
+                    if self.content_store:
+                        self.printlog('Link stored file: %s' % destination)  # NOQA
+                    else:
+                        self.printlog('Hard link existing file: %s' % destination)  # NOQA
+                continue
+
+            if not os.path.exists(pkg.pkg_destination):
+                self.log.debug('Cannot link %s, %s does not exist.' % (destination, pkg.pkg_destination))  # NOQA
+                continue
 
-            # Package size
             try:
-                # Use int type to avoid exception errors.
-                _pkg_size = int(self.request.get_headers(_pkg_url)['content-length'])  # NOQA
-            except Exception:
-                _pkg_size = None
+                if not os.path.exists(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination))
+                    self.log.debug('Created %s to store packages.' % os.path.dirname(destination))  # NOQA
+
+                if self.content_store:
+                    self.content_store.link(pkg.pkg_destination, destination)  # NOQA
+                    if not self.quiet_mode:
+                        self.printlog('Link stored file: %s' % destination)  # NOQA
+                else:
+                    self.link_or_copy(pkg.pkg_destination, destination)
+            except Exception as e:
+                self.log.debug('Exception: %s' % e)
+                self.exit('general_exception', custom_msg=e)
+
+    def link_or_copy(self, source, destination):
+        '''Hard links destination to source. Where that can't be done because
+        they are on different volumes, or the filesystem doesn't support hard
+        links, the file is copied instead, unless --hard-link or a content
+        store asks for links only.'''
+        try:
+            os.link(source, destination)
+            if not self.quiet_mode:
+                self.printlog('Hard link existing file: %s' % destination)
+        except OSError as e:
+            if self.hard_link or self.content_store or e.errno not in [errno.EXDEV, errno.EPERM]:  # NOQA
+                raise
+            shutil.copy2(source, destination)
+            if not self.quiet_mode:
+                self.printlog('Copied existing file: %s' % destination)
+
+    def deploy(self):
+        '''Downloads and installs the queued packages as a pipeline. Downloads
+        run ahead into a staging area bounded by free space, while packages
+        are installed one at a time as their downloads finish.'''
+        # Leave enough room for everything that is going to be installed
+        _staging_limit = self.space.available()
 
-            # Installed size in bytes
+        staging = StagingArea(max(0, _staging_limit))
+        finished = Queue.Queue()
+        errors = []
+
+        self.log.debug('Staging limit for downloads: %s' % self.convert_size(staging.limit))  # NOQA
+
+        def produce():
             try:
-                # Use int type to avoid exception errors.
-                _pkg_install_size = int(packages[pkg]['InstalledSize'])
-            except Exception:
-                _pkg_install_size = None
+                self.downloads.run(staging=staging, finished=finished)
+            except BaseException:
+                errors.append(sys.exc_info())
+            finally:
+                # Tells the installer there is nothing more to come
+                finished.put(None)
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+
+        while True:
+            pkg = finished.get()
+            if pkg is None:
+                break
 
-            # Some package ID's seem to have a '. ' in them which is a typo.
-            _pkg_id = packages[pkg]['PackageID'].replace('. ', '.')
+            try:
+                self.install_pkg(pkg)
+            finally:
+                # Packages without a qualifying app are left on disk
+                if os.path.exists(pkg.pkg_destination):
+                    staging.keep(pkg.pkg_size)
+                else:
+                    staging.release(pkg.pkg_size)
 
-            # If this is a deployment run, return if the package is
-            # already installed on the machine, pkg version, and pkg ID
-            # Apple doesn't include any package version information in
-            # the feed, so can't compare if updates are required.
-            if self.deployment_mode:
-                if not self.force_deploy:
-                    _pkg_installed = self.loop_installed(_pkg_id)
-                elif self.force_deploy:
-                    _pkg_installed = False
-            elif not self.deployment_mode:
-                _pkg_installed = False
+        producer.join()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def resolve_pkg(self, pkg_info, app_feed_file, links=None, mandatory=None):  # NOQA
+        '''Returns a Loop for a package in a feed. This is where any network
+        or receipt lookups for a package happen, and is safe to run from
+        multiple threads. Links is a list of (feed, mandatory) tuples for any
+        other feeds that reference the same package. Mandatory is whether the
+        package is mandatory in any of those feeds, if not given it is taken
+        from this feed.'''
+        # Values to put in the Loop named tuple - lambda strips numbers from name  # NOQA
+        _pkg_loop_for = ''.join(map(lambda c: '' if c in '0123456789' else c, os.path.splitext(app_feed_file)[0]))  # NOQA
+        _pkg_plist = app_feed_file
 
-            # If pkg installed, get version
-            # Local version is an awful version string to compare: 2.0.0.0.1.1447702152  # NOQA
-            if _pkg_installed:
-                _pkg_local_ver = self.local_version(_pkg_id)
-                _pkg_local_ver = '.'.join(str(_pkg_local_ver).split('.')[:3])
+        _pkg_year = self.configuration['loop_feeds'][_pkg_loop_for]['loop_year']  # NOQA
 
-                # Get the remote package version if it exists
+        _pkg_name = pkg_info['DownloadName']
+        _pkg_url = '%s%s/%s' % (self.base_url, _pkg_year, _pkg_name)
+        _pkg_destination_folder_year = _pkg_year
+
+        # Some package names start with ../lp10_ms3_content_2013/
+        if _pkg_name.startswith('../'):
+            # When setting the destination path for mirroring, need to have the correct year  # NOQA
+            if '2013' in _pkg_name and self.mirror_paths:
+                _pkg_destination_folder_year = '2013'
+
+            _pkg_url = '%s/%s' % (APPLE_URL, _pkg_name[3:])
+            _pkg_name = os.path.basename(_pkg_name)
+
+        # Reformat URL if caching server specified
+        if self.caching_server:
+            self.log.debug(_pkg_url)
+            _pkg_url = urlparse(_pkg_url)
+            _pkg_url = '%s%s?source=%s' % (self.caching_server, _pkg_url.path, _pkg_url.netloc)  # NOQA
+
+        # If pkg_server is true, and deployment_mode has a list, use that
+        # instead of Apple servers. Important note, the pkg_server must
+        # have the same `lp10_ms3_content_YYYY` folder structure. i.e.
+        # http://munki.example.org/munki_repo/lp10_ms3_content_2016/
+        # This can be achieved by using the `--mirror-paths` option when
+        # running appleLoops.py and then copying the resulting folders
+        # to the munki repo.
+        if self.pkg_server and self.deployment_mode:
+            if not self.caching_server:
+                # Use the package index the pkg_server publishes to decide
+                # whether it has the package, and that its copy is the size
+                # the feed says. If there isn't an index, test each package
+                # path instead. Fallback if not reachable.
                 try:
-                    # Apple uses long type, but need to make it a number then a string to compare with Loose/StrictVersion()  # NOQA
-                    _pkg_remote_ver = str(float(packages[pkg]['PackageVersion']))  # NOQA
-                except Exception:
-                    _pkg_remote_ver = '0.0.0'
-            else:
-                # Don't need to worry about pkg versions if not installed.
-                _pkg_local_ver = '0.0.0'
+                    mirrored_url = _pkg_url.replace(APPLE_URL, self.pkg_server)  # NOQA
+                    pkg_index = self.pkg_server_index()
+                    if pkg_index:
+                        indexed_size = pkg_index.size(mirrored_url[len(self.pkg_server):].lstrip('/'))  # NOQA
+                        if indexed_size is None:
+                            self.log.debug('%s not in pkg_server index' % mirrored_url)  # NOQA
+                        elif 'DownloadSize' in pkg_info and indexed_size != pkg_info['DownloadSize']:  # NOQA
+                            self.log.debug('%s is %s bytes in pkg_server index, expected %s' % (mirrored_url, indexed_size, pkg_info['DownloadSize']))  # NOQA
+                        else:
+                            _pkg_url = mirrored_url
+                    else:
+                        response_code = self.request.response_code(mirrored_url)  # NOQA
+                        if response_code == 200:
+                            _pkg_url = mirrored_url
+                        else:
+                            self.log.debug('Response code seeking %s is %s' % (mirrored_url, response_code))  # NOQA
+                except Exception as e:
+                    self.log.debug('Exception: %s' % e)
+
+        # Mandatory or optional. The package is saved to this feed's folder
+        # for it, but is mandatory if any other feed says it is.
+        try:
+            _pkg_feed_mandatory = pkg_info['IsMandatory']
+        except Exception:
+            _pkg_feed_mandatory = False
+        _pkg_mandatory = _pkg_feed_mandatory
+        if mandatory is not None:
+            _pkg_mandatory = mandatory
+
+        # Package size
+        _pkg_size = self.pkg_size(pkg_info, _pkg_url)
+
+        # Installed size in bytes
+        try:
+            # Use int type to avoid exception errors.
+            _pkg_install_size = int(pkg_info['InstalledSize'])
+        except Exception:
+            _pkg_install_size = None
+
+        # Some package ID's seem to have a '. ' in them which is a typo.
+        _pkg_id = pkg_info['PackageID'].replace('. ', '.')
+
+        # If this is a deployment run, return if the package is
+        # already installed on the machine, pkg version, and pkg ID
+        # Apple doesn't include any package version information in
+        # the feed, so can't compare if updates are required.
+        if self.deployment_mode:
+            if not self.force_deploy:
+                _pkg_installed = self.loop_installed(_pkg_id)
+            elif self.force_deploy:
+                _pkg_installed = False
+        elif not self.deployment_mode:
+            _pkg_installed = False
+
+        # If pkg installed, get version
+        # Local version is an awful version string to compare: 2.0.0.0.1.1447702152  # NOQA
+        if _pkg_installed:
+            _pkg_local_ver = self.local_version(_pkg_id)
+            _pkg_local_ver = '.'.join(str(_pkg_local_ver).split('.')[:3])
+
+            # Get the remote package version if it exists
+            try:
+                # Apple uses long type, but need to make it a number then a string to compare with Loose/StrictVersion()  # NOQA
+                _pkg_remote_ver = str(float(pkg_info['PackageVersion']))  # NOQA
+            except Exception:
                 _pkg_remote_ver = '0.0.0'
+        else:
+            # Don't need to worry about pkg versions if not installed.
+            _pkg_local_ver = '0.0.0'
+            _pkg_remote_ver = '0.0.0'
 
-            # Do a version check to handle any pkgs that are upgrades
-            # Need to try Loose/Strict as version could be either
+        # Do a version check to handle any pkgs that are upgrades
+        # Need to try Loose/Strict as version could be either
+        try:
+            if LooseVersion(_pkg_local_ver) < LooseVersion(_pkg_remote_ver):  # NOQA
+                self.log.info('%s needs upgrading (based on LooseVersion())' % _pkg_name)  # NOQA
+                _pkg_installed = False
+        except Exception:
             try:
-                if LooseVersion(_pkg_local_ver) < LooseVersion(_pkg_remote_ver):  # NOQA
-                    self.log.info('%s needs upgrading (based on LooseVersion())' % _pkg_name)  # NOQA
+                if StrictVersion(_pkg_local_ver) < StrictVersion(_pkg_remote_ver):  # NOQA
+                    self.log.info('%s needs upgrading (based on StrictVersion())' % _pkg_name)  # NOQA
                     _pkg_installed = False
             except Exception:
-                try:
-                    if StrictVersion(_pkg_local_ver) < StrictVersion(_pkg_remote_ver):  # NOQA
-                        self.log.info('%s needs upgrading (based on StrictVersion())' % _pkg_name)  # NOQA
-                        _pkg_installed = False
-                except Exception:
-                    # Presume pkg not installed if both version tests fail
-                    _pkg_installed = False
-                    _pkg_local_ver = '0.0.0'
-                    _pkg_remote_ver = '0.0.0'
-
-            if self.destination:
-                # The base folder will be the app name and version, i.e. garageband1020  # NOQA
-                _base_folder = os.path.splitext(app_feed_dict['app_feed_file'])[0]  # NOQA
-                if _pkg_mandatory:
-                    _pkg_destination = os.path.join(self.destination, _base_folder, 'mandatory', _pkg_name)  # NOQA
+                # Presume pkg not installed if both version tests fail
+                _pkg_installed = False
+                _pkg_local_ver = '0.0.0'
+                _pkg_remote_ver = '0.0.0'
+
+        _pkg_destination = self.pkg_destination(_pkg_name, app_feed_file, _pkg_feed_mandatory, _pkg_destination_folder_year)  # NOQA
+
+        # Other feeds referencing this package get a link to it, unless they
+        # share the same destination (i.e. mirrored paths)
+        _pkg_links = []
+        for _feed, _mandatory in (links or []):
+            _link = self.pkg_destination(_pkg_name, _feed, _mandatory, _pkg_destination_folder_year)  # NOQA
+            if _link != _pkg_destination and _link not in _pkg_links:
+                _pkg_links.append(_link)
+
+        # With a content store the package is downloaded to the store, and
+        # every feed folder becomes a link.
+        if self.content_store:
+            _pkg_links.insert(0, _pkg_destination)
+            _pkg_destination = self.content_store.path(_pkg_name, _pkg_size)
+
+        loop = self.Loop(
+            pkg_name=_pkg_name,
+            pkg_url=_pkg_url,
+            pkg_mandatory=_pkg_mandatory,
+            pkg_size=_pkg_size,
+            pkg_install_size=_pkg_install_size,
+            pkg_year=_pkg_year,
+            pkg_loop_for=_pkg_loop_for,
+            pkg_plist=_pkg_plist,
+            pkg_id=_pkg_id,
+            pkg_installed=_pkg_installed,
+            pkg_destination=_pkg_destination,
+            pkg_local_ver=_pkg_local_ver,
+            pkg_remote_ver=_pkg_remote_ver,
+            pkg_links=tuple(_pkg_links),
+        )
+
+        return loop
+
+    def pkg_server_index(self):
+        '''Returns the package index published by the pkg_server, fetched
+        once per run through the HTTP cache, or False if there isn't one. A
+        stale index is never used, if the pkg_server can't be reached its
+        packages can't be downloaded from it either.'''
+        with self.pkg_index_lock:
+            if self.pkg_index is None:
+                self.pkg_index = False
+                index_url = '%s/%s' % (self.pkg_server, MirrorManifest.filename)  # NOQA
+                status, data = self.cache.fetch(index_url, stale=False)
+                manifest = MirrorManifest()
+                if status == 200 and manifest.loads(data):
+                    self.pkg_index = manifest
+                    self.log.debug('Using pkg_server index %s (%s packages)' % (index_url, len(manifest.packages)))  # NOQA
                 else:
-                    _pkg_destination = os.path.join(self.destination, _base_folder, 'optional', _pkg_name)  # NOQA
+                    self.log.debug('No pkg_server index at %s (%s), testing each package' % (index_url, status))  # NOQA
 
-                # If the output is being mirrored
-                if self.mirror_paths:
-                    _pkg_destination = os.path.join(self.destination, 'lp10_ms3_content_%s' % _pkg_destination_folder_year, _pkg_name)  # NOQA
+            return self.pkg_index
 
-            if self.deployment_mode:
-                # To avoid any folders that we can't delete being created, in deployment_mode, destination is the `/tmp` folder  # NOQA
-                _pkg_destination = os.path.join('/tmp', _pkg_name)
-
-            loop = self.Loop(
-                pkg_name=_pkg_name,
-                pkg_url=_pkg_url,
-                pkg_mandatory=_pkg_mandatory,
-                pkg_size=_pkg_size,
-                pkg_install_size=_pkg_install_size,
-                pkg_year=_pkg_year,
-                pkg_loop_for=_pkg_loop_for,
-                pkg_plist=_pkg_plist,
-                pkg_id=_pkg_id,
-                pkg_installed=_pkg_installed,
-                pkg_destination=_pkg_destination,
-                pkg_local_ver=_pkg_local_ver,
-                pkg_remote_ver=_pkg_remote_ver,
-            )
+    def build_pkg_index(self, mirror):
+        '''Writes the package index for a mirror folder, to be published with
+        it on a pkg_server.'''
+        mirror = os.path.expanduser(os.path.expandvars(mirror))
+        manifest = MirrorManifest()
+        manifest.scan(mirror)
+        manifest.save(os.path.join(mirror, MirrorManifest.filename))
 
-            if loop not in loops:
-                # After GarageBand 10.3+ release, there's a bunch of loops that are downloaded but don't install due to not finding a qualifying package for mainstage and logicpro
-                garageband1021_failures = [
-                    'JamPack1.pkg',
-                    'JamPack4_Instruments.pkg',
-                    'MAContent10_AppleLoopsLegacy1.pkg',
-                    'MAContent10_AppleLoopsLegacyRemix.pkg',
-                    'MAContent10_AppleLoopsLegacyRhythm.pkg',
-                    'MAContent10_AppleLoopsLegacySymphony.pkg',
-                    'MAContent10_AppleLoopsLegacyVoices.pkg',
-                    'MAContent10_AppleLoopsLegacyWorld.pkg',
-                    'MAContent10_GarageBand6Legacy.pkg',
-                    'MAContent10_IRsSurround.pkg',
-                    'MAContent10_Logic9Legacy.pkg',
-                    'RemixTools_Instruments.pkg',
-                    'RhythmSection_Instruments.pkg',
-                    'Voices_Instruments.pkg',
-                    'WorldMusic_Instruments.pkg',
-                ]
-                # Appending to a list allows the free disk space/threshold checks to work
-                # Also includes check to see if _pkg_name is not one of the packages that gets downloaded for GarageBand 10.3+ that can't install because reasons.
-                if app_feed_filename in ['garageband1021.plist'] and _pkg_name in garageband1021_failures:
-                    pass
-                else:
-                    loops.append(loop)
-                    self.log.debug(loop)
+        if not self.quiet_mode:
+            self.printlog('Indexed %s packages: %s' % (len(manifest.packages), os.path.join(mirror, MirrorManifest.filename)))  # NOQA
+
+    def pkg_destination(self, pkg_name, app_feed_file, mandatory, folder_year):  # NOQA
+        '''Returns the path a package from a feed is saved to.'''
+        if self.destination:
+            # The base folder will be the app name and version, i.e. garageband1020  # NOQA
+            _base_folder = os.path.splitext(app_feed_file)[0]  # NOQA
+            if mandatory:
+                _pkg_destination = os.path.join(self.destination, _base_folder, 'mandatory', pkg_name)  # NOQA
+            else:
+                _pkg_destination = os.path.join(self.destination, _base_folder, 'optional', pkg_name)  # NOQA
 
-        # Internal method to check if download/download+install takes place
-        def download_or_install(loop_pkg):
-            '''Internal function to download/install depending on arguments'''  # NOQA
-            if self.space_threshold and not self.dry_run:
-                if self.size_info['install_total'] >= self.size_info['new_available_space']:  # NOQA
-                    self.exit('freespace_threshold')
+            # If the output is being mirrored
+            if self.mirror_paths:
+                _pkg_destination = os.path.join(self.destination, 'lp10_ms3_content_%s' % folder_year, pkg_name)  # NOQA
 
-            if self.deployment_mode:
-                if not loop_pkg.pkg_installed:
-                    # Check available space is sufficient to download and install  # NOQA
-                    if sum([loop_pkg.pkg_size, loop_pkg.pkg_install_size]) < self.space_available():  # NOQA
-                        self.download(loop_pkg)
-                        self.install_pkg(loop_pkg)
-                    else:
-                        self.exit('insufficient_freespace')
-            else:
-                # Only download if this isn't a deployment run
-                if not self.deployment_mode:
-                    self.download(loop_pkg)
+        if self.deployment_mode:
+            # To avoid any folders that we can't delete being created, in deployment_mode, destination is the `/tmp` folder  # NOQA
+            _pkg_destination = os.path.join(DEPLOYMENT_PATH, pkg_name)
 
-        def update_pkg_sizes(loop):
-            # Only add download and install size info if
-            # the package is not installed or needs upgrading
-            if not loop.pkg_installed:
-                self.size_info['download_total'] = self.size_info['download_total'] + loop.pkg_size  # NOQA
-                self.size_info['install_total'] = self.size_info['install_total'] + loop.pkg_install_size  # NOQA
+        return _pkg_destination
 
-        # To be able to check if a loop is within threshold/free disk space
-        # iterate over the loops
-        for _loop in loops:
-            # Only care about mandatory or optional, because other arguments are taken care of elsewhere.  # NOQA
-            if any([self.mandatory_loops, self.optional_loops]):
-                # If mandatory argument supplied and loop is mandatory
-                if self.mandatory_loops and _loop.pkg_mandatory:  # NOQA
-                    update_pkg_sizes(_loop)
-                    download_or_install(_loop)
-
-                # If optional argument supplied and loop is optional
-                if self.optional_loops and not _loop.pkg_mandatory:  # NOQA
-                    update_pkg_sizes(_loop)
-                    download_or_install(_loop)
-            else:
-                self.exit('loop_types')
+    def pkg_size(self, pkg_info, pkg_url):
+        '''Returns the download size of a package in bytes. The DownloadSize
+        in the feed is used unless it is missing or sizes are being verified,
+        in which case the server is asked with a HEAD request.'''
+        try:
+            # Use int type to avoid exception errors.
+            feed_size = int(pkg_info['DownloadSize'])
+        except Exception:
+            feed_size = None
 
-    def space_available(self):
-        cmd = ['/usr/sbin/diskutil', 'info', '-plist', '/']
-        (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
-        # Return an int
-        return int(plistlib.readPlistFromString(result)['FreeSpace'])
+        if feed_size is not None and not self.verify_sizes:
+            return feed_size
 
-    def loop_installed(self, pkg_id):
-        '''Returns if a package is installed'''
-        cmd = ['/usr/sbin/pkgutil', '--pkg-info-plist', pkg_id]
-        (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+        try:
+            with self.profiler.span('size_probe'):
+                remote_size = int(self.request.head(pkg_url)['content-length'])  # NOQA
+        except Exception:
+            return feed_size
+
+        if feed_size is not None and remote_size != feed_size:
+            self.log.info('Size mismatch for %s - feed: %s  server: %s' % (pkg_url, feed_size, remote_size))  # NOQA
 
-        if result:
-            # need to use plistlib as this doesn't cause issues with tests
-            _pkg_id = plistlib.readPlistFromString(result)['pkgid']
-            if pkg_id in _pkg_id:
-                return True
+        return remote_size
+
+    def space_needed(self, pkg):
+        '''Returns a tuple of the bytes a package needs to download, and to
+        install. Nothing is needed for packages already in the destination,
+        or ones that are linked rather than copied.'''
+        if self.deployment_mode:
+            if pkg.pkg_installed:
+                return (0, 0)
+            return (pkg.pkg_size or 0, pkg.pkg_install_size or 0)
+
+        download = 0
+        if not os.path.exists(pkg.pkg_destination):
+            if not self.files_found.find(pkg.pkg_name):
+                download = pkg.pkg_size or 0
+
+        # Copies already in the destination and other feed folders are hard
+        # linked, so take no more space
+        return (download, 0)
+
+    def plan_space(self, loops):
+        '''Reserves space for each package in download order. Anything that
+        doesn't fit is turned down, and unless this is a dry run, the run
+        stops before any downloads start.'''
+        for loop in loops:
+            download, install = self.space_needed(loop)
+            if not any([download, install]):
+                continue
+
+            if not self.space.reserve(download=download, install=install, transient=self.deployment_mode):  # NOQA
+                self.log.debug('Insufficient space for %s' % loop.pkg_name)
+                self.space_rejected.add(loop.pkg_name)
+
+        self.log.debug('Space plan: %s free, %s protected, %s reserved, %s packages turned down' % (self.space.query(), self.space.protected(), self.space.reserved, len(self.space_rejected)))  # NOQA
+
+        if self.space_rejected and not self.dry_run:
+            if self.space_threshold:
+                self.exit('freespace_threshold', custom_msg=self.convert_size(self.space.protected()))  # NOQA
             else:
-                return False
-        else:
-            return False
+                self.exit('insufficient_freespace')
+
+    def loop_installed(self, pkg_id):
+        '''Returns if a package is installed'''
+        with self.profiler.span('receipts'):
+            return self.receipts.installed(pkg_id)
 
     def local_version(self, pkg_id):
-        cmd = ['/usr/sbin/pkgutil', '--pkg-info-plist', pkg_id]
-        (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+        with self.profiler.span('receipts'):
+            return self.receipts.version(pkg_id)
 
-        if result:
-            try:
-                ver = plistlib.readPlistFromString(result)['pkg-version']
-            except Exception:
-                # If the plist can't be read, or throws an exception, the package is probably not installed.  # NOQA
-                ver = '0.0.0'
+    def pkg_source(self, pkg):
+        '''Returns which source a package is downloaded from.'''
+        return self.url_source(pkg.pkg_url)
 
-        if error:
-            # If there is an error, then the package is probably not installed.
-            # Unlikely to happen, because Apple seems to send stderr to stdout here.  # NOQA
-            ver = '0.0.0'
+    def url_source(self, url):
+        '''Returns which source (apple, pkg_server or cache_server) a url is
+        on.'''
+        if self.sources and self.sources.source_for(url):
+            if self.caching_server:
+                return 'cache_server'
+            else:
+                return 'pkg_server'
+        else:
+            return 'apple'
+
+    def downloaded(self, pkg):
+        '''Records a finished download.'''
+        # Update summary report
+        self.deployment_summary['downloaded_amount'] = self.deployment_summary['downloaded_amount'] + pkg.pkg_size  # NOQA
 
-        return ver
+        # Add this to self.files_found so we can test on the next go around  # NOQA
+        self.files_found.add(pkg.pkg_destination)
 
-    def download(self, pkg):
+    def download(self, pkg, scheduler=None):
+        '''Downloads a package with curl. If a scheduler is provided the
+        download is queued on it instead of run straight away.'''
         # The mighty power of curl. Using `-L -C - <url>` to resume the download if a file exists.  # NOQA
-        curl = ['/usr/bin/curl']
+        curl = [CURL]
         insecure = ['--insecure']
         silent = ['--silent']
         progress = ['--progress-bar']
@@ -982,7 +3516,14 @@ class AppleLoops():
         if self.allow_insecure:
             curl.extend(insecure)
 
-        if self.quiet_mode or self.muted_download:
+        # curl can't share the rate limit bucket, so a download that falls
+        # back to curl gets an equal share of the rate limit
+        if self.limit_rate:
+            curl.extend(['--limit-rate', str(max(1, self.limit_rate // (scheduler.workers if scheduler else 1)))])  # NOQA
+
+        # Progress bars from concurrent downloads, or downloads running
+        # alongside installs, would be unreadable
+        if self.quiet_mode or self.muted_download or (scheduler and (scheduler.workers > 1 or self.deployment_mode)):  # NOQA
             silent.extend(common_args)
             curl.extend(silent)
         else:
@@ -992,6 +3533,19 @@ class AppleLoops():
         # After extending the curl list, now make it the cmd to be used
         cmd = curl
 
+        # With several sources, each attempt swaps in the url of the next
+        # source to try, and fails on HTTP errors so the next can be tried
+        if self.sources:
+            def source_cmd(url):
+                cmd = list(curl)
+                cmd[cmd.index(pkg.pkg_url)] = url
+                cmd.append('--fail')
+                return cmd
+
+            cmd = lambda: self.failover_download(pkg, source_cmd)  # NOQA
+
+        queued = False
+
         # Handling duplicates
         if not os.path.exists(pkg.pkg_destination):
                 # Test if there is a duplicate. This also copies duplicates.
@@ -999,9 +3553,10 @@ class AppleLoops():
                 self.duplicate_file_exists(pkg)
             except Exception:  # Exception as e:
                 # Log if the pkg url has fallen back direct to Apple in circumstances  # NOQA
-                if (self.pkg_server and 'audiocontentdownload.apple.com' in pkg.pkg_url) or (self.caching_server and '?source=' not in pkg.pkg_url):  # NOQA
+                if (self.pkg_server and pkg.pkg_url.startswith(APPLE_URL)) or (self.caching_server and '?source=' not in pkg.pkg_url):  # NOQA
                     self.log.info('Falling back to Apple server for %s download' % pkg.pkg_name)  # NOQA
                 # Use the exception to kick the download process.
+                self.package_event(pkg, 'download')
                 if self.dry_run:
                     if not self.quiet_mode:
                         if not self.deployment_mode or not pkg.pkg_installed:
@@ -1011,9 +3566,7 @@ class AppleLoops():
                                 self.printlog('Download: %s' % download_log_msg)  # NOQA
 
                     # Add this to self.files_found so we can test on the next go around  # NOQA
-                    if self.files_found:
-                        if pkg.pkg_destination not in self.files_found:
-                            self.files_found.append(pkg.pkg_destination)
+                    self.files_found.add(pkg.pkg_destination)
                 else:
                     if not self.quiet_mode:
                         # Do some quick tests if pkg_server is specified
@@ -1022,27 +3575,255 @@ class AppleLoops():
                         else:
                             self.printlog('Downloading: %s' % download_log_msg)
 
-                    # For some reason this was indented into the above not self.quiet, it shouldn't be  # NOQA
-                    subprocess.check_call(cmd)
-
-                    # Update summary report
-                    self.deployment_summary['downloaded_amount'] = self.deployment_summary['downloaded_amount'] + pkg.pkg_size  # NOQA
+                    # Large packages are downloaded in ranges, falling back to curl.  # NOQA
+                    # With a rate limit every package is downloaded this way,
+                    # so they all share the one bucket.
+                    if pkg.pkg_size and (self.rate_limit or (self.segments > 1 and pkg.pkg_size >= SegmentedDownload.min_size)):  # NOQA
+                        fallback = cmd if callable(cmd) else cmd + ['--fail']  # NOQA
+                        cmd = lambda: self.segmented_download(pkg, fallback)  # NOQA
+
+                    # Time the transfer, wherever it ends up running
+                    def transfer(fetch=cmd):
+                        try:
+                            existing_size = os.path.getsize(pkg.pkg_destination)  # NOQA
+                        except OSError:
+                            existing_size = 0
+
+                        start = time.time()
+                        served = None
+                        try:
+                            with self.profiler.span('download'):
+                                if callable(fetch):
+                                    served = fetch()
+                                else:
+                                    self.profiler.count(fetch)
+                                    subprocess.check_call(fetch)
+                        except BaseException:
+                            self.download_event(pkg, start, existing_size, 'failed')  # NOQA
+                            raise
+                        self.download_event(pkg, start, existing_size, 'ok', served=served)  # NOQA
+                        return served
+                    cmd = transfer
 
-                    # Add this to self.files_found so we can test on the next go around  # NOQA
-                    if self.files_found:
-                        if pkg.pkg_destination not in self.files_found:
-                            self.files_found.append(pkg.pkg_destination)
+                    # For some reason this was indented into the above not self.quiet, it shouldn't be  # NOQA
+                    if scheduler:
+                        scheduler.add(self.pkg_source(pkg), cmd, pkg.pkg_destination, callback=lambda: self.downloaded(pkg), size=pkg.pkg_size, item=pkg)  # NOQA
+                        queued = True
+                    else:
+                        cmd()
+                        self.downloaded(pkg)
+            else:
+                self.package_event(pkg, 'duplicate')
 
         elif os.path.exists(pkg.pkg_destination):
+            self.package_event(pkg, 'exists')
             if not self.quiet_mode:
                 self.printlog('Skipping %s' % pkg.pkg_name)
 
-    def percentage(self, percentage, value):
-        '''Returns the calculated percentage of the provided value'''
-        if percentage < 100:
-            return (int(percentage) * int(value)) / 100
+        # A package already on disk (i.e. left over from an install that
+        # found no qualifying app, or a duplicate) isn't downloaded, but
+        # still goes down the pipeline to be installed
+        if scheduler and self.deployment_mode and not queued:
+            scheduler.add(self.pkg_source(pkg), None, pkg.pkg_destination, size=pkg.pkg_size, item=pkg)  # NOQA
+
+    def package_event(self, pkg, decision):
+        '''Records what is done with a package on the event stream.'''
+        self.events.emit('package', decision=decision, name=pkg.pkg_name, pkg_id=pkg.pkg_id, feed=pkg.pkg_plist, mandatory=pkg.pkg_mandatory, size=pkg.pkg_size, install_size=pkg.pkg_install_size, source=self.pkg_source(pkg), dry_run=self.dry_run)  # NOQA
+
+    def download_event(self, pkg, start, existing_size, result, served=None):  # NOQA
+        '''Records a finished (or failed) download on the event stream.
+        Only the bytes transferred now are counted, not any that were there
+        from an earlier partial download. served is the bytes downloaded
+        from each source, if known, and the source most came from is the
+        one recorded.'''
+        duration = time.time() - start
+        try:
+            transferred = os.path.getsize(pkg.pkg_destination) - existing_size
+        except OSError:
+            transferred = 0
+
+        source = max(served, key=served.get) if served else self.pkg_source(pkg)  # NOQA
+        self.events.emit('download', result=result, name=pkg.pkg_name, pkg_id=pkg.pkg_id, source=source, url=pkg.pkg_url, bytes=transferred, duration=round(duration, 3), throughput=int(transferred / duration) if duration > 0 else 0)  # NOQA
+
+    def summary_event(self, completed=True):
+        '''Records a summary of the run on the event stream, and closes it.
+        completed is False if the run stopped early.'''
+        self.events.emit('summary',
+                         completed=completed,
+                         duration=round(self.events.elapsed(), 3),
+                         deployment=self.deployment_mode,
+                         dry_run=self.dry_run,
+                         successful_installs=self.deployment_summary['successful_installs'],  # NOQA
+                         failed_installs=self.deployment_summary['failed_installs'],  # NOQA
+                         install_size=self.deployment_summary['install_size'],
+                         download_total=self.size_info['download_total'],
+                         install_total=self.size_info['install_total'],
+                         downloaded_bytes=self.downloads.stats['bytes'],
+                         downloads=self.downloads.stats['transfers'],
+                         download_seconds=round(self.downloads.stats['elapsed'], 3),  # NOQA
+                         throughput=self.downloads.throughput(),
+                         http_requests=self.request.stats['requests'],
+                         documents_fetched=self.cache.stats['fetched'],
+                         documents_not_modified=self.cache.stats['not_modified'],  # NOQA
+                         documents_from_cache=self.cache.stats['served_from_cache'])  # NOQA
+        self.events.close()
+
+    def apple_url(self, url):
+        '''Returns the Apple url for a caching server or pkg_server url.'''
+        if '?source=' in url:
+            path, host = url.split('?source=', 1)
+            return 'https://%s%s' % (host, urlparse(path).path)
+
+        source = self.sources.source_for(url) if self.sources else None
+        if source:
+            return url.replace(source, APPLE_URL, 1)
+
+        return url
+
+    def pkg_urls(self, pkg):
+        '''Returns the urls a package can be downloaded from, best first.
+        Packages from a caching server or pkg_server can come from any of the
+        other sources, and lastly straight from Apple.'''
+        urls = [pkg.pkg_url]
+        source = self.sources.source_for(pkg.pkg_url) if self.sources else None  # NOQA
+        if source:
+            urls = ['%s%s' % (url, pkg.pkg_url[len(source):]) for url in self.sources.ranked()]  # NOQA
+            urls.append(self.apple_url(pkg.pkg_url))
+
+        return urls
+
+    def failover_download(self, pkg, cmd):
+        '''Downloads a package from each of its urls in turn until one works.
+        cmd is called with a url and returns the curl command to download it
+        with. Each attempt is scored against the source it was made on.
+        Returns the bytes downloaded, keyed by the source that served them.'''
+        urls = self.pkg_urls(pkg)
+        for url in urls:
+            source = self.sources.source_for(url)
+            try:
+                existing_size = os.path.getsize(pkg.pkg_destination)
+            except OSError:
+                existing_size = 0
+
+            start = time.time()
+            try:
+                fetch = cmd(url)
+                self.profiler.count(fetch)
+                subprocess.check_call(fetch)
+            except subprocess.CalledProcessError as e:
+                if source:
+                    self.sources.record(source, time.time() - start, 0, ok=False)  # NOQA
+                if url == urls[-1]:
+                    raise
+                self.log.info('Download of %s from %s failed (%s), trying the next source' % (pkg.pkg_name, url, e))  # NOQA
+                continue
+
+            transferred = os.path.getsize(pkg.pkg_destination) - existing_size  # NOQA
+            if source:
+                self.sources.record(source, time.time() - start, transferred)  # NOQA
+            return {self.url_source(url): transferred}
+
+    def segmented_download(self, pkg, cmd):
+        '''Downloads a package in ranges over several connections, or one
+        range if it is smaller than SegmentedDownload.min_size, counting
+        against the rate limit if there is one. If that fails, the package
+        is downloaded with the curl command instead, and the .part file and
+        its state file are removed whether or not that works. Returns the
+        bytes downloaded, keyed by the source that served them, if known.'''
+        segments = self.segments if pkg.pkg_size >= SegmentedDownload.min_size else 1  # NOQA
+        download = SegmentedDownload(self.request, self.pkg_urls(pkg), pkg.pkg_destination, pkg.pkg_size, segments=segments, headers={'User-Agent': self.user_agent}, rate_limit=self.rate_limit)  # NOQA
+        try:
+            download.run()
+            served = {}
+            for url, count in download.served.items():
+                served[self.url_source(url)] = served.get(self.url_source(url), 0) + count  # NOQA
+            return served
+        except Exception as e:
+            self.log.info('Segmented download of %s failed, using curl: %s' % (pkg.pkg_name, e))  # NOQA
+            try:
+                if callable(cmd):
+                    return cmd()
+                else:
+                    self.profiler.count(cmd)
+                    subprocess.check_call(cmd)
+            finally:
+                for leftover in [download.part, download.state_file]:
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+
+    def write_metrics(self, completed=True):
+        '''Writes metrics about the run to the Prometheus textfile.
+        completed is False if the run stopped early.'''
+        try:
+            self.run_metrics(completed).write()
+        except Exception as e:
+            # Metrics going missing shouldn't fail a deployment
+            self.log.info('Unable to write metrics to %s: %s' % (self.prometheus_textfile, e))  # NOQA
+
+    def run_metrics(self, completed=True):
+        '''Returns metrics about the run: how long it and each phase took,
+        bytes downloaded from each source, packages installed or failed, how
+        often the HTTP cache was used, and how much free space is left.'''
+        metrics = PrometheusTextfile(self.prometheus_textfile)
+
+        if self.deployment_mode:
+            mode = 'deployment'
+        elif self.mirror_paths:
+            mode = 'mirror'
         else:
-            return (int(percentage) * 99 / 100)
+            mode = 'download'
+        run_labels = {'mode': mode, 'dry_run': str(self.dry_run).lower()}
+
+        metrics.add('run_completed', 'Whether the last run finished (1) or stopped early (0).', int(completed), run_labels)  # NOQA
+        metrics.add('run_timestamp_seconds', 'When the last run finished.', int(time.time()), run_labels)  # NOQA
+        metrics.add('run_duration_seconds', 'How long the last run took.', '%0.3f' % self.profiler.elapsed(), run_labels)  # NOQA
+        for phase in self.profiler.order:
+            calls, seconds = self.profiler.phases[phase]
+            metrics.add('phase_duration_seconds', 'Time spent in each phase of the last run, summed across threads.', '%0.3f' % seconds, {'phase': phase})  # NOQA
+            metrics.add('phase_calls', 'Number of times each phase of the last run ran.', calls, {'phase': phase})  # NOQA
+
+        for source in sorted(self.downloads.source_bytes):
+            metrics.add('downloaded_bytes', 'Bytes downloaded from each source in the last run.', self.downloads.source_bytes[source], {'source': source})  # NOQA
+        metrics.add('downloads', 'Packages downloaded in the last run.', self.downloads.stats['transfers'])  # NOQA
+        metrics.add('download_throughput_bytes', 'Average bytes per second downloaded in the last run.', self.downloads.throughput())  # NOQA
+        metrics.add('packages_installed', 'Packages installed in the last run.', self.deployment_summary['successful_installs'])  # NOQA
+        metrics.add('packages_failed', 'Packages that failed to install in the last run.', len(self.deployment_summary['failed_installs']))  # NOQA
+        metrics.add('planned_download_bytes', 'Download size of the packages selected in the last run.', self.size_info['download_total'])  # NOQA
+        metrics.add('planned_install_bytes', 'Install size of the packages selected in the last run.', self.size_info['install_total'])  # NOQA
+
+        documents = 0
+        for result in ['fetched', 'not_modified', 'served_from_cache']:
+            documents += self.cache.stats[result]
+            metrics.add('http_cache_documents', 'Configuration and feed documents in the last run, by how they were served.', self.cache.stats[result], {'result': result})  # NOQA
+        hits = self.cache.stats['not_modified'] + self.cache.stats['served_from_cache']  # NOQA
+        metrics.add('http_cache_hit_ratio', 'Share of documents in the last run that weren\'t downloaded again.', '%0.4f' % (float(hits) / documents if documents else 0))  # NOQA
+        metrics.add('http_requests', 'HTTP requests made in the last run.', self.request.stats['requests'])  # NOQA
+
+        metrics.add('free_space_bytes', 'Free space on the volume packages are saved to, or installed on.', self.space.query())  # NOQA
+        metrics.add('protected_space_bytes', 'Free space kept free by the threshold.', self.space.protected())  # NOQA
+        metrics.add('free_space_headroom_bytes', 'Free space left for more packages once everything planned in the last run is downloaded or installed.', self.space.available())  # NOQA
+
+        return metrics
+
+    def profile_report(self):
+        '''Stops the profiler, and prints the time spent in each phase with
+        the number of HTTP requests and commands run.'''
+        self.profiler.stop()
+        report = ['Profile: %0.3f seconds' % self.profiler.elapsed()]
+        for phase in self.profiler.order:
+            calls, seconds = self.profiler.phases[phase]
+            report.append('  %-14s %10.3f seconds  %6s calls' % (phase, seconds, calls))  # NOQA
+        report.append('  HTTP requests: %s, connections opened: %s, connections re-used: %s' % (self.request.stats['requests'], self.request.stats['connections_opened'], self.request.stats['connections_reused']))  # NOQA
+        report.append('  Documents fetched: %s, not modified: %s, served from cache: %s' % (self.cache.stats['fetched'], self.cache.stats['not_modified'], self.cache.stats['served_from_cache']))  # NOQA
+        report.append('  Commands run: %s' % (', '.join('%s: %s' % (command, count) for command, count in sorted(self.profiler.commands.items())) or 'none'))  # NOQA
+        if self.profiler.profile_file:
+            report.append('  cProfile stats written to %s' % self.profiler.profile_file)  # NOQA
+
+        for line in report:
+            if self.quiet_mode:
+                self.log.info(line)
+            else:
+                self.printlog(line)
 
     def convert_size(self, file_size, precision=2):
         '''Converts the package file size into a human readable number.'''
@@ -1063,53 +3844,47 @@ class AppleLoops():
         This uses exceptions to indicate an item needs to be downloaded.'''
         # Don't need to check if in deployment mode, all files downloaded anyway  # NOQA
         if not self.deployment_mode:
-            if len(self.files_found) > 0:
-                for source_file in self.files_found:
-                    if pkg.pkg_name in os.path.basename(source_file):  # NOQA
-                        if self.dry_run:
-                            if self.hard_link:
-                                self.printlog('Hard link existing file: %s' % pkg.pkg_name)  # NOQA
-                            else:
-                                self.printlog('Copy existing file: %s' % pkg.pkg_name)  # NOQA
-
-                        # If not a dry run, do the thing
-                        if not self.dry_run:
-                            if not os.path.exists(pkg.pkg_destination):
-                                # Make destination folder if it doesn't exist
-                                try:
-                                    if not os.path.exists(os.path.dirname(pkg.pkg_destination)):  # NOQA
-                                        os.makedirs(os.path.dirname(pkg.pkg_destination))  # NOQA
-                                        self.log.debug('Created %s to store packages.' % os.path.dirname(pkg.pkg_destination))  # NOQA
-                                except Exception as e:
-                                    self.log.debug('Exception: %s' % e)
-                                    self.exit('general_exception', custom_msg=e)  # NOQA
-
-                                # Try to hard link or copy the file
-                                if self.hard_link:
-                                    try:
-                                        # Create a hard link to save space
-                                        os.link(source_file, pkg.pkg_destination)  # NOQA
-                                        if not self.quiet_mode:
-                                            self.printlog('Hard link existing file: %s' % pkg.pkg_name)  # NOQA
-                                    except Exception as e:
-                                        self.exit('general_exception', custom_msg=e)  # NOQA
-                                else:
-                                    try:
-                                        shutil.copy2(source_file, pkg.pkg_destination)  # NOQA
-                                        if not self.quiet_mode:
-                                            self.printlog('Copied existing file: %s' % pkg.pkg_name)  # NOQA
-                                    except Exception as e:
-                                        self.exit('general_exception', custom_msg=e)  # NOQA
-                    # Be explicit about not matching any item in self.files_found here, otherwise excessive downloads  # NOQA
-                    elif not any(x.endswith(pkg.pkg_name) for x in self.files_found):  # NOQA
-                        # Raise exception if the file doesn't match any files discovered in self.found_files  # NOQA
-                        # Don't need to exit on this exception because this is a trigger for downloading  # NOQA
-                        self.log.debug('%s does not exist in found files.' % pkg.pkg_name)  # NOQA
-                        raise Exception('%s does not exist in found files.' % pkg.pkg_name)  # NOQA
+            source_file = self.files_found.find(pkg.pkg_name)
+
+            # Only a copy of the right size goes into a content store
+            if source_file and self.content_store and pkg.pkg_size is not None:  # NOQA
+                try:
+                    if os.path.getsize(source_file) != pkg.pkg_size:
+                        self.log.debug('Not storing %s, size does not match feed' % source_file)  # NOQA
+                        source_file = None
+                except OSError:
+                    source_file = None
+
+            if source_file:
+                if self.dry_run:
+                    self.printlog('Hard link existing file: %s' % pkg.pkg_name)  # NOQA
+
+                # If not a dry run, do the thing
+                if not self.dry_run:
+                    if not os.path.exists(pkg.pkg_destination):
+                        # Make destination folder if it doesn't exist
+                        try:
+                            if not os.path.exists(os.path.dirname(pkg.pkg_destination)):  # NOQA
+                                os.makedirs(os.path.dirname(pkg.pkg_destination))  # NOQA
+                                self.log.debug('Created %s to store packages.' % os.path.dirname(pkg.pkg_destination))  # NOQA
+                        except Exception as e:
+                            self.log.debug('Exception: %s' % e)
+                            self.exit('general_exception', custom_msg=e)  # NOQA
+
+                        # Hard link the file, or copy it where that can't be
+                        # done. Existing copies are always hard linked into a
+                        # content store.
+                        try:
+                            self.link_or_copy(source_file, pkg.pkg_destination)  # NOQA
+                        except Exception as e:
+                            self.exit('general_exception', custom_msg=e)
+
+                    self.files_found.add(pkg.pkg_destination)
             else:
+                # Raise exception if the file doesn't match any files discovered in self.files_found  # NOQA
+                # Don't need to exit on this exception because this is a trigger for downloading  # NOQA
                 error_msg = 'Loop %s not found in download path, assuming not downloaded.' % pkg.pkg_name  # NOQA
                 self.log.debug(error_msg)
-                # Don't need to exit on this exception because this is a trigger for downloading  # NOQA
                 raise Exception(error_msg)
         elif self.deployment_mode:
             # Still need to raise an exception to trigger a download
@@ -1133,7 +3908,7 @@ class AppleLoops():
                 self.deployment_summary['successful_installs'] = self.deployment_summary['successful_installs'] + 1  # NOQA
                 self.deployment_summary['install_size'] = self.deployment_summary['install_size'] + pkg.pkg_install_size  # NOQA
 
-            base_cmd = ['/usr/sbin/installer']
+            base_cmd = [INSTALLER]
             untrusted = ['-allowUntrusted']
             pkg_args = ['-pkg', pkg.pkg_destination, '-target', target]
 
@@ -1150,16 +3925,16 @@ class AppleLoops():
             cmd = base_cmd
 
             if self.dry_run:
-                if pkg.pkg_install_size < self.size_info['available_space']:
+                if pkg.pkg_name not in self.space_rejected:
+                    self.package_event(pkg, 'install')
                     if self.force_deploy:
                         self.printlog('  Force install: %s' % pkg.pkg_name)  # NOQA
                     else:
                         self.printlog('  Install: %s' % pkg.pkg_name)  # NOQA
                     # Update installs to do
                     self.deployment_summary['install_size'] = self.deployment_summary['install_size'] + pkg.pkg_install_size  # NOQA
-
-                    self.size_info['available_space'] = (self.size_info['available_space'] - pkg.pkg_install_size)  # NOQA
-                elif pkg.pkg_install_size > self.size_info['available_space']:
+                else:
+                    self.package_event(pkg, 'insufficient_space')
                     self.printlog('  Cannot install (insufficient space): %s' % pkg.pkg_name)  # NOQA
 
             if not self.dry_run:
@@ -1169,7 +3944,24 @@ class AppleLoops():
                 else:
                     self.printlog('  Installing: %s' % pkg.pkg_name)
 
-                (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+                start = time.time()
+                with self.profiler.span('install_pkg'):
+                    self.profiler.count(cmd)
+                    (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+                duration = time.time() - start
+
+                # What happened, for the event stream
+                if error or any(x in result.lower() for x in ['fail', 'failed']):  # NOQA
+                    outcome = 'failed'
+                elif 'successful' in result:
+                    outcome = 'installed'
+                elif 'upgrade' in result:
+                    outcome = 'upgraded'
+                elif 'qualifying copy' in result:
+                    outcome = 'no_qualifying_app'
+                else:
+                    outcome = 'failed'
+                self.events.emit('install', result=outcome, name=pkg.pkg_name, pkg_id=pkg.pkg_id, install_size=pkg.pkg_install_size, duration=round(duration, 3))  # NOQA
 
                 if 'successful' in result:
                     self.printlog('  Installed: %s' % pkg.pkg_name)
@@ -1209,28 +4001,48 @@ class AppleLoops():
 
     def build_dmg(self, dmg_filename):
         '''Builds a DMG. Default filename is appleLoops_YYYY-MM-DD.dmg.'''  # NOQA
-        cmd = ['/usr/bin/hdiutil', 'create', '-volname', 'appleLoops', '-srcfolder', self.destination, dmg_filename]  # NOQA
         if self.dry_run:
             if not self.quiet_mode:
-                print 'Build %s from %s' % (dmg_filename, self.destination)
+                self.echo('Build %s from %s' % (dmg_filename, self.destination))  # NOQA
         else:
             if not os.path.exists(dmg_filename):
                 if not self.quiet_mode:
                     self.printlog('Building %s' % dmg_filename)
 
-                subprocess.check_call(cmd)
+                with self.profiler.span('build_dmg'):
+                    self.create_dmg(dmg_filename)
             else:
                 if self.force_dmg:
                     try:
                         self.printlog('Removing DMG %s' % dmg_filename)
                         self.printlog('Building %s' % dmg_filename)
                         os.remove(dmg_filename)
-                        subprocess.check_call(cmd)
+                        with self.profiler.span('build_dmg'):
+                            self.create_dmg(dmg_filename)
                     except Exception:
                         self.exit('remove_dmg', custom_msg=dmg_filename)
                 else:
                     self.exit('dmg_file_exists', custom_msg=dmg_filename)
 
+    def create_dmg(self, dmg_filename):
+        '''Creates a DMG of the destination with hdiutil. Feed folders are
+        hard linked to a content store, so the DMG is made from a copy of the
+        destination made of hard links without the store, rather than pack
+        every package twice. Symbolic links into the store need it in the DMG
+        though.'''
+        source = self.destination
+        staging = None
+        if self.content_store and self.content_store.hard_links():
+            staging = source = self.content_store.staging(self.destination)
+
+        try:
+            cmd = [HDIUTIL, 'create', '-volname', 'appleLoops', '-srcfolder', source, dmg_filename]  # NOQA
+            self.profiler.count(cmd)
+            subprocess.check_call(cmd)
+        finally:
+            if staging:
+                shutil.rmtree(staging, ignore_errors=True)
+
 
 # Main!
 def main():
@@ -1310,13 +4122,43 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--cache-path',
+        type=str,
+        nargs=1,
+        dest='cache_path',
+        metavar='<folder>',
+        help='Folder to keep cached data in between runs.',
+        required=False
+    )
+
     server_exclusive_group.add_argument(
         '-c', '--cache-server',
         type=str,
-        nargs=1,
+        nargs='+',
         dest='cache_server',
         metavar='http://example.org:port',
-        help='Use cache server to download content through',
+        help='Use cache server to download content through. Several can be given to fail over between.',  # NOQA
+        required=False
+    )
+
+    modes_exclusive_group.add_argument(
+        '--compile-feeds',
+        type=str,
+        nargs='*',
+        dest='compile_feeds',
+        metavar='<feed>',
+        help='Compile feeds (files or names, default is all) into indexes in the cache path.',  # NOQA
+        required=False
+    )
+
+    modes_exclusive_group.add_argument(
+        '--diff-feeds',
+        type=str,
+        nargs='*',
+        dest='diff_feeds',
+        metavar='<feed>',
+        help='Compare feeds (files or names) with the feed before them: packages added, removed, with a new version or size, and the bytes to download. One feed is compared with the configured feed before it, default is the configured history of every app.',  # NOQA
         required=False
     )
 
@@ -1338,6 +4180,24 @@ def main():
         required=False
     )
 
+    modes_exclusive_group.add_argument(
+        '--sync',
+        action='store_true',
+        dest='sync',
+        help='Sync a mirror of every configured feed, pruning packages no feed uses, and write %s. Only packages that changed since the last sync are checked.' % MirrorManifest.filename,  # NOQA
+        required=False
+    )
+
+    modes_exclusive_group.add_argument(
+        '--build-pkg-index',
+        type=str,
+        nargs=1,
+        dest='build_pkg_index',
+        metavar='<mirror>',
+        help='Write %s for a mirror folder, to publish with it on a pkg server.' % MirrorManifest.filename,  # NOQA
+        required=False
+    )
+
     modes_exclusive_group.add_argument(
         '--deployment',
         action='store_true',
@@ -1346,6 +4206,16 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--events',
+        type=str,
+        nargs=1,
+        dest='events',
+        metavar='<file>',
+        help='Append a JSON lines event for each package, download and install, and a summary, to <file>. Use - for stdout, other output then goes to stderr.',  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '--force-deploy',
         action='store_true',
@@ -1366,7 +4236,45 @@ def main():
         '--hard-link',
         action='store_true',
         dest='hard_link',
-        help='Create hard links instead of copying files. Use this to save disk space.',  # NOQA
+        help='Never copy packages. Packages are hard linked wherever they are needed more than once, and copied where a hard link can\'t be made (i.e. across volumes). With this, a package that can\'t be hard linked is an error instead.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--content-store',
+        action='store_true',
+        dest='content_store',
+        help='Keep one copy of each package in destination/.store and link feed folders to it.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--http-pool-size',
+        type=int,
+        nargs=1,
+        dest='http_pool_size',
+        metavar='<connections>',
+        help='Idle keep-alive connections to keep open per server. Default is 4.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--http-timeout',
+        type=int,
+        nargs=1,
+        dest='http_timeout',
+        metavar='<seconds>',
+        help='Seconds to wait on a server before giving up. Default is 5.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--limit-rate',
+        type=str,
+        nargs=1,
+        dest='limit_rate',
+        metavar='<rate>',
+        help='Limit all downloads combined to <rate> bytes per second, i.e. 500K or 2M. Downloads that fall back to curl are limited to an equal share each.',  # NOQA
         required=False
     )
 
@@ -1380,6 +4288,26 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '-j', '--downloads',
+        type=int,
+        nargs=1,
+        dest='downloads',
+        metavar='<downloads>',
+        help='Number of packages to download at the same time. Default is 1.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--download-limits',
+        type=str,
+        nargs='+',
+        dest='download_limits',
+        metavar='<source=n>',
+        help='Limit concurrent downloads per source: apple=n, pkg_server=n, cache_server=n.',  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '-m', '--mandatory-only',
         action='store_true',
@@ -1412,6 +4340,14 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        dest='offline',
+        help='Only use cached copies of the configuration and feeds.',
+        required=False
+    )
+
     parser.add_argument(
         '-o', '--optional-only',
         action='store_true',
@@ -1423,10 +4359,10 @@ def main():
     server_exclusive_group.add_argument(
         '--pkg-server',
         type=str,
-        nargs=1,
+        nargs='+',
         dest='pkg_server',
         metavar='http://example.org/path_to/loops',
-        help='Specify http server where loops are stored in your local environment.',  # NOQA
+        help='Specify http server where loops are stored in your local environment. Several can be given to fail over between.',  # NOQA
         required=False
     )
 
@@ -1440,6 +4376,37 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--prometheus-textfile',
+        type=str,
+        nargs=1,
+        dest='prometheus_textfile',
+        metavar='<file>',
+        help='Write metrics about the run to <file> for the node_exporter textfile collector, which only reads files ending in .prom.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=str,
+        nargs='?',
+        const=True,
+        dest='profile',
+        metavar='<file>',
+        help='Print the time spent in each phase, with HTTP request and command counts. If <file> is given, cProfile stats are also written to it.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--segments',
+        type=int,
+        nargs=1,
+        dest='segments',
+        metavar='<n>',
+        help='Download packages over 100MB in <n> parts at the same time. Default is 1.',  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '-t', '--threshold',
         type=int,
@@ -1450,6 +4417,17 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--order',
+        type=str,
+        nargs=1,
+        dest='order',
+        choices=sorted(download_orders),
+        metavar='<order>',
+        help='Order packages are downloaded in: %s. Default is feed.' % ', '.join(sorted(download_orders)),  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '-q', '--quiet',
         action='store_true',
@@ -1458,6 +4436,24 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--verify-sizes',
+        action='store_true',
+        dest='verify_sizes',
+        help='Check package sizes with the server instead of trusting the feed.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        nargs=1,
+        dest='workers',
+        metavar='<threads>',
+        help='Threads used to resolve package sizes and install state. Default is 4.',  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '-v', '--version',
         action='store_true',
@@ -1493,13 +4489,28 @@ def main():
         else:
             _dmg_filename = None
 
+        if args.downloads:
+            _downloads = args.downloads[0]
+        else:
+            _downloads = 1
+
+        if args.download_limits:
+            _download_limits = args.download_limits
+        else:
+            _download_limits = None
+
         if args.force_dmg:
             _force_dmg = args.force_dmg
         else:
             _force_dmg = False
 
+        if args.cache_path:
+            _cache_path = args.cache_path[0]
+        else:
+            _cache_path = None
+
         if args.cache_server:  # NOQA
-            _cache_server = args.cache_server[0]
+            _cache_server = args.cache_server
         else:
             _cache_server = None
 
@@ -1523,11 +4534,26 @@ def main():
         else:
             _force_deploy = False
 
+        if args.http_pool_size:
+            _http_pool_size = args.http_pool_size[0]
+        else:
+            _http_pool_size = 4
+
+        if args.http_timeout:
+            _http_timeout = args.http_timeout[0]
+        else:
+            _http_timeout = 5
+
         if args.mandatory:
             _mandatory = True
         else:
             _mandatory = False
 
+        if args.limit_rate:
+            _limit_rate = args.limit_rate[0]
+        else:
+            _limit_rate = None
+
         if args.log_path:
             _log_path = args.log_path[0]
         else:
@@ -1548,16 +4574,36 @@ def main():
         else:
             _dry_run = False
 
+        if args.offline:
+            _offline = True
+        else:
+            _offline = False
+
         if args.optional:
             _optional = True
         else:
             _optional = False
 
+        if args.order:
+            _order = args.order[0]
+        else:
+            _order = 'feed'
+
         if args.pkg_server:  # NOQA
-            _pkg_server = args.pkg_server[0]
+            _pkg_server = args.pkg_server
         else:
             _pkg_server = False
 
+        if args.sync:
+            _sync = True
+        else:
+            _sync = False
+
+        if args.segments:
+            _segments = args.segments[0]
+        else:
+            _segments = 1
+
         if args.threshold:
             _space_threshold = args.threshold[0]
         else:
@@ -1582,17 +4628,78 @@ def main():
         else:
             _hard_link = False
 
+        if args.content_store:
+            _content_store = True
+        else:
+            _content_store = False
+
+        if args.verify_sizes:
+            _verify_sizes = True
+        else:
+            _verify_sizes = False
+
+        if args.workers:
+            _workers = args.workers[0]
+        else:
+            _workers = 4
+
+        if args.profile:
+            _profile = args.profile
+        else:
+            _profile = False
+
+        if args.events:
+            _events = args.events[0]
+        else:
+            _events = None
+
+        if args.prometheus_textfile:
+            _prometheus_textfile = args.prometheus_textfile[0]
+        else:
+            _prometheus_textfile = None
+
         al = AppleLoops(allow_insecure=_allow_insecure, allow_untrusted=_allow_untrusted, apps=_apps, apps_plist=_plists,  # NOQA
-                        caching_server=_cache_server, debug=_debug, deployment_mode=_deployment,  # NOQA
-                        destination=_destination, dmg_filename=_dmg_filename, dry_run=_dry_run,  # NOQA
+                        cache_path=_cache_path, caching_server=_cache_server, content_store=_content_store,  # NOQA
+                        debug=_debug, deployment_mode=_deployment,  # NOQA
+                        destination=_destination, dmg_filename=_dmg_filename,  # NOQA
+                        download_limits=_download_limits, downloads=_downloads, dry_run=_dry_run, events=_events,  # NOQA
                         force_deploy=_force_deploy, force_dmg=_force_dmg, hard_link=_hard_link, help_init=False,  # NOQA
-                        log_path=_log_path, mandatory_loops=_mandatory, mirror_paths=_mirror,  # NOQA
-                        muted_download=_muted_download, optional_loops=_optional, pkg_server=_pkg_server,  # NOQA
-                        quiet_mode=_quiet, space_threshold=_space_threshold)  # NOQA
-
-        al.main_processor()
+                        http_pool_size=_http_pool_size, http_timeout=_http_timeout,  # NOQA
+                        limit_rate=_limit_rate, log_path=_log_path, mandatory_loops=_mandatory, mirror_paths=_mirror,  # NOQA
+                        muted_download=_muted_download, offline=_offline, optional_loops=_optional, order=_order,  # NOQA
+                        pkg_server=_pkg_server, profile=_profile, prometheus_textfile=_prometheus_textfile,  # NOQA
+                        quiet_mode=_quiet, segments=_segments, space_threshold=_space_threshold, sync=_sync,  # NOQA
+                        verify_sizes=_verify_sizes, workers=_workers)
+        al.log.debug('Startup took %0.3f seconds' % (time.time() - started))  # NOQA
+
+        completed = False
+        try:
+            if args.compile_feeds is not None:
+                al.compile_feeds(args.compile_feeds)
+            elif args.diff_feeds is not None:
+                al.diff_feeds(args.diff_feeds)
+            elif args.sync:
+                al.sync()
+            elif args.build_pkg_index:
+                al.build_pkg_index(args.build_pkg_index[0])
+            else:
+                al.main_processor()
+            completed = True
+        except SystemExit as e:
+            # Some runs exit early with nothing left to do, which is still
+            # a finished run
+            completed = not e.code
+            raise
+        finally:
+            if al.sources:
+                al.sources.stop()
+            if _profile:
+                al.profile_report()
+            if _events:
+                al.summary_event(completed=completed)
+            if _prometheus_textfile:
+                al.write_metrics(completed=completed)
     else:
-        al = AppleLoops(help_init=True)
         parser.print_help()
         sys.exit(0)
 
@@ -0,0 +1,404 @@
+#!/usr/bin/python
+'''End to end benchmarks for appleLoops.py.
+
+Runs AppleLoops.main_processor() against a local HTTP server standing in for
+Apple's servers and a pkg_server. The server serves the configuration and the
+feeds bundled in lp10_ms3_content_2016, and a synthetic package of a fixed
+size for any .pkg requested. pkgutil, installer, diskutil and hdiutil are
+replaced with fake shims, so the benchmarks also run on Linux.
+
+Each scenario is timed, and the HTTP requests, subprocesses and bytes
+transferred are counted. Results are written as JSON.'''
+import argparse
+import json
+import os
+import platform
+import plistlib
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from BaseHTTPServer import HTTPServer
+from datetime import datetime
+from distutils.spawn import find_executable
+from glob import glob
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+# appleLoops.py lives in the folder above this one
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+
+import appleLoops  # NOQA
+
+config_file = 'com.github.carlashley.appleLoops.configuration.plist'
+feed_folder = 'lp10_ms3_content_2016'
+
+# Fake tools. Each logs its name to the counts file before doing anything.
+shims = {
+    'pkgutil': '''# Nothing is installed
+[ "$1" = "--pkgs" ] && exit 0
+exit 1
+''',
+    'installer': '''echo "installer: The install was successful."
+''',
+    'diskutil': '''cat <<EOF
+<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+	<key>FreeSpace</key>
+	<integer>10995116277760</integer>
+</dict>
+</plist>
+EOF
+''',
+    'hdiutil': '''# The DMG filename is the last argument
+for last in "$@"; do :; done
+touch "$last"
+''',
+}
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def process_request(self, request, client_address):
+        # Keep track of the threads handling requests, so close() can wait
+        # for them to finish
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))  # NOQA
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on packages they don't need all of
+        pass
+
+
+class Handler(SimpleHTTPRequestHandler):
+    '''Serves files from the fixture folder, and a synthetic package of
+    server.pkg_size bytes for any .pkg path. Range requests are honoured
+    for packages. Folders are only listed if server.listing is set, a munki
+    repo for example answers 404 instead. If server.caching is set, requests
+    without a ?source= answer 400, as they do from a caching server.'''
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't hold either back
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self, key):
+        with self.server.lock:
+            self.server.counts[key] = self.server.counts.get(key, 0) + 1
+
+    def translate_path(self, path):
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        return os.path.join(self.server.root, *[part for part in path.split('/') if part and part != '..'])  # NOQA
+
+    def list_directory(self, path):
+        if not self.server.listing:
+            self.send_error(404)
+            return None
+        return SimpleHTTPRequestHandler.list_directory(self, path)
+
+    def send_pkg(self, head=False):
+        size = self.server.pkg_size
+        start, end = 0, size - 1
+        byte_range = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))  # NOQA
+        if byte_range and byte_range.group(1):
+            start = int(byte_range.group(1))
+            if byte_range.group(2):
+                end = min(int(byte_range.group(2)), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))  # NOQA
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if not head:
+            with self.server.lock:
+                self.server.counts['pkg_bytes'] = self.server.counts.get('pkg_bytes', 0) + end - start + 1  # NOQA
+            offset = start
+            while offset <= end:
+                chunk = self.server.payload[offset:min(end + 1, offset + 65536)]  # NOQA
+                self.wfile.write(chunk)
+                offset += len(chunk)
+
+    def not_cached(self):
+        '''Answers 400 for a request a caching server would turn down.'''
+        if self.server.caching and '?source=' not in self.path:
+            self.send_error(400)
+            return True
+        return False
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.not_cached():
+            return
+        if self.path.split('?', 1)[0].endswith('.pkg'):
+            self.count('pkg_get')
+            self.send_pkg()
+        else:
+            self.count('get')
+            # Unchanged files get a 304, like they do from Apple
+            path = self.translate_path(self.path)
+            modified = self.headers.get('If-Modified-Since')
+            if modified and os.path.isfile(path) and modified == self.date_time_string(os.path.getmtime(path)):  # NOQA
+                self.count('not_modified')
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                SimpleHTTPRequestHandler.do_GET(self)
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        self.count('head')
+        if self.not_cached():
+            return
+        if self.path.split('?', 1)[0].endswith('.pkg'):
+            self.send_pkg(head=True)
+        else:
+            SimpleHTTPRequestHandler.do_HEAD(self)
+
+
+class Fixture():
+    '''A scratch folder holding the files the server serves, fake apps, fake
+    tools, and a folder per benchmark run.'''
+    def __init__(self, pkg_size, latency, keep=False):
+        self.path = tempfile.mkdtemp(prefix='appleLoops_benchmark_')
+        self.keep = keep
+        self.root = os.path.join(self.path, 'www')
+        self.apps = os.path.join(self.path, 'Applications')
+        self.bin = os.path.join(self.path, 'bin')
+        self.counts_file = os.path.join(self.path, 'subprocesses.log')
+        self.feeds = sorted(os.path.basename(feed) for feed in glob(os.path.join(repo_path, feed_folder, '*.plist')))  # NOQA
+
+        for folder in [self.root, self.apps, self.bin, os.path.join(self.path, 'tmp')]:  # NOQA
+            os.makedirs(folder)
+
+        os.symlink(os.path.join(repo_path, feed_folder), os.path.join(self.root, feed_folder))  # NOQA
+
+        # App paths point at fake apps, each with the newest bundled feed
+        configuration = plistlib.readPlist(os.path.join(repo_path, config_file))  # NOQA
+        for app, feed_config in configuration['loop_feeds'].items():
+            feeds = [feed for feed in self.feeds if feed.startswith(app)]
+            app_path = feed_config['app_path'].replace('/Applications', self.apps, 1)  # NOQA
+            feed_config['app_path'] = app_path
+            if feeds:
+                resources = os.path.dirname(app_path).replace('*', '')
+                os.makedirs(resources)
+                open(os.path.join(resources, feeds[-1]), 'w').close()
+        plistlib.writePlist(configuration, os.path.join(self.root, config_file))  # NOQA
+
+        for name, script in shims.items():
+            self.shim(name, script)
+        self.shim('curl', 'exec %s "$@"\n' % find_executable('curl'))
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.root = self.root
+        self.server.pkg_size = pkg_size
+        self.server.payload = ''.join(chr(index % 251) for index in range(pkg_size))  # NOQA
+        self.server.latency = latency
+        self.server.listing = True
+        self.server.caching = False
+        self.server.counts = {}
+        self.server.lock = threading.Lock()
+        self.server.threads = []
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # Point appleLoops at the server and the fake tools, and keep
+        # deployment downloads out of /tmp
+        appleLoops.APPLE_URL = self.url
+        appleLoops.DEPLOYMENT_PATH = os.path.join(self.path, 'tmp')
+        for name in ['curl', 'diskutil', 'hdiutil', 'installer', 'pkgutil']:
+            setattr(appleLoops, name.upper(), os.path.join(self.bin, name))
+
+    def shim(self, name, script):
+        path = os.path.join(self.bin, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\necho %s >> "%s"\n%s' % (name, self.counts_file, script))  # NOQA
+        os.chmod(path, 0755)
+
+    def counts(self):
+        '''Returns and resets the server and subprocess counters.'''
+        with self.server.lock:
+            server_counts, self.server.counts = self.server.counts, {}
+
+        subprocesses = {}
+        if os.path.exists(self.counts_file):
+            with open(self.counts_file) as f:
+                for line in f:
+                    subprocesses[line.strip()] = subprocesses.get(line.strip(), 0) + 1  # NOQA
+            os.remove(self.counts_file)
+
+        return server_counts, subprocesses
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # Connections still open (i.e. kept alive) are left to the daemon
+        # threads after a second
+        for thread in self.server.threads:
+            thread.join(1)
+        if not self.keep:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def scenarios(fixture, downloads):
+    '''Returns (name, AppleLoops keyword arguments, warm) for each scenario.
+    Warm scenarios re-use the caches and destination of the previous run.'''
+    common = {
+        'apps_plist': fixture.feeds,
+        'downloads': downloads,
+        'mandatory_loops': True,
+        'optional_loops': True,
+        'pkg_server': fixture.url,
+        'quiet_mode': True,
+    }
+
+    deployment = dict(common, deployment_mode=True, optional_loops=False)
+    del deployment['apps_plist']
+
+    result = [
+        ('dry-run', dict(common, dry_run=True), False),
+        ('dry-run-warm', dict(common, dry_run=True), True),
+        ('mirror', dict(common, dry_run=False, mirror_paths=True), False),
+        ('mirror-warm', dict(common, dry_run=False, mirror_paths=True), True),  # NOQA
+        ('deployment-dry-run', dict(deployment, dry_run=True), False),
+    ]
+
+    # Installing needs root, even with the fake installer
+    if os.getuid() == 0:
+        result.append(('deployment', dict(deployment, dry_run=False), False))
+
+    return result
+
+
+def run(fixture, name, kwargs, run_path):
+    '''Runs one scenario and returns its results.'''
+    kwargs = dict(kwargs, cache_path=os.path.join(run_path, 'cache'), destination=os.path.join(run_path, 'destination'), log_path=os.path.join(run_path, 'logs'))  # NOQA
+    for folder in [kwargs['destination'], kwargs['log_path']]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    fixture.counts()
+
+    # Some output ignores quiet mode, so keep stdout free for the results
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        start = time.time()
+        al = appleLoops.AppleLoops(**kwargs)
+        al.main_processor()
+        elapsed = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    server_counts, subprocesses = fixture.counts()
+
+    downloaded = al.downloads.stats['bytes']
+    return {
+        'name': name,
+        'elapsed': round(elapsed, 4),
+        'http': {
+            'requests': sum(server_counts.get(key, 0) for key in ['get', 'head', 'pkg_get']),  # NOQA
+            'feed_and_config_gets': server_counts.get('get', 0),
+            'not_modified': server_counts.get('not_modified', 0),
+            'heads': server_counts.get('head', 0),
+            'pkg_gets': server_counts.get('pkg_get', 0),
+            'pkg_bytes_served': server_counts.get('pkg_bytes', 0),
+            'connections_opened': al.request.stats['connections_opened'],
+            'connections_reused': al.request.stats['connections_reused'],
+        },
+        'cache': dict(al.cache.stats),
+        'downloads': {
+            'bytes': downloaded,
+            'transfers': al.downloads.stats['transfers'],
+            'throughput': int(downloaded / elapsed) if elapsed else 0,
+        },
+        'subprocesses': subprocesses,
+        'deployment_summary': {
+            'successful_installs': al.deployment_summary['successful_installs'],  # NOQA
+            'failed_installs': len(al.deployment_summary['failed_installs']),  # NOQA
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks appleLoops.py against a local HTTP server.')  # NOQA
+    parser.add_argument('--downloads', type=int, default=4, help='Concurrent downloads. Default is 4.')  # NOQA
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch folder after running.')  # NOQA
+    parser.add_argument('--latency', type=float, default=0, help='Seconds the server waits before each response. Default is 0.')  # NOQA
+    parser.add_argument('--output', type=str, default='-', help='File to write JSON results to, or - for stdout. Default is -.')  # NOQA
+    parser.add_argument('--pkg-size', type=int, default=65536, help='Bytes in each synthetic package. Default is 65536.')  # NOQA
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to run each scenario. Default is 1.')  # NOQA
+    parser.add_argument('--scenario', type=str, action='append', help='Only run the named scenario. Can be used more than once.')  # NOQA
+    args = parser.parse_args()
+
+    # Don't wait on anything outside the machine
+    socket.setdefaulttimeout(30)
+
+    fixture = Fixture(args.pkg_size, args.latency, keep=args.keep)
+    results = {
+        'generated': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'appleLoops_version': appleLoops.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {
+            'downloads': args.downloads,
+            'latency': args.latency,
+            'pkg_size': args.pkg_size,
+            'repeat': args.repeat,
+        },
+        'feeds': fixture.feeds,
+        'scenarios': [],
+    }
+
+    try:
+        for repeat in range(args.repeat):
+            run_path = os.path.join(fixture.path, 'run%s' % repeat)
+            for name, kwargs, warm in scenarios(fixture, args.downloads):
+                if args.scenario and name not in args.scenario and not any(['%s-warm' % scenario == name for scenario in args.scenario]):  # NOQA
+                    continue
+
+                # Cold scenarios start from nothing, warm ones from the last run  # NOQA
+                if not warm:
+                    shutil.rmtree(run_path, ignore_errors=True)
+
+                result = run(fixture, name, kwargs, run_path)
+                result['repeat'] = repeat
+                results['scenarios'].append(result)
+                sys.stderr.write('%-20s %8.3fs %6s requests %6s downloads %s\n' % (name, result['elapsed'], result['http']['requests'], result['downloads']['transfers'], ', '.join('%s=%s' % item for item in sorted(result['subprocesses'].items()))))  # NOQA
+    finally:
+        fixture.close()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print output
+    else:
+        with open(args.output, 'w') as f:
+            f.write('%s\n' % output)
+
+
+if __name__ == '__main__':
+    main()
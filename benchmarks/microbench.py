@@ -0,0 +1,254 @@
+#!/usr/bin/python
+'''Microbenchmarks for feed parsing and catalog building.
+
+Times the parts of appleLoops.py that scale with the size of a feed, against
+each feed bundled in lp10_ms3_content_2016:
+
+- plistlib: plistlib.readPlist, for comparison.
+- foundation: readPlist and readPlistFromString. Skipped where PyObjC's
+  Foundation can't be imported.
+- feed_reader: FeedReader, which is what appleLoops.py reads feeds with.
+- resolve_feeds: building a Loop record for each package in the feed, with
+  receipts and network lookups stubbed out.
+- diff_feeds: diff_feeds against the previous feed for the same app.
+- duplicates: duplicate_file_exists for every package in the feed, against a
+  destination holding the packages of every bundled feed.
+
+Each case runs in its own process. Once a case is set up, one run of it is
+made in a process forked from that one, which starts with a fresh peak memory
+mark. So the peak memory of a case doesn't include importing appleLoops.py or
+setting up the case. Results are written as JSON.'''
+import argparse
+import json
+import os
+import platform
+import plistlib
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from glob import glob
+
+# appleLoops.py lives in the folder above this one
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+
+import appleLoops  # NOQA
+
+feed_folder = os.path.join(repo_path, 'lp10_ms3_content_2016')
+
+cases = ['plistlib', 'foundation', 'feed_reader', 'resolve_feeds', 'diff_feeds', 'duplicates']  # NOQA
+
+
+def bundled_feeds():
+    return sorted(glob(os.path.join(feed_folder, '*.plist')))
+
+
+def feed_app(feed):
+    '''Returns the app a feed is for - strips numbers from the feed name.'''
+    return ''.join(c for c in os.path.splitext(os.path.basename(feed))[0] if c not in '0123456789')  # NOQA
+
+
+def previous_feed(feed):
+    '''Returns the feed before this one for the same app, or None.'''
+    feeds = [path for path in bundled_feeds() if feed_app(path) == feed_app(feed)]  # NOQA
+    index = feeds.index(feed)
+    if index:
+        return feeds[index - 1]
+
+
+def peak_rss():
+    '''Returns the peak resident memory of this process in bytes.'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def measure(function):
+    '''Runs a function once in a forked process, and returns its peak
+    resident memory in bytes and how far that rose above the memory the
+    process started with.'''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            baseline = peak_rss()
+            function()
+            os.write(write_fd, json.dumps([peak_rss(), peak_rss() - baseline]))  # NOQA
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    if not output:
+        raise RuntimeError('Measuring memory failed')
+    return json.loads(output)
+
+
+def read_feed(feed):
+    with open(feed, 'rb') as f:
+        return appleLoops.FeedReader(keys=['Packages', 'Content']).parse_file(f)  # NOQA
+
+
+def apple_loops(scratch, **kwargs):
+    '''Returns an AppleLoops for the bundled configuration that doesn't touch
+    the network, with nothing installed.'''
+    for folder in ['cache', 'destination', 'logs']:
+        if not os.path.exists(os.path.join(scratch, folder)):
+            os.makedirs(os.path.join(scratch, folder))
+
+    # The bundled configuration is found next to appleLoops.py
+    al = appleLoops.AppleLoops(cache_path=os.path.join(scratch, 'cache'), destination=os.path.join(scratch, 'destination'), log_path=os.path.join(scratch, 'logs'), mandatory_loops=True, optional_loops=True, offline=True, quiet_mode=True, workers=1, **kwargs)  # NOQA
+    # An empty receipts index, so pkgutil isn't run
+    al.receipts.receipts = {}
+    return al
+
+
+def setup(case, feed, scratch):
+    '''Returns the function to time for a case, or None to skip it.'''
+    if case == 'plistlib':
+        return lambda: plistlib.readPlist(feed)
+
+    elif case == 'foundation':
+        try:
+            import Foundation  # NOQA
+        except ImportError:
+            return None
+
+        with open(feed, 'rb') as f:
+            data = f.read()
+        return lambda: (appleLoops.readPlist(feed), appleLoops.readPlistFromString(data))  # NOQA
+
+    elif case == 'feed_reader':
+        return lambda: read_feed(feed)
+
+    elif case == 'resolve_feeds':
+        al = apple_loops(scratch)
+        feeds = [{'app_feed_file': os.path.basename(feed), 'result': al.read_feed(os.path.basename(feed), feed)}]  # NOQA
+        return lambda: al.resolve_feeds(feeds)
+
+    elif case == 'diff_feeds':
+        previous = previous_feed(feed)
+        if not previous:
+            return None
+
+        al = apple_loops(scratch)
+        return lambda: al.diff_feeds([previous, feed])
+
+    elif case == 'duplicates':
+        # A destination with a copy of every package from every feed, in the
+        # folder for that feed
+        destination = os.path.join(scratch, 'destination')
+        for other in bundled_feeds():
+            folder = os.path.join(destination, os.path.basename(other).replace('.plist', ''))  # NOQA
+            os.makedirs(folder)
+            for pkg in read_feed(other)['Packages'].values():
+                open(os.path.join(folder, os.path.basename(pkg['DownloadName'])), 'w').close()  # NOQA
+
+        al = apple_loops(scratch)
+        al.files_found = appleLoops.DestinationIndex(destination)
+        al.files_found.scan()
+        loops = al.resolve_feeds([{'app_feed_file': os.path.basename(feed), 'result': al.read_feed(os.path.basename(feed), feed)}])  # NOQA
+
+        def duplicates():
+            for loop in loops:
+                try:
+                    al.duplicate_file_exists(loop)
+                except Exception:
+                    pass
+        return duplicates
+
+
+def child(case, feed, repeat):
+    '''Runs a case and writes its results to stdout as JSON.'''
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    scratch = tempfile.mkdtemp(prefix='appleLoops_microbench_')
+    result = {'skipped': True}
+    try:
+        function = setup(case, feed, scratch)
+        if function:
+            rss, rss_growth = measure(function)
+            times = []
+            for run in range(repeat):
+                start = time.time()
+                function()
+                times.append(time.time() - start)
+
+            result = {
+                'best': round(min(times), 6),
+                'mean': round(sum(times) / len(times), 6),
+                'peak_rss': rss,
+                'peak_rss_growth': rss_growth,
+                'skipped': False,
+            }
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    print json.dumps(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for feed parsing and catalog building in appleLoops.py.')  # NOQA
+    parser.add_argument('--case', type=str, action='append', choices=cases, help='Only run the named case. Can be used more than once.')  # NOQA
+    parser.add_argument('--child', type=str, nargs=2, metavar=('CASE', 'FEED'), help=argparse.SUPPRESS)  # NOQA
+    parser.add_argument('--feed', type=str, action='append', help='Only run against the named feed, i.e. logicpro1040.plist. Can be used more than once.')  # NOQA
+    parser.add_argument('--output', type=str, default='-', help='File to write JSON results to, or - for stdout. Default is -.')  # NOQA
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times each case is timed. Default is 5.')  # NOQA
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.repeat)
+        return
+
+    results = {
+        'generated': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'appleLoops_version': appleLoops.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'feeds': [],
+    }
+
+    for feed in bundled_feeds():
+        if args.feed and os.path.basename(feed) not in args.feed:
+            continue
+
+        feed_result = {
+            'feed': os.path.basename(feed),
+            'bytes': os.path.getsize(feed),
+            'packages': len(read_feed(feed)['Packages']),
+            'cases': {},
+        }
+
+        for case in (args.case or cases):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', case, feed, '--repeat', str(args.repeat)])  # NOQA
+            result = json.loads(output.splitlines()[-1])
+            feed_result['cases'][case] = result
+            if result['skipped']:
+                sys.stderr.write('%-22s %-14s skipped\n' % (feed_result['feed'], case))  # NOQA
+            else:
+                sys.stderr.write('%-22s %-14s %10.6fs %8.1f MB peak %8.1f MB growth\n' % (feed_result['feed'], case, result['best'], result['peak_rss'] / 1048576.0, result['peak_rss_growth'] / 1048576.0))  # NOQA
+
+        results['feeds'].append(feed_result)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print output
+    else:
+        with open(args.output, 'w') as f:
+            f.write('%s\n' % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,12 @@ _appleLoops() {
   COMPREPLY=()
 
   cur="${COMP_WORDS[COMP_CWORD]}"
-  opts="--allow-insecure allow-untrusted --apps --build-dmg --cache-server --debug \
-    --destination --deployment --dry-run --force-deploy --hard-link --log-path \
-    --mandatory-only --mirror-paths --mute-progress-bar --optional-only \
-    --pkg-server --plists --threshold --quiet --version"
+  opts="--allow-insecure allow-untrusted --apps --build-dmg --build-pkg-index --cache-path --cache-server --compile-feeds --content-store --debug \
+    --destination --deployment --diff-feeds --download-limits --downloads --dry-run --events --force-deploy --hard-link --http-pool-size \
+    --http-timeout --limit-rate --log-path \
+    --mandatory-only --mirror-paths --mute-progress-bar --offline --optional-only --order \
+    --pkg-server --plists --profile --prometheus-textfile --segments --sync --threshold --quiet --verify-sizes --version \
+    --workers"
 
   case "$cur" in
     --*)
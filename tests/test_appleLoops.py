@@ -0,0 +1,1495 @@
+#!/usr/bin/python
+'''Tests for appleLoops.py, run against the local HTTP server and fake tools
+from benchmarks/benchmark.py.
+
+    python -m unittest discover tests'''
+import errno
+import json
+import os
+import plistlib
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from datetime import datetime
+
+# appleLoops.py lives in the folder above this one
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [repo_path, os.path.join(repo_path, 'benchmarks')]
+
+import appleLoops  # NOQA
+import benchmark  # NOQA
+
+
+def feed_path(feed):
+    '''Returns the path to a bundled feed.'''
+    return os.path.join(repo_path, benchmark.feed_folder, feed)
+
+
+def read_feed(feed):
+    '''Returns the Packages and Content of a bundled feed, as read by the
+    streaming parser.'''
+    with open(feed_path(feed), 'rb') as f:
+        return appleLoops.FeedReader(keys=['Packages', 'Content']).parse_file(f)  # NOQA
+
+
+class ScratchTestCase(unittest.TestCase):
+    '''Gives each test a scratch folder.'''
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='appleLoops_test_')
+        self.addCleanup(shutil.rmtree, self.path, True)
+
+
+class FixtureTestCase(unittest.TestCase):
+    '''Starts a fixture (server, fake apps and tools) for each test.'''
+    pkg_size = 262144
+
+    def setUp(self):
+        self.fixture = benchmark.Fixture(self.pkg_size, 0)
+        # Cleanups run last added first, so anything a test cleans up runs
+        # before the server is stopped
+        self.addCleanup(self.fixture.close)
+
+    def pkg_url(self, name):
+        return '%s/lp10_ms3_content_2016/%s' % (self.fixture.url, name)
+
+    def apple_loops(self, run='main_processor', **kwargs):
+        '''Runs AppleLoops.main_processor() (or another method) against the
+        fixture, with its caches and destination in the fixture folder.
+        Returns the AppleLoops instance.'''
+        run_path = os.path.join(self.fixture.path, 'run')
+        for folder in ['destination', 'logs']:
+            if not os.path.exists(os.path.join(run_path, folder)):
+                os.makedirs(os.path.join(run_path, folder))
+
+        kwargs = dict({
+            'cache_path': os.path.join(run_path, 'cache'),
+            'destination': os.path.join(run_path, 'destination'),
+            'downloads': 4,
+            'log_path': os.path.join(run_path, 'logs'),
+            'mandatory_loops': True,
+            'pkg_server': self.fixture.url,
+            'quiet_mode': True,
+        }, **kwargs)
+
+        # Some output ignores quiet mode
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            al = appleLoops.AppleLoops(**kwargs)
+            self.addCleanup(al.request.close)
+            getattr(al, run)()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        return al
+
+
+class TestThreadedMap(unittest.TestCase):
+    def test_order_and_concurrency(self):
+        '''Results come back in item order, and no more calls run at once
+        than there are workers.'''
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def square(item):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            # Later items finish first
+            time.sleep(0.01 * (10 - item))
+            with lock:
+                running[0] -= 1
+            return item * item
+
+        self.assertEqual(appleLoops.threaded_map(square, range(10), workers=3), [item * item for item in range(10)])  # NOQA
+        self.assertEqual(running[1], 3)
+
+    def test_exit(self):
+        '''SystemExit raised in a worker is re-raised to the caller, and
+        remaining work is abandoned.'''
+        done = []
+
+        def work(item):
+            if item == 0:
+                sys.exit(3)
+            time.sleep(0.05)
+            done.append(item)
+
+        with self.assertRaises(SystemExit) as context:
+            appleLoops.threaded_map(work, range(20), workers=2)
+        self.assertEqual(context.exception.code, 3)
+        self.assertLess(len(done), 19)
+
+
+class TestFeedReader(unittest.TestCase):
+    def test_bundled_feeds(self):
+        '''Fed in small chunks, the kept keys of each bundled feed match
+        plistlib, and every other top level key is skipped.'''
+        folder = os.path.join(repo_path, benchmark.feed_folder)
+        for feed in sorted(os.listdir(folder)):
+            expected = plistlib.readPlist(feed_path(feed))
+            reader = appleLoops.FeedReader(keys=['Packages', 'Content'])
+            with open(feed_path(feed), 'rb') as f:
+                result = reader.parse_file(f, chunk_size=4099)
+            self.assertEqual(sorted(result), ['Content', 'Packages'], feed)
+            self.assertEqual(result['Packages'], expected['Packages'], feed)
+            self.assertEqual(result['Content'], expected['Content'], feed)
+
+    def test_value_types(self):
+        '''Each plist type is read, split across chunks at any point, and a
+        skipped value can hold anything.'''
+        document = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<plist version="1.0"><dict>'
+            '<key>Skipped</key><array><dict><key>Packages</key>'
+            '<integer>1</integer></dict><data>AAAA</data></array>'
+            '<key>Packages</key><dict>'
+            '<key>Size</key><integer>-42</integer>'
+            '<key>Ratio</key><real>0.5</real>'
+            '<key>Mandatory</key><true/>'
+            '<key>Optional</key><false/>'
+            '<key>Blob</key><data>aGVs\nbG8=</data>'
+            '<key>Name</key><string>Loops &amp; Beats</string>'
+            '<key>Empty</key><string></string>'
+            '<key>Published</key><date>2018-08-05T12:30:00Z</date>'
+            '<key>List</key><array><string>a</string><array/><dict/></array>'
+            '</dict></dict></plist>')
+        expected = {'Packages': {
+            'Size': -42,
+            'Ratio': 0.5,
+            'Mandatory': True,
+            'Optional': False,
+            'Blob': 'hello',
+            'Name': 'Loops & Beats',
+            'Empty': '',
+            'Published': datetime(2018, 8, 5, 12, 30),
+            'List': ['a', [], {}],
+        }}
+        self.assertEqual(plistlib.readPlistFromString(document)['Packages']['Published'], expected['Packages']['Published'])  # NOQA
+        for chunk_size in [1, 7, len(document)]:
+            reader = appleLoops.FeedReader(keys=['Packages'])
+            for start in range(0, len(document), chunk_size):
+                reader.feed(document[start:start + chunk_size])
+            self.assertEqual(reader.close(), expected)
+
+        # Without keys, everything is kept
+        reader = appleLoops.FeedReader()
+        reader.feed(document)
+        self.assertEqual(sorted(reader.close()), ['Packages', 'Skipped'])
+
+
+class TestRequests(FixtureTestCase):
+    def test_probes_reuse_connections(self):
+        '''Probing packages larger than the drain limit re-uses one
+        connection, as HEAD responses have no body to drain.'''
+        request = appleLoops.Requests()
+        self.addCleanup(request.close)
+        self.assertTrue(self.pkg_size > request.drain_limit)
+
+        for index in range(5):
+            self.assertEqual(request.response_code(self.pkg_url('%s.pkg' % index)), 200)  # NOQA
+        self.assertEqual(request.stats['connections_opened'], 1)
+        self.assertEqual(request.stats['connections_reused'], 4)
+
+        server_counts, subprocesses = self.fixture.counts()
+        self.assertEqual(server_counts.get('head'), 5)
+        self.assertEqual(server_counts.get('pkg_get'), None)
+
+
+class TestHTTPCache(FixtureTestCase):
+    def setUp(self):
+        FixtureTestCase.setUp(self)
+        self.request = appleLoops.Requests()
+        self.addCleanup(self.request.close)
+        self.cache = appleLoops.HTTPCache(self.request, os.path.join(self.fixture.path, 'cache'))  # NOQA
+        self.url = '%s/document.txt' % self.fixture.url
+        self.publish('first')
+
+    def publish(self, data):
+        '''Changes the document on the server.'''
+        path = os.path.join(self.fixture.root, 'document.txt')
+        with open(path, 'w') as f:
+            f.write(data)
+        stamp = time.time() + (10 if self.cache.stats['fetched'] else 0)
+        os.utime(path, (stamp, stamp))
+
+    def test_conditional_get(self):
+        '''An unchanged document is only downloaded once.'''
+        self.assertEqual(self.cache.fetch(self.url), (200, 'first'))
+        self.assertEqual(self.cache.fetch(self.url), (200, 'first'))
+        self.assertEqual(self.cache.stats['not_modified'], 1)
+
+        self.publish('second')
+        self.assertEqual(self.cache.fetch(self.url), (200, 'second'))
+        self.assertEqual(self.cache.stats['fetched'], 2)
+
+    def test_rejected_document(self):
+        '''A document a consumer rejects isn't cached, the stale copy isn't
+        served instead, and the connection isn't pooled.'''
+        self.cache.fetch(self.url)
+        self.publish('second')
+
+        def reject(chunk):
+            raise ValueError('Not a feed')
+
+        status, data_file, streamed = self.cache.fetch_file(self.url, consumers=[reject])  # NOQA
+        self.assertTrue(isinstance(status, ValueError))
+        self.assertEqual([name for name in os.listdir(self.cache.cache_path) if name.endswith('.tmp')], [])  # NOQA
+        self.assertEqual([conn for conns in self.request.pools.values() for conn in conns], [])  # NOQA
+        self.assertEqual(self.cache.fetch(self.url), (200, 'second'))
+
+    def test_stale_copy(self):
+        '''If the server can't be reached the cached copy is served.'''
+        self.cache.fetch(self.url)
+        self.fixture.server.shutdown()
+        self.fixture.server.server_close()
+        self.request.close()
+        self.assertEqual(self.cache.fetch(self.url), (200, 'first'))
+        self.assertTrue(isinstance(self.cache.fetch(self.url, stale=False)[0], Exception))  # NOQA
+
+
+class TestPkgSize(FixtureTestCase):
+    def size(self, pkg_info, **kwargs):
+        '''Returns the size of a package and the HEAD requests it took.'''
+        al = self.apple_loops(run='load_configuration', **kwargs)
+        self.fixture.counts()
+        size = al.pkg_size(pkg_info, self.pkg_url('Loops.pkg'))
+        return (size, self.fixture.counts()[0].get('head', 0))
+
+    def test_feed_size(self):
+        '''The feed's DownloadSize is used without asking the server.'''
+        self.assertEqual(self.size({'DownloadSize': 1234}), (1234, 0))
+
+    def test_server_size(self):
+        '''The server is asked when the feed has no size, or sizes are
+        being verified.'''
+        self.assertEqual(self.size({}), (self.pkg_size, 1))
+        self.assertEqual(self.size({'DownloadSize': 1234}, verify_sizes=True), (self.pkg_size, 1))  # NOQA
+
+
+class TestHelpInit(FixtureTestCase):
+    def test_no_requests(self):
+        '''Help output is built without a request to any server, first from
+        the bundled configuration, then from the cached one.'''
+        self.fixture.counts()
+        al = self.apple_loops(run='load_configuration', help_init=True)
+        self.assertEqual(self.fixture.counts()[0], {})
+        self.assertNotIn('://', al.config_url)
+        self.assertTrue(al.supported_plists)
+
+        online = self.apple_loops(run='load_configuration')
+        self.assertTrue(self.fixture.counts()[0])
+
+        al = self.apple_loops(run='load_configuration', help_init=True)
+        self.assertEqual(self.fixture.counts()[0], {})
+        self.assertEqual(al.config_url, online.config_url)
+        self.assertEqual(sorted(al.supported_plists), sorted(online.supported_plists))  # NOQA
+
+
+class TestConfiguration(FixtureTestCase):
+    def test_cached_configuration(self):
+        '''The configuration is fetched from the pkg server once, then
+        checked with a conditional GET, or read from the cache offline.'''
+        config_url = '%s/%s' % (self.fixture.url, benchmark.config_file)
+        first = self.apple_loops(run='load_configuration')
+        self.assertEqual(first.config_url, config_url)
+        self.assertTrue(first.configuration['loop_feeds'])
+
+        second = self.apple_loops(run='load_configuration')
+        self.assertEqual(second.config_url, config_url)
+        self.assertEqual(second.configuration, first.configuration)
+        self.assertEqual(second.cache.stats['fetched'], 0)
+
+        self.fixture.counts()
+        offline = self.apple_loops(run='load_configuration', offline=True)
+        self.assertEqual(offline.configuration, first.configuration)
+        self.assertEqual(self.fixture.counts()[0].get('get'), None)
+
+
+class TestFeedIndex(ScratchTestCase):
+    def test_logic_content_groups(self):
+        '''Logic Pro feeds have Content groups for each language, English
+        is used, with packages in SubContent groups added to their group.'''
+        index = appleLoops.FeedIndex(self.path)
+        result = index.compile('logicpro1040.plist', 'digest', read_feed('logicpro1040.plist'))  # NOQA
+
+        groups = plistlib.readPlist(feed_path('logicpro1040.plist'))['Content']['en']  # NOQA
+        self.assertEqual([group['Name'] for group in result['Content']], [group['Name'] for group in groups])  # NOQA
+        self.assertEqual(result['Content'][0]['Packages'], groups[0]['Packages'])  # NOQA
+        alchemy = [group for group in groups if group['Name'] == 'Alchemy'][0]  # NOQA
+        self.assertEqual([group for group in result['Content'] if group['Name'] == 'Alchemy'][0]['Packages'], [pkg for sub_group in alchemy['SubContent'] for pkg in sub_group['Packages']])  # NOQA
+        self.assertEqual(index.load('logicpro1040.plist', 'digest'), result)  # NOQA
+
+    def test_garageband_content_groups(self):
+        result = appleLoops.FeedIndex(self.path).compact(read_feed('garageband1021.plist'))  # NOQA
+        groups = plistlib.readPlist(feed_path('garageband1021.plist'))['Content']  # NOQA
+        self.assertEqual(result['Content'], [{'Name': group['Name'], 'Packages': group['Packages']} for group in groups])  # NOQA
+
+    def test_first_language_without_english(self):
+        content = {'fr': [{'Name': 'Basse', 'Packages': ['b']}], 'de': [{'Name': 'Bass', 'Packages': ['a']}]}  # NOQA
+        result = appleLoops.FeedIndex(self.path).compact({'Packages': {}, 'Content': content})  # NOQA
+        self.assertEqual(result['Content'], [{'Name': 'Bass', 'Packages': ['a']}])  # NOQA
+
+
+class TestSpacePlanner(ScratchTestCase):
+    '''SpacePlanner with a fake diskutil reporting 1000 bytes free, which
+    logs each time it is called.'''
+    diskutil_script = '''#!/bin/sh
+echo "$@" >> "%(path)s/diskutil.log"
+echo "<plist><dict><key>FreeSpace</key><integer>1000</integer></dict></plist>"
+'''
+
+    def setUp(self):
+        ScratchTestCase.setUp(self)
+        self.diskutil = os.path.join(self.path, 'diskutil')
+        with open(self.diskutil, 'w') as f:
+            f.write(self.diskutil_script % {'path': self.path})
+        os.chmod(self.diskutil, 0755)
+
+    def calls(self):
+        with open(os.path.join(self.path, 'diskutil.log')) as f:
+            return f.read().splitlines()
+
+    def test_threshold(self):
+        '''Free space is queried once, and the threshold protects a
+        percentage of it.'''
+        planner = appleLoops.SpacePlanner('/Volumes/Data', threshold=10, diskutil=self.diskutil)  # NOQA
+        self.assertEqual(planner.usable(), 900)
+        self.assertEqual(planner.available(), 900)
+        self.assertEqual(self.calls(), ['info -plist /Volumes/Data'])
+
+    def test_reserve(self):
+        '''Reservations are kept in the ledger until space runs out, and
+        transient downloads only need to fit alongside them.'''
+        planner = appleLoops.SpacePlanner(diskutil=self.diskutil)
+        self.assertTrue(planner.reserve(download=200, install=300))
+        self.assertEqual(planner.available(), 500)
+        self.assertTrue(planner.reserve(download=400, install=100, transient=True))  # NOQA
+        self.assertEqual(planner.available(), 400)
+        self.assertFalse(planner.reserve(download=401))
+        self.assertFalse(planner.reserve(download=101, install=300, transient=True))  # NOQA
+        self.assertEqual(planner.available(), 400)
+        self.assertTrue(planner.reserve(install=400))
+        self.assertEqual(planner.available(), 0)
+
+    def test_statvfs(self):
+        '''Without a working diskutil, statvfs of the nearest existing folder
+        is used.'''
+        planner = appleLoops.SpacePlanner(os.path.join(self.path, 'missing', 'folder'), diskutil=os.path.join(self.path, 'none'))  # NOQA
+        stat = os.statvfs(self.path)
+        self.assertAlmostEqual(planner.query(), stat.f_bavail * stat.f_frsize, delta=1 << 24)  # NOQA
+
+
+class TestReceiptIndex(ScratchTestCase):
+    '''ReceiptIndex with a fake pkgutil and a folder of fixture receipts.
+    pkgutil lists the packages in the pkgs folder, each file holding the
+    package's version, and logs how it was called.'''
+    pkgutil_script = '''#!/bin/sh
+echo "$1" >> "%(path)s/pkgutil.log"
+case "$1" in
+    --pkgs)
+        [ -e "%(path)s/broken" ] && exit 1
+        ls "%(path)s/pkgs" ;;
+    --pkg-info-plist)
+        [ -e "%(path)s/pkgs/$2" ] || exit 1
+        echo "<plist><dict><key>pkg-version</key>"
+        echo "<string>$(cat "%(path)s/pkgs/$2")</string></dict></plist>" ;;
+esac
+'''
+
+    def setUp(self):
+        ScratchTestCase.setUp(self)
+        for folder in ['pkgs', 'receipts']:
+            os.makedirs(os.path.join(self.path, folder))
+
+        self.pkgutil = os.path.join(self.path, 'pkgutil')
+        with open(self.pkgutil, 'w') as f:
+            f.write(self.pkgutil_script % {'path': self.path})
+        os.chmod(self.pkgutil, 0755)
+
+        self.install('com.example.a', '1.0')
+        self.install('com.example.b', '2.0', receipt=False)
+
+    def install(self, pkg_id, version, receipt=True):
+        with open(os.path.join(self.path, 'pkgs', pkg_id), 'w') as f:
+            f.write(version)
+        if receipt:
+            plistlib.writePlist({'PackageVersion': version}, os.path.join(self.path, 'receipts', '%s.plist' % pkg_id))  # NOQA
+
+    def index(self):
+        return appleLoops.ReceiptIndex(pkgutil=self.pkgutil, receipts_db=os.path.join(self.path, 'receipts'), cache_file=os.path.join(self.path, 'cache', 'receipts.plist'))  # NOQA
+
+    def calls(self):
+        '''Returns and resets the pkgutil calls.'''
+        log = os.path.join(self.path, 'pkgutil.log')
+        if not os.path.exists(log):
+            return []
+        with open(log) as f:
+            calls = f.read().split()
+        os.remove(log)
+        return calls
+
+    def test_versions(self):
+        '''Versions come from the receipt, or pkgutil if there isn't one.'''
+        index = self.index()
+        self.assertEqual(index.version('com.example.a'), '1.0')
+        self.assertEqual(index.version('com.example.b'), '2.0')
+        self.assertEqual(index.version('com.example.c'), '0.0.0')
+        self.assertFalse(index.installed('com.example.c'))
+        self.assertEqual(self.calls(), ['--pkgs', '--pkg-info-plist'])
+
+    def test_cache(self):
+        '''The cached index is used until the receipts database changes.'''
+        index = self.index()
+        self.assertEqual(index.version('com.example.b'), '2.0')
+        index.save()
+        self.calls()
+
+        cached = self.index()
+        self.assertTrue(cached.installed('com.example.a'))
+        self.assertEqual(cached.version('com.example.b'), '2.0')
+        self.assertFalse(cached.installed('com.example.c'))
+        self.assertEqual(self.calls(), [])
+
+        self.install('com.example.c', '3.0')
+        stamp = os.path.getmtime(os.path.join(self.path, 'receipts')) + 10
+        os.utime(os.path.join(self.path, 'receipts'), (stamp, stamp))
+        changed = self.index()
+        self.assertEqual(changed.version('com.example.c'), '3.0')
+        self.assertEqual(self.calls(), ['--pkgs'])
+
+    def test_pkgutil_fails(self):
+        '''If pkgutil can't list receipts, packages are looked up one at a
+        time and the index isn't cached.'''
+        open(os.path.join(self.path, 'broken'), 'w').close()
+        index = self.index()
+        self.assertTrue(index.installed('com.example.a'))
+        self.assertEqual(index.version('com.example.b'), '2.0')
+        self.assertFalse(index.installed('com.example.c'))
+        index.save()
+        self.assertFalse(os.path.exists(index.cache_file))
+
+        os.remove(os.path.join(self.path, 'broken'))
+        self.assertEqual(self.index().version('com.example.a'), '1.0')
+
+
+class TestSourcePool(FixtureTestCase):
+    def pool(self, urls, **kwargs):
+        request = appleLoops.Requests()
+        self.addCleanup(request.close)
+        pool = appleLoops.SourcePool(request, urls, **kwargs)
+        self.addCleanup(pool.stop)
+        return pool
+
+    def test_pkg_server_without_listing_is_up(self):
+        '''A pkg server is up if it answers 404 for its root, like a munki
+        repo without a listing. One that can't be reached, or that answers
+        400, is down.'''
+        self.fixture.server.listing = False
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        unreachable = 'http://127.0.0.1:%s' % closed.getsockname()[1]
+        closed.close()
+
+        pool = self.pool([unreachable, self.fixture.url])
+        self.assertEqual(pool.request.response_code(self.fixture.url), 404)
+        pool.check()
+        self.assertEqual(pool.best(), self.fixture.url)
+        self.assertEqual(pool.ranked(), [self.fixture.url, unreachable])
+
+        self.fixture.server.caching = True
+        self.assertFalse(pool.probe(self.fixture.url))
+
+    def test_caching_server_must_answer_400(self):
+        '''A caching server is only up if it answers 400, a web server
+        answering 200 or 404 isn't a caching server.'''
+        pool = self.pool([self.fixture.url], caching=True)
+        self.assertFalse(pool.probe(self.fixture.url))
+        self.fixture.server.listing = False
+        self.assertFalse(pool.probe(self.fixture.url))
+
+        self.fixture.server.caching = True
+        self.assertTrue(pool.probe(self.fixture.url))
+        self.assertEqual(pool.best(), self.fixture.url)
+
+    def test_single_pkg_server_is_not_probed(self):
+        '''A single pkg_server is used without a check at startup, so one
+        without a listing for its root isn't dropped.'''
+        self.fixture.server.listing = False
+        al = self.apple_loops(run='pkg_server_index')
+        self.assertEqual(al.pkg_server, self.fixture.url)
+        server_counts, subprocesses = self.fixture.counts()
+        self.assertEqual(server_counts.get('head'), None)
+
+    def test_failed_source_is_last(self):
+        '''A source a download failed on is ranked last until it passes its
+        next check, otherwise the order given is kept.'''
+        urls = [self.fixture.url, '%s/' % self.fixture.url]
+        pool = self.pool(urls)
+        self.assertEqual(pool.ranked(), urls)
+
+        pool.record(urls[0], 1, 0, ok=False)
+        self.assertEqual(pool.ranked(), urls[::-1])
+        self.assertTrue(pool.probe(urls[0]))
+        self.assertEqual(pool.sources[urls[0]]['healthy'], True)
+
+    def test_stop(self):
+        '''The background checks end when the pool is stopped.'''
+        pool = self.pool([self.fixture.url, '%s/' % self.fixture.url], interval=0.01)  # NOQA
+        pool.start()
+        time.sleep(0.1)
+        pool.stop()
+        pool.checker.join(1)
+        self.assertFalse(pool.checker.is_alive())
+
+
+class TestDownloadScheduler(ScratchTestCase):
+    def test_source_limits(self):
+        '''Each source is held to its own limit on concurrent transfers,
+        and bytes are counted per source.'''
+        scheduler = appleLoops.DownloadScheduler(workers=4, limits={'apple': 1})  # NOQA
+        lock = threading.Lock()
+        running = {'apple': [0, 0], 'pkg_server': [0, 0]}
+
+        def download(source, destination):
+            def cmd():
+                with lock:
+                    running[source][0] += 1
+                    running[source][1] = max(running[source])
+                time.sleep(0.05)
+                with open(destination, 'wb') as f:
+                    f.write('x' * 100)
+                with lock:
+                    running[source][0] -= 1
+            return cmd
+
+        for index in range(8):
+            source = ['apple', 'pkg_server'][index % 2]
+            destination = os.path.join(self.path, str(index))
+            scheduler.add(source, download(source, destination), destination)
+        scheduler.run()
+
+        self.assertEqual(running['apple'][1], 1)
+        self.assertGreater(running['pkg_server'][1], 1)
+        self.assertEqual(scheduler.source_bytes, {'apple': 400, 'pkg_server': 400, 'cache_server': 0})  # NOQA
+        self.assertEqual(scheduler.stats['transfers'], 8)
+
+
+class TestDestinationIndex(ScratchTestCase):
+    def setUp(self):
+        ScratchTestCase.setUp(self)
+        self.root = os.path.join(self.path, 'destination')
+        self.manifest_file = os.path.join(self.path, 'manifest.idx')
+        for path in ['a/x.pkg', 'b/x.pkg', 'b/c/y.pkg', 'b/c/notes.txt', '%s/ab/z.pkg' % appleLoops.ContentStore.folder]:  # NOQA
+            self.write(path)
+
+    def write(self, path, data='pkg'):
+        path = os.path.join(self.root, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def scan(self, root=None):
+        index = appleLoops.DestinationIndex(root or self.root, manifest_file=self.manifest_file, workers=2)  # NOQA
+        index.scan()
+        index.save()
+        return index
+
+    def test_scan(self):
+        '''Packages are indexed by name with every path they are at, leaving
+        out other files and the content store.'''
+        index = self.scan()
+        self.assertEqual(len(index), 3)
+        self.assertEqual(sorted(index.files['x.pkg']), [os.path.join(self.root, 'a/x.pkg'), os.path.join(self.root, 'b/x.pkg')])  # NOQA
+        self.assertEqual(index.find('y.pkg'), os.path.join(self.root, 'b/c/y.pkg'))  # NOQA
+        self.assertNotIn('z.pkg', index)
+        self.assertNotIn('notes.txt', index)
+        self.assertEqual(index.stats, {'listed': 4, 'reused': 0})
+
+        index.remove(os.path.join(self.root, 'b/c/y.pkg'))
+        self.assertIsNone(index.find('y.pkg'))
+        self.assertEqual(len(index), 2)
+
+    def test_manifest(self):
+        '''Only folders that changed since the last scan are listed again,
+        and a manifest for another root isn't used.'''
+        self.scan()
+        self.assertEqual(self.scan().stats, {'listed': 0, 'reused': 4})
+
+        self.write('b/c/w.pkg')
+        os.utime(os.path.join(self.root, 'b/c'), (1, 1))
+        index = self.scan()
+        self.assertEqual(index.stats, {'listed': 1, 'reused': 3})
+        self.assertIn('w.pkg', index)
+
+        self.assertEqual(self.scan(os.path.join(self.root, 'b')).stats, {'listed': 2, 'reused': 0})  # NOQA
+
+    def test_size(self):
+        '''size() reads a replaced file from disk and updates the index.'''
+        index = self.scan()
+        path = os.path.join(self.root, 'a/x.pkg')
+        self.write('a/x.pkg', 'replaced')
+        self.assertEqual(index.info[path][0], 3)
+        self.assertEqual(index.size(path), 8)
+        self.assertEqual(index.info[path][0], 8)
+        os.remove(path)
+        self.assertIsNone(index.size(path))
+
+
+class TestContentStore(FixtureTestCase):
+    pkg_size = 4096
+
+    def test_duplicate_compares_contents(self):
+        '''Only a copy of the same package with the same contents is a
+        duplicate of a stored package.'''
+        store = appleLoops.ContentStore(self.fixture.path)
+        os.makedirs(store.root)
+        blob = store.path('Loops.pkg', 3)
+        for path, data in [(blob, 'abc'), ('same.pkg', 'abc'), ('Loops.pkg', 'abd'), (os.path.join('copy', 'Loops.pkg'), 'abc')]:  # NOQA
+            path = os.path.join(self.fixture.path, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(data)
+
+        self.assertTrue(store.duplicate(blob, os.path.join(self.fixture.path, 'copy', 'Loops.pkg')))  # NOQA
+        self.assertFalse(store.duplicate(blob, os.path.join(self.fixture.path, 'Loops.pkg')))  # NOQA
+        self.assertFalse(store.duplicate(blob, os.path.join(self.fixture.path, 'same.pkg')))  # NOQA
+
+    def test_dmg_leaves_out_store(self):
+        '''The DMG is built without the store, but with every package.'''
+        al = self.apple_loops(apps_plist=['garageband1021.plist'], content_store=True, dry_run=False)  # NOQA
+        stored = os.listdir(al.content_store.root)
+        self.assertTrue(stored)
+
+        # The store isn't listed with the feed folders
+        index = appleLoops.DestinationIndex(al.destination)
+        index.scan()
+        self.assertTrue(len(index) > 0)
+        self.assertFalse([path for path in index.info if appleLoops.ContentStore.folder in path])  # NOQA
+
+        # The fake hdiutil lists what the DMG would be made from
+        listing = os.path.join(self.fixture.path, 'dmg.txt')
+        self.fixture.shim('hdiutil', 'cd "$5" && find . -type f > "%s"\n' % listing)  # NOQA
+        al.create_dmg(os.path.join(self.fixture.path, 'loops.dmg'))
+
+        with open(listing) as f:
+            files = f.read().split()
+        self.assertEqual(len([path for path in files if path.endswith('.pkg')]), len(stored))  # NOQA
+        self.assertFalse([path for path in files if appleLoops.ContentStore.folder in path])  # NOQA
+        self.assertEqual([name for name in os.listdir(al.destination) if name.startswith('.dmg')], [])  # NOQA
+
+
+class TestSegmentedDownload(FixtureTestCase):
+    def download(self, size):
+        destination = os.path.join(self.fixture.path, 'Loops.pkg')
+        request = appleLoops.Requests()
+        self.addCleanup(request.close)
+        appleLoops.SegmentedDownload(request, [self.pkg_url('Loops.pkg')], destination, size, segments=4).run()  # NOQA
+        return destination
+
+    def test_download(self):
+        with open(self.download(self.pkg_size), 'rb') as f:
+            self.assertEqual(f.read(), self.fixture.server.payload)
+
+    def test_size_mismatch(self):
+        '''A package that isn't the size the feed says fails, rather than
+        being truncated or padded to the feed's size.'''
+        for size in [self.pkg_size - 1000, self.pkg_size + 1000]:
+            with self.assertRaises(appleLoops.RequestsException):
+                self.download(size)
+            self.assertFalse(os.path.exists(os.path.join(self.fixture.path, 'Loops.pkg')))  # NOQA
+
+    def test_fallback_failure_cleans_up(self):
+        '''When the curl fallback fails as well, the .part file and its
+        state file aren't left behind.'''
+        al = self.apple_loops(run='load_configuration', dry_run=False)
+        pkg = al.resolve_pkg({'DownloadName': 'Loops.pkg', 'DownloadSize': self.pkg_size + 1000, 'PackageID': 'com.example.loops'}, 'garageband1021.plist')  # NOQA
+
+        def fallback():
+            self.assertTrue(os.path.exists('%s.part' % pkg.pkg_destination))
+            raise subprocess.CalledProcessError(22, 'curl')
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            al.segmented_download(pkg, fallback)
+        for leftover in ['%s.part' % pkg.pkg_destination, '%s.part.plist' % pkg.pkg_destination]:  # NOQA
+            self.assertFalse(os.path.exists(leftover), leftover)
+
+
+class TestRateLimit(FixtureTestCase):
+    pkg_size = 1048576
+
+    def test_one_download_gets_the_whole_rate(self):
+        '''The rate limit is shared by the downloads running, not split
+        between every download there could be.'''
+        al = self.apple_loops(run='load_configuration', dry_run=False, downloads=4, limit_rate='512K')  # NOQA
+        pkg = al.resolve_pkg({'DownloadName': 'Loops.pkg', 'DownloadSize': self.pkg_size, 'PackageID': 'com.example.loops'}, 'garageband1021.plist')  # NOQA
+
+        start = time.time()
+        al.download(pkg, scheduler=al.downloads)
+        al.downloads.run()
+        elapsed = time.time() - start
+
+        self.assertEqual(os.path.getsize(pkg.pkg_destination), self.pkg_size)  # NOQA
+        # The bucket starts full, so the first 512K is free and the rest
+        # takes a second. A quarter of the rate would take 8 seconds.
+        self.assertTrue(0.8 < elapsed < 4, elapsed)
+
+
+class TestCatalog(FixtureTestCase):
+    pkg_size = 4096
+
+    def feed(self, app_feed_file, *packages):
+        '''Returns a feed as get_feed() does, with (DownloadName,
+        IsMandatory) packages.'''
+        result = {'Packages': {}, 'Content': []}
+        for name, mandatory in packages:
+            result['Packages'][name] = {'DownloadName': name, 'DownloadSize': self.pkg_size, 'IsMandatory': mandatory, 'PackageID': 'com.example.%s' % name}  # NOQA
+        return {'app_feed_file': app_feed_file, 'result': result}
+
+    def test_shared_package(self):
+        '''A package in several feeds is resolved once, linked into each
+        feed's folder, and is mandatory if any feed says so.'''
+        al = self.apple_loops(run='load_configuration', optional_loops=True, order='mandatory')  # NOQA
+        loops = al.resolve_feeds([
+            self.feed('garageband1021.plist', ('Drums.pkg', False), ('Shared.pkg', False)),  # NOQA
+            self.feed('logicpro1040.plist', ('Shared.pkg', True)),
+        ])
+
+        self.assertEqual([(loop.pkg_name, loop.pkg_mandatory) for loop in loops], [('Shared.pkg', True), ('Drums.pkg', False)])  # NOQA
+        self.assertEqual(loops[0].pkg_destination, os.path.join(al.destination, 'garageband1021', 'optional', 'Shared.pkg'))  # NOQA
+        self.assertEqual(loops[0].pkg_links, (os.path.join(al.destination, 'logicpro1040', 'mandatory', 'Shared.pkg'),))  # NOQA
+
+    def test_shared_package_is_hard_linked(self):
+        '''A downloaded package is hard linked into the other feeds'
+        folders, and copied where a hard link can't be made.'''
+        al = self.apple_loops(run='load_configuration', dry_run=False, optional_loops=True)  # NOQA
+        loops = al.resolve_feeds([
+            self.feed('garageband1021.plist', ('Shared.pkg', False)),
+            self.feed('logicpro1040.plist', ('Shared.pkg', True)),
+            self.feed('mainstage324.plist', ('Shared.pkg', True)),
+        ])
+        pkg = loops[0]
+        os.makedirs(os.path.dirname(pkg.pkg_destination))
+        with open(pkg.pkg_destination, 'wb') as f:
+            f.write('x' * self.pkg_size)
+
+        link = os.link
+
+        def cross_device(source, destination):
+            if 'mainstage' in destination:
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            link(source, destination)
+
+        os.link = cross_device
+        try:
+            al.fan_out(pkg)
+        finally:
+            os.link = link
+
+        linked, copied = pkg.pkg_links
+        self.assertTrue(os.path.samefile(linked, pkg.pkg_destination))
+        self.assertFalse(os.path.samefile(copied, pkg.pkg_destination))
+        self.assertEqual(os.path.getsize(copied), self.pkg_size)
+
+    def test_existing_copy_is_hard_linked(self):
+        '''A package already elsewhere in the destination is hard linked by
+        default. With hard_link, a package that can't be linked is an
+        error instead of a copy.'''
+        for hard_link in [False, True]:
+            al = self.apple_loops(run='load_configuration', dry_run=False, hard_link=hard_link)  # NOQA
+            existing = os.path.join(al.destination, 'garageband1020', 'mandatory', 'Shared.pkg')  # NOQA
+            if not os.path.exists(existing):
+                os.makedirs(os.path.dirname(existing))
+                with open(existing, 'wb') as f:
+                    f.write('x' * self.pkg_size)
+            al.files_found = appleLoops.DestinationIndex(al.destination)
+            al.files_found.scan()
+            pkg = al.resolve_feeds([self.feed('logicpro1040.plist', ('Shared.pkg', True))])[0]  # NOQA
+            if os.path.exists(pkg.pkg_destination):
+                os.remove(pkg.pkg_destination)
+
+            al.duplicate_file_exists(pkg)
+            self.assertTrue(os.path.samefile(existing, pkg.pkg_destination))
+            os.remove(pkg.pkg_destination)
+
+            link = os.link
+
+            def cross_device(source, destination):
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+            os.link = cross_device
+            try:
+                if hard_link:
+                    with self.assertRaises(SystemExit):
+                        al.duplicate_file_exists(pkg)
+                    self.assertFalse(os.path.exists(pkg.pkg_destination))
+                else:
+                    al.duplicate_file_exists(pkg)
+                    self.assertFalse(os.path.samefile(existing, pkg.pkg_destination))  # NOQA
+            finally:
+                os.link = link
+
+    def test_bundled_feeds(self):
+        '''Packages of the bundled feeds are merged by DownloadName, keeping
+        each feed that lists a package and what it says about it.'''
+        catalog = appleLoops.Catalog()
+        feeds = {}
+        for feed in ['garageband1021.plist', 'logicpro1040.plist', 'mainstage324.plist']:  # NOQA
+            packages = plistlib.readPlist(feed_path(feed))['Packages']
+            feeds[feed] = dict((packages[pkg]['DownloadName'], bool(packages[pkg].get('IsMandatory'))) for pkg in packages)  # NOQA
+            catalog.add_feed(feed, packages)
+
+        names = set().union(*feeds.values())
+        self.assertEqual(sorted(catalog.names), sorted(names))
+        self.assertTrue(len(names) < sum(len(feeds[feed]) for feed in feeds))
+        for name in catalog.names:
+            self.assertEqual(sorted((ref['feed'], ref['mandatory']) for ref in catalog.packages[name]), sorted((feed, feeds[feed][name]) for feed in feeds if name in feeds[feed]))  # NOQA
+
+
+class TestOrder(FixtureTestCase):
+    pkg_size = 4096
+
+    def resolve(self, feed, order):
+        '''Returns the names of the packages in a bundled feed, in download
+        order.'''
+        al = self.apple_loops(run='load_configuration', optional_loops=True, order=order)  # NOQA
+        loops = al.resolve_feeds([{'app_feed_file': feed, 'result': al.read_feed(feed, feed_path(feed))}])  # NOQA
+        return [loop.pkg_name for loop in loops]
+
+    def test_content_order(self):
+        '''Packages are downloaded in the order of the Content groups that
+        list them, then the packages that aren't in a group.'''
+        feed = plistlib.readPlist(feed_path('logicpro1040.plist'))
+        expected = []
+        for group in appleLoops.FeedIndex(None).compact(feed)['Content']:
+            for pkg in group['Packages']:
+                if pkg in feed['Packages']:
+                    name = os.path.basename(feed['Packages'][pkg]['DownloadName'])  # NOQA
+                    if name not in expected:
+                        expected.append(name)
+        self.assertTrue(len(expected) > 100)
+
+        names = self.resolve('logicpro1040.plist', 'content')
+        self.assertEqual(names[:len(expected)], expected)
+        self.assertEqual(sorted(names), sorted(self.resolve('logicpro1040.plist', 'feed')))  # NOQA
+        self.assertNotEqual(names, self.resolve('logicpro1040.plist', 'feed'))  # NOQA
+
+
+class TestSync(FixtureTestCase):
+    pkg_size = 4096
+
+    def test_replaced_file_is_refetched(self):
+        '''A package replaced in place, which doesn't change its folder's
+        mtime, is still found to be the wrong size and fetched again.'''
+        first = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        self.assertTrue(first.downloads.stats['transfers'] > 0)
+
+        # The manifest only has the folders that were there when a sync
+        # started, so it takes a second sync for the first to be kept
+        unchanged = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        self.assertEqual(unchanged.downloads.stats['transfers'], 0)
+
+        path = sorted(unchanged.files_found.info)[0]
+        folder_mtime = os.path.getmtime(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('truncated')
+        os.utime(os.path.dirname(path), (folder_mtime, folder_mtime))
+
+        second = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        self.assertEqual(second.downloads.stats['transfers'], 1)
+        self.assertEqual(os.path.getsize(path), self.pkg_size)
+
+    def only_bundled_feeds(self):
+        '''Configures only the feeds the fixture serves, so none fail.'''
+        config_file = os.path.join(self.fixture.root, benchmark.config_file)
+        configuration = plistlib.readPlist(config_file)
+        for app, feed_config in configuration['loop_feeds'].items():
+            feed_config['plists'] = [feed for feed in feed_config['plists'] if feed in self.fixture.feeds]  # NOQA
+        plistlib.writePlist(configuration, config_file)
+
+    def stray(self, al, folder):
+        '''Adds a package no feed references to a folder of the mirror.'''
+        path = os.path.join(al.destination, folder, 'Stray.pkg')
+        with open(path, 'w') as f:
+            f.write('stray')
+        return path
+
+    def test_missing_feed_stops_pruning(self):
+        '''Packages referenced only by a feed that can't be fetched aren't
+        pruned, and the manifest is left alone.'''
+        first = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        self.assertTrue([feed for feed in first.supported_plists if feed not in self.fixture.feeds])  # NOQA
+        manifest = os.path.join(first.destination, appleLoops.MirrorManifest.filename)  # NOQA
+        self.assertFalse(os.path.exists(manifest))
+
+        stray = self.stray(first, 'lp10_ms3_content_2016')
+        self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        self.assertTrue(os.path.exists(stray))
+        self.assertFalse(os.path.exists(manifest))
+
+    def test_prune(self):
+        '''With every feed fetched, mirrored and stored packages no feed
+        references are pruned.'''
+        self.only_bundled_feeds()
+        first = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True, content_store=True)  # NOQA
+        self.assertTrue(os.path.exists(os.path.join(first.destination, appleLoops.MirrorManifest.filename)))  # NOQA
+
+        strays = [self.stray(first, 'lp10_ms3_content_2016'), self.stray(first, appleLoops.ContentStore.folder)]  # NOQA
+        second = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True, content_store=True)  # NOQA
+        self.assertEqual(second.downloads.stats['transfers'], 0)
+        self.assertEqual([path for path in strays if os.path.exists(path)], [])  # NOQA
+
+    def test_delta(self):
+        '''Packages unchanged since the last sync aren't checked on disk,
+        the packages of a feed that changed are.'''
+        self.only_bundled_feeds()
+        first = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        manifest_file = os.path.join(first.destination, appleLoops.MirrorManifest.filename)  # NOQA
+        manifest = appleLoops.MirrorManifest()
+        self.assertTrue(manifest.load(manifest_file))
+        self.assertEqual(sorted(manifest.digests), sorted(manifest.feeds))
+
+        # Replaced in place, which doesn't change its folder's mtime
+        path = os.path.join(first.destination, sorted(manifest.packages)[0])
+        folder_mtime = os.path.getmtime(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('truncated')
+        os.utime(os.path.dirname(path), (folder_mtime, folder_mtime))
+
+        trusted = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        self.assertEqual(trusted.downloads.stats['transfers'], 0)
+        self.assertEqual(os.path.getsize(path), len('truncated'))
+
+        manifest.load(manifest_file)
+        manifest.digests = dict((feed, 'changed') for feed in manifest.digests)  # NOQA
+        manifest.save(manifest_file)
+        changed = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        self.assertEqual(changed.downloads.stats['transfers'], 1)
+        self.assertEqual(os.path.getsize(path), self.pkg_size)
+
+    def test_dry_run_refetch(self):
+        '''A dry run reports packages to re-fetch, and leaves them alone.'''
+        self.only_bundled_feeds()
+        first = self.apple_loops(run='sync', sync=True, dry_run=False, verify_sizes=True)  # NOQA
+        path = sorted(first.files_found.info)[0]
+        with open(path, 'w') as f:
+            f.write('truncated')
+        # Without the manifest every package is checked
+        os.remove(os.path.join(first.destination, appleLoops.MirrorManifest.filename))  # NOQA
+
+        events = os.path.join(self.fixture.path, 'events.jsonl')
+        self.apple_loops(run='sync', sync=True, dry_run=True, verify_sizes=True, events=events)  # NOQA
+        with open(events) as f:
+            decisions = [event.get('decision') for event in map(json.loads, f)]  # NOQA
+        self.assertEqual(decisions.count('exists'), 0)
+        self.assertEqual(os.path.getsize(path), len('truncated'))
+
+
+class TestDiffFeeds(FixtureTestCase):
+    def test_diff_packages(self):
+        '''Packages are sorted into what was added, removed, or changed in
+        version or size, and the bytes to catch up are added up.'''
+        al = self.apple_loops(run='load_configuration')
+        old = {
+            'A.pkg': {'PackageVersion': '1', 'DownloadSize': 10},
+            'B.pkg': {'PackageVersion': '1', 'DownloadSize': 20},
+            'C.pkg': {'PackageVersion': '1', 'DownloadSize': 30},
+            'D.pkg': {'DownloadSize': 40},
+        }
+        new = {
+            'A.pkg': {'PackageVersion': '1', 'DownloadSize': 10},
+            'B.pkg': {'PackageVersion': '2', 'DownloadSize': 20},
+            'C.pkg': {'PackageVersion': '1', 'DownloadSize': 35},
+            'E.pkg': {'PackageVersion': '1', 'DownloadSize': 100},
+        }
+        self.assertEqual(al.diff_packages(old, new), {
+            'added': ['E.pkg'],
+            'removed': ['D.pkg'],
+            'version_changed': ['B.pkg'],
+            'size_changed': ['C.pkg'],
+            'download_bytes': 155,
+            'byte_delta': 65,
+        })
+
+    def test_bundled_feeds(self):
+        '''A single feed is compared with the configured feed before it for
+        the same app, and the first feed of an app has nothing before it.'''
+        al = self.apple_loops(run='load_configuration')
+        diffs = al.diff_feeds(['logicpro1022.plist'])
+
+        def packages(feed):
+            packages = plistlib.readPlist(feed_path(feed))['Packages']
+            return set(packages[pkg]['DownloadName'] for pkg in packages)
+
+        old, new = packages('logicpro1021.plist'), packages('logicpro1022.plist')  # NOQA
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual((diffs[0]['old'], diffs[0]['new']), ('logicpro1021.plist', 'logicpro1022.plist'))  # NOQA
+        self.assertEqual(diffs[0]['added'], sorted(new - old))
+        self.assertEqual(diffs[0]['removed'], sorted(old - new))
+        self.assertTrue(diffs[0]['added'] and diffs[0]['removed'])
+
+        # The exit message ignores quiet mode
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            with self.assertRaises(SystemExit) as context:
+                al.diff_feeds(['logicpro1021.plist'])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        self.assertEqual(context.exception.code, 23)
+
+
+class TestPkgServerIndex(FixtureTestCase):
+    pkg_size = 4096
+
+    def index_path(self, info):
+        '''Returns the path of a package in a mirror, the bundled feeds all
+        use the 2016 folder.'''
+        if info['DownloadName'].startswith('../'):
+            return info['DownloadName'][3:]
+        return 'lp10_ms3_content_2016/%s' % info['DownloadName']
+
+    def publish_index(self, folder='', sizes=None):
+        '''Publishes an index of every package in the bundled feeds, with the
+        size each feed gives it unless it is in sizes.'''
+        manifest = appleLoops.MirrorManifest()
+        for feed in self.fixture.feeds:
+            for info in read_feed(feed)['Packages'].values():
+                path = self.index_path(info)
+                manifest.add(path, (sizes or {}).get(path, info['DownloadSize']))  # NOQA
+        if not os.path.exists(os.path.join(self.fixture.root, folder)):
+            os.makedirs(os.path.join(self.fixture.root, folder))
+        manifest.save(os.path.join(self.fixture.root, folder, appleLoops.MirrorManifest.filename))  # NOQA
+
+    def test_index_replaces_probes(self):
+        '''With an index, a deployment fetches it from the pkg_server
+        instead of probing every package.'''
+        probed = self.apple_loops(deployment_mode=True, dry_run=True)
+        server_counts, subprocesses = self.fixture.counts()
+        self.assertFalse(probed.pkg_server_index())
+        self.assertTrue(server_counts.get('head', 0) > 10)
+
+        self.publish_index()
+        indexed = self.apple_loops(deployment_mode=True, dry_run=True)
+        indexed_counts, subprocesses = self.fixture.counts()
+        self.assertTrue(indexed.pkg_server_index())
+        # A single pkg_server isn't probed at all
+        self.assertEqual(indexed_counts.get('head', 0), 0)
+        self.assertEqual(indexed.deployment_summary['install_size'], probed.deployment_summary['install_size'])  # NOQA
+        # Both runs asked for the index once
+        self.assertEqual(indexed_counts['get'], server_counts['get'])
+
+    def test_wrong_size_is_not_used(self):
+        '''A package whose size in the index doesn't match the feed comes
+        from Apple instead of the pkg_server.'''
+        feed = self.fixture.feeds[-1]
+        packages = sorted(read_feed(feed)['Packages'].values(), key=lambda info: info['DownloadName'])  # NOQA
+        self.publish_index(folder='mirror', sizes={self.index_path(packages[1]): 1})  # NOQA
+
+        pkg_server = '%s/mirror' % self.fixture.url
+        al = self.apple_loops(run='pkg_server_index', deployment_mode=True, dry_run=True, pkg_server=pkg_server)  # NOQA
+        self.assertTrue(al.pkg_index)
+        self.assertTrue(al.resolve_pkg(packages[0], feed).pkg_url.startswith(pkg_server))  # NOQA
+        self.assertFalse(al.resolve_pkg(packages[1], feed).pkg_url.startswith(pkg_server))  # NOQA
+
+    def test_stale_index_is_not_used(self):
+        '''A cached index isn't used when the pkg_server stops answering
+        after its index was fetched.'''
+        self.publish_index()
+        al = self.apple_loops(run='pkg_server_index')
+        self.assertTrue(al.pkg_index)
+
+        self.fixture.server.shutdown()
+        self.fixture.server.server_close()
+        al.request.close()
+        al.pkg_index = None
+        self.assertFalse(al.pkg_server_index())
+
+
+class TestMain(FixtureTestCase):
+    pkg_size = 4096
+
+    def main(self, *args):
+        '''Runs appleLoops.py with the arguments against the fixture, and
+        returns the exit code.'''
+        run_path = os.path.join(self.fixture.path, 'run')
+        if not os.path.exists(run_path):
+            os.makedirs(run_path)
+
+        # Nothing is left to close the connection pool, so don't keep any
+        argv, sys.argv = sys.argv, ['appleLoops.py', '--pkg-server', self.fixture.url, '--cache-path', os.path.join(run_path, 'cache'), '--log-path', run_path, '--http-pool-size', '0', '--quiet'] + list(args)  # NOQA
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            appleLoops.main()
+            return 0
+        except SystemExit as e:
+            return e.code
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            sys.argv = argv
+
+    def test_nothing_to_install_completes(self):
+        '''A deployment with nothing to install exits early, but finished.'''
+        shutil.rmtree(self.fixture.apps)
+        events = os.path.join(self.fixture.path, 'events.jsonl')
+        self.assertFalse(self.main('--deployment', '--dry-run', '--mandatory', '--events', events))  # NOQA
+
+        with open(events) as f:
+            summary = [event for event in map(json.loads, f) if event['event'] == 'summary']  # NOQA
+        self.assertEqual(len(summary), 1)
+        self.assertTrue(summary[0]['completed'])
+
+    def test_nothing_to_install_metrics(self):
+        '''The metrics of a deployment that exits early say it finished.'''
+        shutil.rmtree(self.fixture.apps)
+        textfile = os.path.join(self.fixture.path, 'appleloops.prom')
+        self.assertFalse(self.main('--deployment', '--dry-run', '--mandatory', '--prometheus-textfile', textfile))  # NOQA
+
+        with open(textfile) as f:
+            self.assertTrue('appleloops_run_completed{dry_run="true",mode="deployment"} 1\n' in f.read())  # NOQA
+
+    def test_diff_unknown_app(self):
+        '''Feeds for an app that isn't configured exit with an error.'''
+        self.assertEqual(self.main('--diff-feeds', 'foo1.plist', 'bar2.plist'), 24)  # NOQA
+
+
+class TestProfiler(ScratchTestCase):
+    def test_spans_and_commands(self):
+        '''Phases add up across calls in the order they first ran, and each
+        command is counted by name.'''
+        profiler = appleLoops.Profiler(enabled=True)
+        profiler.start()
+        with profiler.span('feeds'):
+            profiler.count(['/bin/true'])
+            time.sleep(0.02)
+        with profiler.span('downloads'):
+            profiler.count(['true', '-v'])
+        with profiler.span('feeds'):
+            profiler.count(['/bin/true'])
+        profiler.stop()
+
+        self.assertEqual(profiler.order, ['feeds', 'downloads'])
+        self.assertEqual(profiler.phases['feeds'][0], 2)
+        self.assertGreaterEqual(profiler.phases['feeds'][1], 0.02)
+        self.assertEqual(profiler.commands, {'true': 3})
+
+    def test_disabled(self):
+        '''A disabled profiler records nothing.'''
+        profiler = appleLoops.Profiler()
+        profiler.start()
+        with profiler.span('feeds'):
+            profiler.count(['/bin/true'])
+        profiler.stop()
+        self.assertEqual((profiler.phases, profiler.commands), ({}, {}))
+
+    def test_profile_file(self):
+        '''cProfile stats are written to the profile file when stopped.'''
+        profile_file = os.path.join(self.path, 'appleLoops.prof')
+        profiler = appleLoops.Profiler(profile_file=profile_file)
+        profiler.start()
+        appleLoops.order_loops([], 'feed')
+        profiler.stop()
+        self.assertTrue(profiler.enabled)
+        self.assertTrue(os.path.getsize(profile_file) > 0)
+
+
+class TestProfiledRun(FixtureTestCase):
+    pkg_size = 4096
+
+    def test_commands_counted_where_run(self):
+        '''A run counts the commands it runs itself, without patching
+        subprocess for the rest of the process.'''
+        popen = subprocess.Popen
+        al = self.apple_loops(deployment_mode=True, dry_run=True, prometheus_textfile=os.path.join(self.fixture.path, 'appleLoops.prom'))  # NOQA
+        self.assertIs(subprocess.Popen, popen)
+        server_counts, subprocesses = self.fixture.counts()
+        self.assertEqual(al.profiler.commands, subprocesses)
+
+
+class TestEventStream(FixtureTestCase):
+    pkg_size = 4096
+
+    def read_events(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_stream(self):
+        '''Events are appended as JSON lines sharing the run's ID, and an
+        event that can't be written is dropped without raising.'''
+        path = os.path.join(self.fixture.path, 'events.jsonl')
+        events = appleLoops.EventStream(path)
+        events.emit('start', version='1')
+        events.emit('broken', value=object())
+        events.emit('summary', completed=True)
+        events.close()
+        events.emit('closed')
+        events = appleLoops.EventStream(path)
+        events.emit('start')
+        events.close()
+
+        records = self.read_events(path)
+        self.assertEqual([record['event'] for record in records], ['start', 'summary', 'start'])  # NOQA
+        self.assertEqual(records[0]['version'], '1')
+        self.assertEqual(records[0]['run'], records[1]['run'])
+        self.assertNotEqual(records[0]['run'], records[2]['run'])
+        appleLoops.EventStream().emit('dropped')
+
+    def test_run(self):
+        '''Every package has a decision and every download a result, and a
+        second run finds the packages already there.'''
+        path = os.path.join(self.fixture.path, 'events.jsonl')
+        al = self.apple_loops(apps_plist=['garageband1011.plist'], dry_run=False, events=path)  # NOQA
+        al.summary_event()
+        records = self.read_events(path)
+        os.remove(path)
+
+        packages = [record for record in records if record['event'] == 'package']  # NOQA
+        downloads = [record for record in records if record['event'] == 'download']  # NOQA
+        self.assertEqual(records[0]['event'], 'start')
+        self.assertTrue(packages)
+        self.assertEqual(set(record['decision'] for record in packages), set(['download']))  # NOQA
+        self.assertEqual(sorted(record['name'] for record in downloads), sorted(record['name'] for record in packages))  # NOQA
+        self.assertEqual(set(record['result'] for record in downloads), set(['ok']))  # NOQA
+        self.assertEqual(records[-1]['event'], 'summary')
+        self.assertEqual(records[-1]['downloads'], len(downloads))
+
+        al = self.apple_loops(apps_plist=['garageband1011.plist'], dry_run=False, events=path)  # NOQA
+        al.events.close()
+        records = self.read_events(path)
+        self.assertEqual(set(record['decision'] for record in records if record['event'] == 'package'), set(['exists']))  # NOQA
+        self.assertNotIn('download', [record['event'] for record in records])
+
+
+class TestMetrics(FixtureTestCase):
+    pkg_size = 4096
+
+    def test_render(self):
+        '''Each metric has its help and type once, followed by its samples
+        with their labels sorted and escaped.'''
+        path = os.path.join(self.fixture.path, 'appleloops.prom')
+        metrics = appleLoops.PrometheusTextfile(path)
+        metrics.add('downloads', 'Packages downloaded.', 3)
+        metrics.add('downloaded_bytes', 'Bytes downloaded.', 10, {'source': 'apple', 'feed': 'a"b\\c'})  # NOQA
+        metrics.add('downloaded_bytes', 'Bytes downloaded.', 20, {'source': 'pkg_server'})  # NOQA
+        metrics.write()
+
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(), [
+                '# HELP appleloops_downloads Packages downloaded.',
+                '# TYPE appleloops_downloads gauge',
+                'appleloops_downloads 3',
+                '# HELP appleloops_downloaded_bytes Bytes downloaded.',
+                '# TYPE appleloops_downloaded_bytes gauge',
+                'appleloops_downloaded_bytes{feed="a\\"b\\\\c",source="apple"} 10',  # NOQA
+                'appleloops_downloaded_bytes{source="pkg_server"} 20',
+            ])
+        self.assertEqual(os.stat(path).st_mode & 0777, 0644)
+        self.assertFalse([name for name in os.listdir(self.fixture.path) if name.endswith('.tmp')])  # NOQA
+
+    def test_run_metrics(self):
+        '''The metrics of a run count what was downloaded from each source.'''
+        textfile = os.path.join(self.fixture.path, 'appleloops.prom')
+        al = self.apple_loops(apps_plist=['garageband1011.plist'], dry_run=False, prometheus_textfile=textfile)  # NOQA
+        al.write_metrics()
+
+        with open(textfile) as f:
+            lines = f.read().splitlines()
+        self.assertIn('appleloops_run_completed{dry_run="false",mode="download"} 1', lines)  # NOQA
+        self.assertIn('appleloops_downloads %s' % al.downloads.stats['transfers'], lines)  # NOQA
+        self.assertIn('appleloops_downloaded_bytes{source="pkg_server"} %s' % (al.downloads.stats['transfers'] * self.pkg_size), lines)  # NOQA
+        self.assertIn('appleloops_downloaded_bytes{source="apple"} 0', lines)
+        self.assertTrue(al.downloads.stats['transfers'] > 0)
+
+    def test_failures_are_left_out(self):
+        '''Metrics that can't be worked out or written don't stop a run, and
+        leave no temporary files behind.'''
+        # A folder can't be replaced by the textfile
+        textfile = os.path.join(self.fixture.path, 'metrics', 'appleloops.prom')  # NOQA
+        os.makedirs(textfile)
+        al = self.apple_loops(run='load_configuration', prometheus_textfile=textfile)  # NOQA
+        al.write_metrics()
+        self.assertEqual(os.listdir(os.path.dirname(textfile)), ['appleloops.prom'])  # NOQA
+
+        def query():
+            raise OSError(2, 'No such file or directory')
+
+        os.rmdir(textfile)
+        al.space.query = query
+        al.write_metrics()
+        self.assertEqual(os.listdir(os.path.dirname(textfile)), [])
+
+
+class TestStagingArea(unittest.TestCase):
+    def test_reserve_waits_for_room(self):
+        '''A download waits until installs release enough room, but one is
+        always let in when nothing is staged.'''
+        staging = appleLoops.StagingArea(10)
+        staging.reserve(100)
+        staging.release(100)
+        staging.reserve(6)
+
+        reserved = threading.Event()
+        thread = threading.Thread(target=lambda: (staging.reserve(6), reserved.set()))  # NOQA
+        thread.daemon = True
+        thread.start()
+        self.assertFalse(reserved.wait(0.1))
+
+        staging.release(6)
+        self.assertTrue(reserved.wait(5))
+        self.assertEqual(staging.used, 6)
+
+    def test_kept_files_still_count(self):
+        '''A file left on disk after its install still takes up room, but
+        doesn't stop the next download from being let in.'''
+        staging = appleLoops.StagingArea(10)
+        staging.reserve(6)
+        staging.keep(6)
+        self.assertEqual((staging.used, staging.kept), (0, 6))
+
+        staging.reserve(6)
+        reserved = threading.Event()
+        thread = threading.Thread(target=lambda: (staging.reserve(1), reserved.set()))  # NOQA
+        thread.daemon = True
+        thread.start()
+        self.assertFalse(reserved.wait(0.1))
+
+        staging.release(6)
+        self.assertTrue(reserved.wait(5))
+
+    def test_unknown_size(self):
+        '''A package whose size lookup failed counts as nothing.'''
+        staging = appleLoops.StagingArea(10)
+        staging.reserve(None)
+        staging.keep(None)
+        staging.release(None)
+        self.assertEqual((staging.used, staging.kept), (0, 0))
+
+
+@unittest.skipUnless(os.getuid() == 0, 'installing needs root')
+class TestDeployment(FixtureTestCase):
+    def test_pipeline(self):
+        '''Every downloaded package is installed, and removed from the
+        deployment folder once it is.'''
+        events = os.path.join(self.fixture.path, 'events.jsonl')
+        al = self.apple_loops(deployment_mode=True, dry_run=False, events=events)  # NOQA
+        al.events.close()
+
+        with open(events) as f:
+            records = map(json.loads, f)
+        downloads = sorted(record['name'] for record in records if record['event'] == 'download')  # NOQA
+        installs = sorted(record['name'] for record in records if record['event'] == 'install' and record['result'] == 'installed')  # NOQA
+        self.assertTrue(downloads)
+        self.assertEqual(installs, downloads)
+        self.assertEqual(al.deployment_summary['successful_installs'], len(downloads))  # NOQA
+        self.assertFalse([name for name in os.listdir(appleLoops.DEPLOYMENT_PATH) if name.endswith('.pkg')])  # NOQA
+
+    def test_events_on_stdout(self):
+        '''With events streamed to stdout, every line written there is an
+        event, messages go to stderr.'''
+        run_path = os.path.join(self.fixture.path, 'run')
+        os.makedirs(run_path)
+        output = os.path.join(run_path, 'stdout')
+        argv, sys.argv = sys.argv, ['appleLoops.py', '--deployment', '--mandatory', '--pkg-server', self.fixture.url, '--cache-path', os.path.join(run_path, 'cache'), '--log-path', run_path, '--http-pool-size', '0', '--events', '-', '-q']  # NOQA
+        stdout, sys.stdout = sys.stdout, open(output, 'w')
+        stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+        try:
+            appleLoops.main()
+        finally:
+            sys.stdout.close()
+            sys.stderr.close()
+            sys.stdout, sys.stderr, sys.argv = stdout, stderr, argv
+
+        with open(output) as f:
+            records = map(json.loads, f)
+        self.assertTrue([record for record in records if record['event'] == 'install'])  # NOQA
+        self.assertEqual(records[-1]['event'], 'summary')
+
+    def test_failover_bytes(self):
+        '''Bytes of a download that fails over from a pkg_server to Apple
+        are counted against Apple.'''
+        # A second fixture points appleLoops at itself, so point it back
+        names = ['APPLE_URL', 'DEPLOYMENT_PATH', 'CURL', 'DISKUTIL', 'HDIUTIL', 'INSTALLER', 'PKGUTIL']  # NOQA
+        settings = dict((name, getattr(appleLoops, name)) for name in names)
+        mirror = benchmark.Fixture(self.pkg_size, 0)
+        self.addCleanup(mirror.close)
+        for name, value in settings.items():
+            setattr(appleLoops, name, value)
+
+        al = self.apple_loops(run='load_configuration', deployment_mode=True, dry_run=False, pkg_server=mirror.url)  # NOQA
+        pkg = al.resolve_pkg({'DownloadName': 'Loops.pkg', 'DownloadSize': self.pkg_size, 'PackageID': 'com.example.loops'}, 'garageband1021.plist')  # NOQA
+        self.assertTrue(pkg.pkg_url.startswith(mirror.url))
+        self.assertEqual(al.pkg_source(pkg), 'pkg_server')
+
+        mirror.server.shutdown()
+        mirror.server.server_close()
+        al.download(pkg, scheduler=al.downloads)
+        al.downloads.run()
+        self.assertEqual(al.downloads.source_bytes, {'apple': self.pkg_size, 'pkg_server': 0, 'cache_server': 0})  # NOQA
+
+    def test_leftover_pkg_is_installed(self):
+        '''A package left behind by an earlier run is installed, not just
+        skipped because it is already there.'''
+        events = os.path.join(self.fixture.path, 'events.jsonl')
+        first = self.apple_loops(deployment_mode=True, dry_run=False, events=events)  # NOQA
+        installed = first.deployment_summary['successful_installs']
+        self.assertTrue(installed > 0)
+
+        with open(events) as f:
+            name = [event['name'] for event in map(json.loads, f) if event['event'] == 'install'][0]  # NOQA
+        leftover = os.path.join(appleLoops.DEPLOYMENT_PATH, name)
+        self.assertTrue(leftover.startswith(self.fixture.path))
+        with open(leftover, 'w') as f:
+            f.write(self.fixture.server.payload)
+
+        second = self.apple_loops(deployment_mode=True, dry_run=False)
+        self.assertEqual(second.deployment_summary['successful_installs'], installed)  # NOQA
+        self.assertEqual(second.downloads.stats['transfers'], installed - 1)  # NOQA
+        self.assertFalse(os.path.exists(leftover))
+
+
+class TestBenchmark(FixtureTestCase):
+    pkg_size = 4096
+
+    def test_dry_run_scenarios(self):
+        '''A cold dry run fetches the configuration and feeds but no
+        packages, and a warm one only revalidates them.'''
+        run_path = os.path.join(self.fixture.path, 'benchmark')
+        scenarios = dict((name, kwargs) for name, kwargs, warm in benchmark.scenarios(self.fixture, 4))  # NOQA
+        cold = benchmark.run(self.fixture, 'dry-run', scenarios['dry-run'], run_path)  # NOQA
+        warm = benchmark.run(self.fixture, 'dry-run-warm', scenarios['dry-run-warm'], run_path)  # NOQA
+
+        self.assertTrue(cold['cache']['fetched'] > 0)
+        self.assertEqual(cold['http']['pkg_gets'], 0)
+        self.assertEqual(cold['downloads']['transfers'], 0)
+        self.assertEqual(warm['cache']['fetched'], 0)
+        self.assertEqual(warm['http']['not_modified'], cold['cache']['fetched'])  # NOQA
+        self.assertEqual(warm['http']['feed_and_config_gets'], warm['http']['not_modified'])  # NOQA
+
+    def test_microbenchmarks(self):
+        '''Every microbenchmark case runs against a feed, apart from
+        Foundation where it isn't available.'''
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output([sys.executable, os.path.join(repo_path, 'benchmarks', 'microbench.py'), '--feed', 'garageband1012.plist', '--repeat', '1'], stderr=devnull)  # NOQA
+        results = json.loads(output)
+        self.assertEqual([feed['feed'] for feed in results['feeds']], ['garageband1012.plist'])  # NOQA
+
+        cases = results['feeds'][0]['cases']
+        self.assertEqual(sorted(cases), sorted(['plistlib', 'foundation', 'feed_reader', 'resolve_feeds', 'diff_feeds', 'duplicates']))  # NOQA
+        for case in cases:
+            if case != 'foundation':
+                self.assertFalse(cases[case]['skipped'], case)
+                self.assertTrue(cases[case]['best'] >= 0, case)
+                self.assertTrue(0 <= cases[case]['peak_rss_growth'] < cases[case]['peak_rss'], case)  # NOQA
+
+
+if __name__ == '__main__':
+    unittest.main()